@@ -7,18 +7,39 @@ import * as d3 from 'd3'
 import axios from 'axios'
 import { get } from 'node_modules/axios/index.cjs'
 import vesselMovements from '../data/vesselMovements.json'
-import commodityDistributions from '../data/commodityDistributions.json'
 import mc2 from '../data/mc2.json'
 import pairVesselCommodity from '../data/pairVesselCommodity.json'
-import vesselCommodityUnion from '../data/vesselCommodityUnion.json'
-import transportMovements from '../data/transportMovements.json'
-import harborMovements from '../data/harborMovements.json'
 import Oceanus_Geography from '../data/Oceanus_Geography.json'
 import locationCoordinates from '../data/locationCoordinates.json'
 
 // import { get } from 'node_modules/axios/index.cjs'
 
 const DATA_SERVER_URL = 'http://127.0.0.1:5000'
+// MAX_PAGE_SIZE of the server, larger pages mean fewer round trips
+const PAGE_SIZE = 10000
+
+// the in-flight request of each fetch, aborted when the same fetch starts again for newer filters
+const pendingRequests: { [name: string]: AbortController } = {}
+
+function restartRequest(name: string) {
+  pendingRequests[name]?.abort()
+  pendingRequests[name] = new AbortController()
+  return pendingRequests[name].signal
+}
+
+// paired vessels and commodities are matched by id, a refetched union holds new copies of them
+function sameVessel(a: any, b: any) {
+  return a.movement_id === b.movement_id && a.vessel_id === b.vessel_id
+}
+
+function sameCommodity(a: any, b: any) {
+  return a.document_id === b.document_id
+}
+
+function removePair(union: any, pair: any) {
+  union.vessels = union.vessels.filter((item: any) => !sameVessel(item, pair.vessel))
+  union.commoditys = union.commoditys.filter((item: any) => !sameCommodity(item, pair.commodity))
+}
 
 interface LocationCoordinates {
   [key: string]: [number, number]
@@ -50,7 +71,7 @@ export const useStore = defineStore({
   state: () => ({
     exampleData: [],
     vesselMovements: [] as any,
-    commodityDistributions: commodityDistributions as CommodityDistribution[],
+    commodityDistributions: [] as CommodityDistribution[],
     locationCoordinates: locationCoordinates as any,
     vesselMovementsFlag: false,
     commodityDistributionsFlag: false,
@@ -67,8 +88,8 @@ export const useStore = defineStore({
     commoditys: [] as string[],
     commodityFishingLocations: {} as any,
     pairVesselCommodity: pairVesselCommodity as any,
-    remainVesselCommodityUnion: vesselCommodityUnion as any,
-    vesselCommodityUnion: vesselCommodityUnion as any,
+    remainVesselCommodityUnion: [] as any,
+    vesselCommodityUnion: [] as any,
     transportMovements: [] as any,
     harborMovements: [] as any,
     vesselTSNE: [] as any,
@@ -358,11 +379,44 @@ export const useStore = defineStore({
         this.exampleData = data
       })
     },
+    // follow the next_cursor of a paginated query endpoint until every page is in
+    async getAllPages(api: string, param: object, signal?: AbortSignal) {
+      const items: any[] = []
+      let cursor = null
+      do {
+        const response: any = await axios.post(`${DATA_SERVER_URL}/${api}`, { ...param, cursor, limit: PAGE_SIZE }, { signal })
+        items.push(...response.data.items)
+        cursor = response.data.next_cursor
+      } while (cursor)
+      return items
+    },
     async getVesselMovements() {
-      await new Promise(resolve => setTimeout(resolve, 1000))
-      this.vesselMovements = transportMovements
-      this.transportMovements = transportMovements
-      this.harborMovements = harborMovements
+      const param = { start_date: this.dateInterval[0], end_date: this.dateInterval[1] }
+      const signal = restartRequest('vesselMovements')
+      try {
+        const [transportMovements, harborMovements] = await Promise.all([
+          this.getAllPages('query_transport_movements', param, signal),
+          this.getAllPages('query_harbor_movements', param, signal),
+        ])
+        this.vesselMovements = transportMovements
+        this.transportMovements = transportMovements
+        this.harborMovements = harborMovements
+      }
+      catch (error) {
+        // a newer date interval took over
+        if (!axios.isCancel(error))
+          console.error(error)
+      }
+    },
+    async getCommodityDistributions() {
+      const signal = restartRequest('commodityDistributions')
+      try {
+        this.commodityDistributions = await this.getAllPages('query_commodity_distributions', { start_date: this.dateInterval[0], end_date: this.dateInterval[1] }, signal)
+      }
+      catch (error) {
+        if (!axios.isCancel(error))
+          console.error(error)
+      }
     },
     getDefaultPairVesselCommodity() {
       this.pairVesselCommodity = pairVesselCommodity
@@ -370,15 +424,21 @@ export const useStore = defineStore({
     },
     deleteVesselCommodityPair(pair: any) {
       this.pairVesselCommodity = this.pairVesselCommodity.filter((item: any) => item !== pair)
-      const union = this.remainVesselCommodityUnion.filter((item: any) => item.date === pair.date && item.location_id === pair.location_id)[0]
-      union.vessels.push(pair.vessel)
-      union.commoditys.push(pair.commodity)
+      // the union may not be loaded for the current filters
+      const union = this.remainVesselCommodityUnion.find((item: any) => item.date === pair.date && item.location_id === pair.location_id)
+      if (!union)
+        return
+      if (!union.vessels.some((item: any) => sameVessel(item, pair.vessel)))
+        union.vessels.push(pair.vessel)
+      if (!union.commoditys.some((item: any) => sameCommodity(item, pair.commodity)))
+        union.commoditys.push(pair.commodity)
     },
     addVesselCommodityPair(date: string, location_id: string, vessel: any, commodity: any) {
-      this.pairVesselCommodity.unshift({ date, location_id, vessel, commodity })
-      const union = this.remainVesselCommodityUnion.filter((item: any) => item.date === date && item.location_id === location_id)[0]
-      union.vessels = union.vessels.filter((item: any) => item !== vessel)
-      union.commoditys = union.commoditys.filter((item: any) => item !== commodity)
+      const pair = { date, location_id, vessel, commodity }
+      this.pairVesselCommodity.unshift(pair)
+      const union = this.remainVesselCommodityUnion.find((item: any) => item.date === date && item.location_id === location_id)
+      if (union)
+        removePair(union, pair)
     },
     initialization() {
       this.selectedVesselIDs = this.vessels.map((vessel: any) => vessel.id)
@@ -386,6 +446,26 @@ export const useStore = defineStore({
       this.selectedCommodityIDs = this.commodities.map((commodity: any) => commodity.id)
       this.dateInterval = ['2035-02-01', '2035-12-31']
     },
+    async getVesselCommodityUnion() {
+      const param = { start_date: this.dateInterval[0], end_date: this.dateInterval[1], location_ids: this.selectedLocationIDs }
+      const signal = restartRequest('vesselCommodityUnion')
+      try {
+        const response = await axios.post(`${DATA_SERVER_URL}/get_vessel_commodity_union`, param, { signal })
+        // what is already paired is not left to pair again
+        const unions = new Map(response.data.map((item: any) => [`${item.date} ${item.location_id}`, item]))
+        for (const pair of this.pairVesselCommodity) {
+          const union = unions.get(`${pair.date} ${pair.location_id}`)
+          if (union)
+            removePair(union, pair)
+        }
+        this.vesselCommodityUnion = response.data
+        this.remainVesselCommodityUnion = response.data
+      }
+      catch (error) {
+        if (!axios.isCancel(error))
+          console.error(error)
+      }
+    },
     getVesselTSNE() {
       this.post('get_vessel_tsne', { start_date: this.dateInterval[0], end_date: this.dateInterval[1], vessel_ids: this.vesselIDs, location_ids: this.selectedLocationIDs }, (data: []) => {
         this.vesselTSNE = data
@@ -0,0 +1,220 @@
+"""
+Time and memory-profile the Model hot paths on synthetic MC2 data.
+
+    $ python benchmark.py --scales 1 10 --repeat 3 --output bench.json
+    $ python benchmark.py --scales 1 10 --baseline bench.json
+
+Every scale runs in a fresh process, so startup and peak RSS are not
+skewed by what an earlier scale left behind.  The generated data is kept
+under --data-root and reused while the scale and seed stay the same.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import resource
+import statistics
+import subprocess
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+
+# few enough vessels that the pair distances stay affordable, t-SNE needs more than its perplexity
+TSNE_VESSELS = 100
+TSNE_PERPLEXITY = 50
+TSNE_DAYS = 60
+# a stage this much slower than in the baseline is reported as a regression
+REGRESSION_RATIO = 1.2
+
+
+def measure(function, setup=None, repeat=3, memory=True):
+    """Seconds of every run of function(setup()), plus its tracemalloc peak from one extra run."""
+    runs = []
+    result = None
+    for _ in range(repeat):
+        argument = setup() if setup is not None else None
+        start = time.perf_counter()
+        result = function(argument)
+        runs.append(time.perf_counter() - start)
+    stage = {'runs': runs, 'min': min(runs), 'median': statistics.median(runs)}
+    if memory:
+        # traced separately, tracing slows the allocations down too much to time them
+        argument = setup() if setup is not None else None
+        tracemalloc.start()
+        function(argument)
+        stage['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    # ru_maxrss is in kilobytes on Linux
+    stage['max_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return stage, result
+
+
+def run_stages(data_folder, repeat, memory):
+    from src.models import Model, FOLDER_CACHE, FOLDER_SIMILARITY
+    from src.similarity import SimilarityIndexStore
+
+    cache = os.path.join(data_folder, FOLDER_CACHE)
+    stages = {}
+
+    def cold(_):
+        shutil.rmtree(cache, ignore_errors=True)
+        return Model(data_folder)
+
+    stages['startup_cold'], _ = measure(cold, repeat=repeat, memory=memory)
+    stages['startup_warm'], model = measure(lambda _: Model(data_folder), repeat=repeat, memory=memory)
+
+    vessels = model.get_entities_vague('Entity.Vessel')['id'].tolist()
+    locations = model.get_entities_vague('Entity.Location')['id'].tolist()
+    dates = model.movement_table['start_time'].str[:10]
+    start_date, end_date = dates.min(), dates.max()
+    tsne_end = (datetime.strptime(start_date, '%Y-%m-%d') + timedelta(days=TSNE_DAYS - 1)).strftime('%Y-%m-%d')
+
+    def bench(name, function, setup=None):
+        stages[name], result = measure(function, setup, repeat=repeat, memory=memory)
+        return result
+
+    bench('get_transport_movements', lambda _: model.get_transport_movements())
+    bench('get_vessel_time_series', lambda _: model.get_vessel_time_series(start_date, end_date, vessels, locations))
+    time_series = model.get_vessel_time_series(start_date, tsne_end, vessels[:TSNE_VESSELS], locations)
+    if len(time_series) > TSNE_PERPLEXITY:
+        bench('get_vessel_tsne', lambda _: model.get_vessel_tsne(time_series))
+
+    def reset_similarity_indexes():
+        folder = os.path.join(cache, FOLDER_SIMILARITY)
+        shutil.rmtree(folder, ignore_errors=True)
+        model.similarity_indexes = SimilarityIndexStore(folder)
+
+    index = bench('get_similarity_index', lambda _: model.get_similarity_index(start_date, end_date, locations),
+                  reset_similarity_indexes)
+    if len(index):
+        bench('get_similar_vessels',
+              lambda _: model.get_similar_vessels(index.vessels[0], start_date, end_date, locations))
+
+    def reset_rollups():
+        model.vessel_rollup = model.commodity_rollup = None
+
+    bench('get_vessel_rollup', lambda _: model.get_vessel_rollup(), reset_rollups)
+    bench('get_commodity_rollup', lambda _: model.get_commodity_rollup(), reset_rollups)
+    bench('get_rollup', lambda _: model.get_rollup('vessel', start_date, end_date, bins=52))
+    bench('get_aggregate_vessel_movements',
+          lambda _: model.get_aggregate_vessel_movements(start_date, end_date, vessels, locations))
+
+    def reset_harbor_table():
+        model.harbor_table = None
+
+    bench('get_harbor_movements', lambda _: model.get_harbor_movements(), reset_harbor_table)
+    date_location_commodity = bench('get_date_location_commodity', lambda _: model.get_date_location_commodity())
+
+    def reset_commodity_tables():
+        model.species_index = model.commodity_fishing_locations = model.commodity_distribution_table = None
+
+    bench('get_commodity_fishing_locations', lambda _: model.get_commodity_fishing_locations(), reset_commodity_tables)
+    bench('get_commodity_distributions', lambda _: model.get_commodity_distributions(), reset_commodity_tables)
+    bench('get_date_location_commodity_export', lambda _: model.get_date_location_commodity_export())
+    bench('get_date_location_commodity_import', lambda _: model.get_date_location_commodity_import())
+
+    harbor_movements = model.get_harbor_movements()
+    bench('get_vessel_commodity_union',
+          lambda _: model.get_vessel_commodity_union(harbor_movements, date_location_commodity))
+    # refresh_unions extends the union it is given, so every run gets its own
+    bench('refresh_unions', lambda union: model.refresh_unions(union, harbor_movements),
+          lambda: model.get_vessel_commodity_union([], date_location_commodity))
+
+    def reset_union_index():
+        model.union_index = None
+
+    bench('get_union_index', lambda _: model.get_union_index(), reset_union_index)
+    return stages
+
+
+def worker(args):
+    # runs in its own process, the results go to a file because the model prints to stdout
+    stages = run_stages(args.worker, args.repeat, not args.no_memory)
+    with open(args.result, 'w') as file:
+        json.dump(stages, file)
+
+
+def prepare(data_root, scale, seed):
+    from src.synthetic import generate
+
+    folder = os.path.abspath(os.path.join(data_root, f'x{scale:g}-seed{seed}'))
+    meta_path = os.path.join(folder, 'counts.json')
+    if not os.path.exists(meta_path):
+        counts = generate(folder, scale=scale, seed=seed)
+        with open(meta_path, 'w') as file:
+            json.dump(counts, file)
+    with open(meta_path, 'r') as file:
+        return folder, json.load(file)
+
+
+def compare(results, baseline_path):
+    with open(baseline_path, 'r') as file:
+        baseline = {entry['scale']: entry['stages'] for entry in json.load(file)['results']}
+    regressions = []
+    for entry in results:
+        before = baseline.get(entry['scale'], {})
+        for name, stage in entry['stages'].items():
+            if name not in before:
+                continue
+            ratio = stage['min'] / max(before[name]['min'], 1e-9)
+            flag = ' REGRESSION' if ratio > REGRESSION_RATIO else ''
+            print(f"x{entry['scale']:g} {name:40s} {before[name]['min']:9.4f}s -> {stage['min']:9.4f}s "
+                  f"({ratio:5.2f}x){flag}")
+            if flag:
+                regressions.append((entry['scale'], name))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scales', type=float, nargs='+', default=[1, 10])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--data-root', default=os.path.join('data', 'cache', 'benchmark'))
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='compare against the results of an earlier run')
+    parser.add_argument('--no-memory', action='store_true', help='skip the tracemalloc runs')
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    parser.add_argument('--result', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        return worker(args)
+
+    results = []
+    for scale in args.scales:
+        folder, counts = prepare(args.data_root, scale, args.seed)
+        result_path = os.path.join(folder, 'result.json')
+        command = [sys.executable, os.path.abspath(__file__), '--worker', folder, '--result', result_path,
+                   '--repeat', str(args.repeat)] + (['--no-memory'] if args.no_memory else [])
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL,
+                       cwd=os.path.dirname(os.path.abspath(__file__)))
+        with open(result_path, 'r') as file:
+            stages = json.load(file)
+        results.append({'scale': scale, 'counts': counts, 'stages': stages})
+        for name, stage in stages.items():
+            print(f"x{scale:g} {name:40s} min {stage['min']:9.4f}s  median {stage['median']:9.4f}s"
+                  + (f"  peak {stage['peak_bytes'] / 2 ** 20:8.1f} MiB" if 'peak_bytes' in stage else ''))
+
+    report = {
+        'meta': {
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'repeat': args.repeat,
+            'seed': args.seed,
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    if args.baseline and compare(results, args.baseline):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
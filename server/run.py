@@ -1,3 +1,3 @@
-from src import app
+from src import app, views
 
 app.run(host='127.0.0.1', port=5000, use_reloader=True, debug=True)
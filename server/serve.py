@@ -0,0 +1,186 @@
+"""
+Production server: the model is loaded once, then pre-forked workers share it.
+
+    $ python serve.py --workers 8 --port 5000 --max-requests 5000
+
+The parent process imports the views (which loads the model from the
+snapshot), freezes the garbage collector so that the loaded objects are
+never written to again, binds the socket and forks the workers.  Workers
+inherit the model copy-on-write and the memory-mapped tables through the
+page cache, so each one adds little beyond its own request state.
+
+Workers accept on the shared socket and recycle themselves after
+--max-requests requests (plus some jitter, so they do not all restart
+together): they stop accepting, finish the requests in flight and exit, and
+the parent forks a replacement.  SIGHUP recycles every worker one at a
+time, SIGTERM / SIGINT drain them all and stop.  GET /ready answers 503
+from a draining worker.  Batches sent to POST /ingest (or dropped into
+data/inbox with --watch) go through the shared ingest log, so every worker
+applies them.  Job records are kept in data/cache/jobs: a job submitted to
+one worker can be polled, fetched or cancelled through any other, and it
+finishes even when the worker that started it is recycled.
+"""
+import os
+import gc
+import sys
+import time
+import random
+import signal
+import socket
+import argparse
+import threading
+from werkzeug.serving import make_server, select_address_family
+
+# a worker that dies this soon after its start is not restarted right away, it would crash again
+MIN_WORKER_LIFETIME = 1.0
+
+
+def worker(listener, args):
+    from src import app
+    from src.serving import CountingMiddleware, worker_state
+    from src.metrics import registry
+
+    # the parent's handlers do not apply here
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+    max_requests = args.max_requests + random.randint(0, args.max_requests_jitter) if args.max_requests else 0
+    server = None
+
+    def drain():
+        if worker_state.draining:
+            return
+        worker_state.draining = True
+        # shutdown() waits for serve_forever to return, so never from the serving thread itself
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    def on_request(served):
+        if max_requests and served >= max_requests:
+            drain()
+
+    server = make_server(args.host, args.port, CountingMiddleware(app, on_request=on_request), threaded=True,
+                         fd=listener.fileno())
+    signal.signal(signal.SIGTERM, lambda signum, frame: drain())
+    server.serve_forever()
+
+    worker_state.wait_idle(args.graceful_timeout)
+    registry.flush()
+    os._exit(0)
+
+
+def spawn(listener, args):
+    pid = os.fork()
+    if pid == 0:
+        try:
+            worker(listener, args)
+        finally:
+            os._exit(1)
+    return pid
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--max-requests', type=int, default=0, help='recycle a worker after this many, 0 never')
+    parser.add_argument('--max-requests-jitter', type=int, default=0)
+    parser.add_argument('--graceful-timeout', type=float, default=30.0,
+                        help='seconds a draining worker gets to finish its requests')
+    parser.add_argument('--watch', action='store_true', help='ingest the batch files dropped into data/inbox')
+    args = parser.parse_args()
+
+    from src import app, views
+    from src.metrics import registry
+
+    app.config['DEBUG'] = False
+    app.config['TEMPLATES_AUTO_RELOAD'] = False
+
+    listener = socket.socket(select_address_family(args.host, args.port), socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((args.host, args.port))
+    listener.listen(128)
+    listener.set_inheritable(True)
+
+    # the loaded model is long-lived: keep the collector from touching (and so copying) its pages in the workers
+    gc.collect()
+    gc.freeze()
+    # the startup timings are only ever recorded here
+    registry.flush()
+
+    workers = {}
+    started = {}
+    stopping = False
+    recycle = []
+
+    def start_worker():
+        pid = spawn(listener, args)
+        workers[pid] = True
+        started[pid] = time.monotonic()
+
+    def on_stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(workers):
+            _kill(pid, signal.SIGTERM)
+
+    def on_hup(signum, frame):
+        recycle.extend(pid for pid in workers if pid not in recycle)
+
+    signal.signal(signal.SIGTERM, on_stop)
+    signal.signal(signal.SIGINT, on_stop)
+    signal.signal(signal.SIGHUP, on_hup)
+
+    for _ in range(args.workers):
+        start_worker()
+    print(f' * serving {args.host}:{args.port} with {args.workers} workers, data version {views.model.data_version}',
+          file=sys.stderr)
+    if args.watch:
+        # the parent only moves the files into the ingest log, every worker applies it on its next request
+        views.inbox.start()
+
+    deadline = None
+    while workers:
+        if stopping and deadline is None:
+            deadline = time.monotonic() + args.graceful_timeout
+        if deadline is not None and time.monotonic() > deadline:
+            for pid in list(workers):
+                _kill(pid, signal.SIGKILL)
+        if recycle and not stopping and all(workers.values()):
+            # one at a time: start the replacement first, then drain the old worker
+            pid = recycle.pop(0)
+            if pid in workers:
+                start_worker()
+                workers[pid] = False
+                _kill(pid, signal.SIGTERM)
+
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        if pid == 0:
+            time.sleep(0.1)
+            continue
+        if pid not in workers:
+            continue
+        replace = workers.pop(pid)
+        lifetime = time.monotonic() - started.pop(pid)
+        if stopping or not replace:
+            continue
+        if lifetime < MIN_WORKER_LIFETIME:
+            time.sleep(MIN_WORKER_LIFETIME)
+        start_worker()
+    listener.close()
+
+
+def _kill(pid, signum):
+    try:
+        os.kill(pid, signum)
+    except ProcessLookupError:
+        pass
+
+
+if __name__ == '__main__':
+    main()
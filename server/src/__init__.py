@@ -9,4 +9,5 @@ app.config['TEMPLATES_AUTO_RELOAD'] = True
 # flask_cors: Cross Origin Resource Sharing (CORS), making cross-origin AJAX possible.
 CORS(app)
 
-from src import views
\ No newline at end of file
+# the routes are registered by importing src.views (see run.py), which also loads the model;
+# tools that only need src.models do not pay for it
@@ -0,0 +1,142 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+
+FILE_CUBE_DATA = 'cube.npy'
+FILE_CUBE_META = 'cube.json'
+# bump whenever the saved layout changes, older cubes are rebuilt
+CUBE_FORMAT = 2
+
+COUNT = 0
+DWELL = 1
+
+
+class ActivityCube:
+    """
+    Dense vessel x day x location x {count, dwell} array built once from the
+    day-split transport movements, together with the id -> index maps needed
+    to answer any (date range, vessels, locations) selection by slicing.
+    """
+
+    def __init__(self, vessel_ids, location_ids, first_day, data, version=None):
+        # plain Python values, ids or interned codes, so that the meta file stays JSON
+        self.vessel_ids = np.asarray(vessel_ids).tolist()
+        self.location_ids = np.asarray(location_ids).tolist()
+        self.vessel_index = {vessel: i for i, vessel in enumerate(self.vessel_ids)}
+        self.location_index = {location: i for i, location in enumerate(self.location_ids)}
+        self.first_day = np.datetime64(first_day, 'D')
+        self.data = data
+        self.version = version
+        # writable array with room for more days, data is a view of it once add() has run
+        self._buffer = None
+
+    @property
+    def n_days(self):
+        return self.data.shape[1]
+
+    @classmethod
+    def from_movements(cls, movements, version=None):
+        vessel_codes, vessel_ids = pd.factorize(movements['vessel_id'])
+        location_codes, location_ids = pd.factorize(movements['location_id'])
+        days = pd.to_datetime(movements['date'], format='%Y-%m-%d').to_numpy().astype('datetime64[D]')
+        first_day = days.min() if len(days) else np.datetime64('1970-01-01', 'D')
+        day_codes = (days - first_day).astype(np.int64)
+        n_days = int(day_codes.max()) + 1 if len(days) else 0
+
+        shape = (len(vessel_ids), n_days, len(location_ids))
+        flat = np.ravel_multi_index((vessel_codes, day_codes, location_codes), shape) if len(days) else day_codes
+        size = int(np.prod(shape))
+        data = np.empty(shape + (2,), dtype=np.float64)
+        data[..., COUNT] = np.bincount(flat, minlength=size).reshape(shape)
+        data[..., DWELL] = np.bincount(flat, weights=movements['dwell'].to_numpy(dtype=np.float64),
+                                       minlength=size).reshape(shape)
+        return cls(vessel_ids, location_ids, first_day, data, version)
+
+    def add(self, movements):
+        """
+        Add day-split movements to the cube in place.  Unseen vessels and
+        locations and days outside the cube grow it; days grow into spare
+        capacity that doubles when it runs out, so appending day after day
+        copies the array O(log days) times.  A memory mapped cube is copied
+        into memory on the first add.
+        """
+        if not len(movements):
+            return self
+        for ids, index, column in ((self.vessel_ids, self.vessel_index, 'vessel_id'),
+                                   (self.location_ids, self.location_index, 'location_id')):
+            for value in pd.unique(movements[column]).tolist():
+                if value not in index:
+                    index[value] = len(ids)
+                    ids.append(value)
+        days = pd.to_datetime(movements['date'], format='%Y-%m-%d').to_numpy().astype('datetime64[D]')
+        first_day = min(self.first_day, days.min()) if self.n_days else days.min()
+        shift = int((self.first_day - first_day).astype(np.int64)) if self.n_days else 0
+        day_codes = (days - first_day).astype(np.int64)
+        n_days = max(shift + self.n_days, int(day_codes.max()) + 1)
+
+        buffer = self._buffer
+        if buffer is None or shift or n_days > buffer.shape[1] \
+                or (len(self.vessel_ids), len(self.location_ids)) != (buffer.shape[0], buffer.shape[2]):
+            capacity = self.n_days if buffer is None else buffer.shape[1]
+            capacity = capacity if n_days <= capacity else max(n_days, 2 * capacity)
+            buffer = np.zeros((len(self.vessel_ids), capacity, len(self.location_ids), 2), dtype=np.float64)
+            n_vessels, _, n_locations, _ = self.data.shape
+            buffer[:n_vessels, shift:shift + self.n_days, :n_locations] = self.data
+            self._buffer = buffer
+        self.data = buffer[:, :n_days]
+        self.first_day = first_day
+
+        cells = (np.array([self.vessel_index[vessel] for vessel in movements['vessel_id'].tolist()], dtype=np.intp),
+                 day_codes,
+                 np.array([self.location_index[location] for location in movements['location_id'].tolist()],
+                          dtype=np.intp))
+        np.add.at(self.data[..., COUNT], cells, 1)
+        np.add.at(self.data[..., DWELL], cells, movements['dwell'].to_numpy(dtype=np.float64))
+        return self
+
+    def save(self, folder):
+        os.makedirs(folder, exist_ok=True)
+        np.save(os.path.join(folder, FILE_CUBE_DATA), self.data)
+        with open(os.path.join(folder, FILE_CUBE_META), 'w') as file:
+            json.dump({'format': CUBE_FORMAT, 'vessel_ids': self.vessel_ids, 'location_ids': self.location_ids,
+                       'first_day': str(self.first_day), 'version': self.version}, file)
+
+    @classmethod
+    def load(cls, folder, version=None, mmap_mode='r'):
+        """Open a saved cube read-only and memory mapped, so that every worker shares the same pages."""
+        with open(os.path.join(folder, FILE_CUBE_META), 'r') as file:
+            meta = json.load(file)
+        if meta.get('format') != CUBE_FORMAT or (version is not None and meta['version'] != version):
+            return None
+        data = np.load(os.path.join(folder, FILE_CUBE_DATA), mmap_mode=mmap_mode)
+        return cls(meta['vessel_ids'], meta['location_ids'], meta['first_day'], data, meta['version'])
+
+    def slice(self, start_date, end_date, vessel_ids, location_ids):
+        """
+        Return (vessels, dates, array) for the selection, the array being shaped
+        (vessels, days, locations, 2).  Vessels without any movement in the
+        selection are dropped, unknown locations and days outside the cube are zeros.
+        """
+        start = np.datetime64(start_date, 'D')
+        end = np.datetime64(end_date, 'D')
+        n_days = max(int((end - start).astype(np.int64)) + 1, 0)
+        dates = np.datetime_as_string(start + np.arange(n_days).astype('timedelta64[D]'), unit='D').tolist()
+
+        vessel_rows = np.array(sorted({self.vessel_index[vessel] for vessel in vessel_ids if vessel in self.vessel_index}),
+                               dtype=np.intp)
+        known = [(column, self.location_index[location]) for column, location in enumerate(location_ids)
+                 if location in self.location_index]
+        columns = np.array([column for column, _ in known], dtype=np.intp)
+        location_columns = np.array([index for _, index in known], dtype=np.intp)
+
+        result = np.zeros((len(vessel_rows), n_days, len(location_ids), 2), dtype=np.float64)
+        first = int((start - self.first_day).astype(np.int64))
+        lo, hi = max(first, 0), min(first + n_days, self.n_days)
+        if hi > lo and len(columns):
+            block = self.data[np.ix_(vessel_rows, np.arange(lo, hi), location_columns)]
+            result[:, lo - first:hi - first][:, :, columns] = block
+
+        active = result[..., COUNT].reshape(len(vessel_rows), -1).sum(axis=1) > 0
+        vessels = [self.vessel_ids[row] for row in vessel_rows[active]]
+        return vessels, dates, result[active]
@@ -0,0 +1,237 @@
+import numpy as np
+import numba
+from scipy.spatial.distance import cdist as cdist_euclidean
+from tslearn.metrics import sakoe_chiba_mask, itakura_mask
+
+METRICS = ('dtw', 'euclidean')
+WINDOWS = ('sakoe_chiba', 'itakura')
+DEFAULT_BLOCK_SIZE = 32
+
+
+def band(n_timesteps, window=None, window_size=None):
+    """
+    First and last admissible j for every i of the warping path, following the
+    tslearn masks: window_size is the radius for 'sakoe_chiba' and the maximum
+    slope for 'itakura'.
+    """
+    if window is None:
+        return np.zeros(n_timesteps, dtype=np.int64), np.full(n_timesteps, n_timesteps - 1, dtype=np.int64)
+    if window == 'sakoe_chiba':
+        mask = sakoe_chiba_mask(n_timesteps, n_timesteps, radius=int(window_size if window_size is not None else 1))
+    elif window == 'itakura':
+        mask = itakura_mask(n_timesteps, n_timesteps, max_slope=float(window_size if window_size is not None else 2.))
+    else:
+        raise ValueError(f'unknown window: {window}, expected one of {WINDOWS}')
+    allowed = np.isfinite(mask)
+    lo = np.argmax(allowed, axis=1)
+    hi = n_timesteps - 1 - np.argmax(allowed[:, ::-1], axis=1)
+    return lo.astype(np.int64), hi.astype(np.int64)
+
+
+@numba.njit(cache=True, nogil=True)
+def _envelope(series, lo, hi):
+    n_timesteps, n_features = series.shape
+    upper = np.empty((n_timesteps, n_features))
+    lower = np.empty((n_timesteps, n_features))
+    for i in range(n_timesteps):
+        for f in range(n_features):
+            upper[i, f] = series[lo[i], f]
+            lower[i, f] = series[lo[i], f]
+            for j in range(lo[i] + 1, hi[i] + 1):
+                upper[i, f] = max(upper[i, f], series[j, f])
+                lower[i, f] = min(lower[i, f], series[j, f])
+    return upper, lower
+
+
+@numba.njit(cache=True, nogil=True)
+def _lb_keogh(x, upper, lower):
+    # every i is matched at least once inside its band, so the distance of
+    # x[i] to the envelope of the band never exceeds its share of the DTW cost
+    total = 0.
+    for i in range(x.shape[0]):
+        for f in range(x.shape[1]):
+            if x[i, f] > upper[i, f]:
+                diff = x[i, f] - upper[i, f]
+                total += diff * diff
+            elif x[i, f] < lower[i, f]:
+                diff = lower[i, f] - x[i, f]
+                total += diff * diff
+    return np.sqrt(total)
+
+
+@numba.njit(cache=True, nogil=True)
+def _dtw(x, y, lo, hi, cutoff):
+    n, m = x.shape[0], y.shape[0]
+    previous = np.full(m + 1, np.inf)
+    current = np.full(m + 1, np.inf)
+    previous[0] = 0.
+    cutoff_squared = cutoff * cutoff
+    for i in range(n):
+        current[:] = np.inf
+        row_min = np.inf
+        for j in range(lo[i], hi[i] + 1):
+            dist = 0.
+            for f in range(x.shape[1]):
+                diff = x[i, f] - y[j, f]
+                dist += diff * diff
+            current[j + 1] = dist + min(previous[j + 1], current[j], previous[j])
+            row_min = min(row_min, current[j + 1])
+        # every path crosses row i, so the row minimum already bounds the result
+        if row_min > cutoff_squared:
+            return np.sqrt(row_min)
+        previous, current = current, previous
+    return np.sqrt(previous[m])
+
+
+@numba.njit(parallel=True, nogil=True, cache=True)
+def _dtw_block(X, Y, rows, symmetric, lo, hi, upper, lower, cutoff, out):
+    for r in numba.prange(rows.shape[0]):
+        i = rows[r]
+        first = i + 1 if symmetric else 0
+        for j in range(first, Y.shape[0]):
+            if cutoff < np.inf:
+                bound = _lb_keogh(X[i], upper[j], lower[j])
+                if bound >= cutoff:
+                    out[r, j] = bound
+                    continue
+            out[r, j] = _dtw(X[i], Y[j], lo, hi, cutoff)
+
+
+def envelopes(X, lo, hi, block_size=DEFAULT_BLOCK_SIZE, progress=None):
+    """
+    Upper and lower LB_Keogh envelopes of every series of the (n, timesteps,
+    features) dataset X, progress(series_done, n) is called after every block.
+    """
+    X = np.ascontiguousarray(X, dtype=np.float64)
+    upper = np.empty(X.shape)
+    lower = np.empty(X.shape)
+    for j in range(X.shape[0]):
+        upper[j], lower[j] = _envelope(X[j], lo, hi)
+        if progress is not None and ((j + 1) % block_size == 0 or j + 1 == X.shape[0]):
+            progress(j + 1, X.shape[0])
+    return upper, lower
+
+
+@numba.njit(parallel=True, nogil=True, cache=True)
+def _lb_keogh_many(x, x_upper, x_lower, X, upper, lower, out):
+    # the larger of the two one-sided bounds, both are valid
+    for j in numba.prange(X.shape[0]):
+        out[j] = max(_lb_keogh(x, upper[j], lower[j]), _lb_keogh(X[j], x_upper, x_lower))
+
+
+@numba.njit(parallel=True, nogil=True, cache=True)
+def _dtw_many(x, X, candidates, lo, hi, cutoff, out):
+    for r in numba.prange(candidates.shape[0]):
+        out[r] = _dtw(x, X[candidates[r]], lo, hi, cutoff)
+
+
+def nearest(x, X, k, lo, hi, upper, lower, exclude=None, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    Exact k nearest neighbours of the series x among the rows of X by DTW
+    within the band (lo, hi), given the envelopes of X.  Candidates are
+    visited in LB_Keogh order and refined in parallel blocks with the
+    current k-th distance as the early-abandon cutoff; the search stops as
+    soon as the next lower bound cannot beat it, so most rows never get a
+    DTW.  Returns (rows, distances, number of DTWs computed).
+    """
+    x = np.ascontiguousarray(x, dtype=np.float64)
+    x_upper, x_lower = _envelope(x, lo, hi)
+    bounds = np.empty(X.shape[0])
+    _lb_keogh_many(x, x_upper, x_lower, X, upper, lower, bounds)
+    if exclude is not None:
+        bounds[exclude] = np.inf
+    order = np.argsort(bounds, kind='stable')
+    order = order[np.isfinite(bounds[order])]
+
+    rows = np.empty(0, dtype=np.int64)
+    distances = np.empty(0)
+    computed = 0
+    # the k best bounds go first on their own, so that every later block already has a cutoff
+    starts = [0] + list(range(k, len(order), block_size))
+    for start, stop in zip(starts, starts[1:] + [len(order)]):
+        cutoff = distances[k - 1] if len(distances) >= k else np.inf
+        candidates = order[start:stop]
+        candidates = candidates[bounds[candidates] < cutoff]
+        if not len(candidates):
+            break
+        block = np.empty(len(candidates))
+        _dtw_many(x, X, candidates.astype(np.int64), lo, hi, cutoff, block)
+        computed += len(candidates)
+        rows = np.concatenate([rows, candidates])
+        distances = np.concatenate([distances, block])
+        best = np.argsort(distances, kind='stable')[:k]
+        rows, distances = rows[best], distances[best]
+    return rows, distances, computed
+
+
+def _is_number(value):
+    return isinstance(value, (int, float, np.integer, np.floating)) and not isinstance(value, bool)
+
+
+def check_engine(metric='dtw', window=None, window_size=None, max_distance=None, n_jobs=None):
+    # raise ValueError for engine parameters cdist cannot use, before any work is done
+    if metric not in METRICS:
+        raise ValueError(f'unknown metric: {metric!r}, expected one of {METRICS}')
+    if window is not None and window not in WINDOWS:
+        raise ValueError(f'unknown window: {window!r}, expected one of {WINDOWS}')
+    if window_size is not None:
+        if not _is_number(window_size) or not window_size >= 0:
+            raise ValueError(f'invalid window_size: {window_size!r}, expected a number >= 0')
+        if window == 'itakura' and window_size == 0:
+            raise ValueError('invalid window_size: 0, the itakura slope must be > 0')
+    if max_distance is not None and (not _is_number(max_distance) or not max_distance >= 0):
+        raise ValueError(f'invalid max_distance: {max_distance!r}, expected a number >= 0')
+    if n_jobs is not None and (not isinstance(n_jobs, (int, np.integer)) or isinstance(n_jobs, bool) or n_jobs == 0):
+        raise ValueError(f'invalid n_jobs: {n_jobs!r}, expected a non-zero integer, negative for every core')
+
+
+def cdist(X, Y=None, metric='dtw', window=None, window_size=None, max_distance=None,
+          n_jobs=None, block_size=DEFAULT_BLOCK_SIZE, progress=None):
+    """
+    Pairwise distances between the (n, timesteps, features) datasets X and Y
+    (X against itself when Y is None), matching tslearn's cdist_dtw.
+
+    window restricts warping to a Sakoe-Chiba band or an Itakura parallelogram.
+    With max_distance, pairs whose LB_Keogh bound already exceeds it skip the
+    DTW and every pair is abandoned once it is known to exceed it; those pairs
+    are reported as a lower bound >= max_distance instead of the exact value.
+    Rows are computed in blocks on all cores (or n_jobs threads), and
+    progress(rows_done, n_rows) is called after every block.
+    """
+    check_engine(metric, window, window_size, max_distance, n_jobs)
+    symmetric = Y is None
+    X = np.ascontiguousarray(X, dtype=np.float64)
+    Y = X if symmetric else np.ascontiguousarray(Y, dtype=np.float64)
+    n_x, n_y = X.shape[0], Y.shape[0]
+
+    if metric == 'euclidean':
+        distances = cdist_euclidean(X.reshape(n_x, -1), Y.reshape(n_y, -1))
+        if progress is not None:
+            progress(n_x, n_x)
+        return distances
+
+    if n_jobs is not None:
+        numba.set_num_threads(numba.config.NUMBA_NUM_THREADS if n_jobs < 0
+                              else min(n_jobs, numba.config.NUMBA_NUM_THREADS))
+    lo, hi = band(X.shape[1], window, window_size)
+    cutoff = np.inf if max_distance is None else float(max_distance)
+    n_features = Y.shape[2]
+    upper = np.empty((n_y, X.shape[1], n_features))
+    lower = np.empty((n_y, X.shape[1], n_features))
+    if cutoff < np.inf:
+        for j in range(n_y):
+            upper[j], lower[j] = _envelope(Y[j], lo, hi)
+
+    distances = np.zeros((n_x, n_y))
+    for start in range(0, n_x, block_size):
+        rows = np.arange(start, min(start + block_size, n_x), dtype=np.int64)
+        block = np.zeros((len(rows), n_y))
+        _dtw_block(X, Y, rows, symmetric, lo, hi, upper, lower, cutoff, block)
+        distances[rows] = block
+        if progress is not None:
+            progress(int(rows[-1]) + 1, n_x)
+
+    if symmetric:
+        distances = np.triu(distances, 1)
+        distances += distances.T
+    return distances
@@ -0,0 +1,180 @@
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+
+DEFAULT_MEMORY_BUDGET = 256 * 2 ** 20
+DEFAULT_DISK_BUDGET = 2 ** 30
+
+
+def cache_key(*parts):
+    return hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class _DistanceMatrix:
+    """Square float32 matrix over a growing list of vessels, NaN marks pairs not computed yet."""
+
+    def __init__(self, vessels, values):
+        self.vessels = list(vessels)
+        self.index = {vessel: i for i, vessel in enumerate(self.vessels)}
+        self.values = values
+        self.mtime = None
+
+    @property
+    def nbytes(self):
+        return self.values.nbytes
+
+    def lookup(self, vessels):
+        positions = np.array([self.index.get(vessel, -1) for vessel in vessels], dtype=np.intp)
+        result = np.full((len(vessels), len(vessels)), np.nan, dtype=np.float32)
+        known = np.flatnonzero(positions >= 0)
+        result[np.ix_(known, known)] = self.values[np.ix_(positions[known], positions[known])]
+        return result
+
+    def merge(self, vessels, values):
+        added = [vessel for vessel in dict.fromkeys(vessels) if vessel not in self.index]
+        if added:
+            size = len(self.vessels) + len(added)
+            grown = np.full((size, size), np.nan, dtype=np.float32)
+            grown[:len(self.vessels), :len(self.vessels)] = self.values
+            self.values = grown
+            for vessel in added:
+                self.index[vessel] = len(self.vessels)
+                self.vessels.append(vessel)
+        positions = np.array([self.index[vessel] for vessel in vessels], dtype=np.intp)
+        block = self.values[np.ix_(positions, positions)]
+        known = ~np.isnan(values)
+        block[known] = values[known]
+        self.values[np.ix_(positions, positions)] = block
+
+
+class DistanceCache:
+    """
+    Pairwise vessel distances memoized per selection context (date range,
+    location set, normalization and distance parameters), so a request only
+    computes the pairs it has not seen before.  Matrices live in an LRU map
+    bounded by memory_budget and are written through to folder as .npy files,
+    which other workers and later runs read back on a miss; the on-disk store
+    is pruned least-recently-used first once it exceeds disk_budget.
+    """
+
+    def __init__(self, folder, memory_budget=DEFAULT_MEMORY_BUDGET, disk_budget=DEFAULT_DISK_BUDGET):
+        self.folder = folder
+        self.memory_budget = memory_budget
+        self.disk_budget = disk_budget
+        self._matrices = OrderedDict()
+        self._lock = threading.Lock()
+        # a job forked while another thread holds the lock would otherwise wait forever
+        os.register_at_fork(after_in_child=self._reset_lock)
+
+    def _reset_lock(self):
+        self._lock = threading.Lock()
+
+    def get(self, key, vessels):
+        """(n, n) distances between vessels, NaN where the pair is not cached."""
+        with self._lock:
+            matrix = self._open(key)
+            if matrix is None:
+                result = np.full((len(vessels), len(vessels)), np.nan, dtype=np.float32)
+            else:
+                result = matrix.lookup(vessels)
+            np.fill_diagonal(result, 0.)
+            return result
+
+    def put(self, key, vessels, values):
+        with self._lock:
+            matrix = self._open(key)
+            if matrix is None:
+                matrix = _DistanceMatrix([], np.empty((0, 0), dtype=np.float32))
+            matrix.merge(vessels, np.asarray(values, dtype=np.float32))
+            self._matrices[key] = matrix
+            self._matrices.move_to_end(key)
+            self._write(key, matrix)
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._matrices.clear()
+            for file_name in self._files():
+                os.remove(os.path.join(self.folder, file_name))
+
+    def _open(self, key):
+        if key in self._matrices and self._matrices[key].mtime == self._mtime(key):
+            self._matrices.move_to_end(key)
+            return self._matrices[key]
+        # not loaded yet, or rewritten by another worker or job since
+        matrix = self._read(key) or self._matrices.pop(key, None)
+        if matrix is not None:
+            self._matrices[key] = matrix
+            self._evict()
+        return matrix
+
+    def _evict(self):
+        total = sum(matrix.nbytes for matrix in self._matrices.values())
+        while len(self._matrices) > 1 and total > self.memory_budget:
+            _, matrix = self._matrices.popitem(last=False)
+            total -= matrix.nbytes
+
+    def _mtime(self, key):
+        try:
+            return os.stat(self._paths(key)[0]).st_mtime_ns
+        except OSError:
+            return None
+
+    def _paths(self, key):
+        return os.path.join(self.folder, f'{key}.npy'), os.path.join(self.folder, f'{key}.json')
+
+    def _files(self):
+        if not os.path.isdir(self.folder):
+            return []
+        return [file_name for file_name in os.listdir(self.folder)
+                if file_name.endswith(('.npy', '.json')) and '.tmp' not in file_name]
+
+    def _read(self, key):
+        values_path, vessels_path = self._paths(key)
+        try:
+            with open(vessels_path, 'r') as file:
+                vessels = json.load(file)
+            values = np.load(values_path)
+            if values.shape != (len(vessels), len(vessels)):
+                # caught between the two renames of a concurrent writer
+                return None
+            # touch the files so that pruning sees them as recently used
+            os.utime(values_path)
+            matrix = _DistanceMatrix(vessels, values)
+            matrix.mtime = self._mtime(key)
+            return matrix
+        except (OSError, ValueError):
+            return None
+
+    def _write(self, key, matrix):
+        values_path, vessels_path = self._paths(key)
+        try:
+            os.makedirs(self.folder, exist_ok=True)
+            # write aside and rename, readers in other processes never see half a file
+            np.save(values_path + '.tmp.npy', matrix.values)
+            os.replace(values_path + '.tmp.npy', values_path)
+            with open(vessels_path + '.tmp', 'w') as file:
+                json.dump(matrix.vessels, file)
+            os.replace(vessels_path + '.tmp', vessels_path)
+            matrix.mtime = self._mtime(key)
+            self._prune()
+        except OSError as e:
+            print(f'could not cache distances because {e}')
+
+    def _prune(self):
+        entries = []
+        for file_name in self._files():
+            if file_name.endswith('.npy'):
+                stat = os.stat(os.path.join(self.folder, file_name))
+                entries.append((stat.st_mtime, stat.st_size, file_name[:-len('.npy')]))
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in sorted(entries)[:-1]:
+            if total <= self.disk_budget:
+                break
+            for path in self._paths(key):
+                if os.path.exists(path):
+                    os.remove(path)
+            total -= size
@@ -0,0 +1,91 @@
+from collections import defaultdict
+import pandas as pd
+
+
+class GraphStore:
+    """
+    In-memory index over the mc2 knowledge graph, built once at startup.
+    Nodes and links are partitioned by their 'type' into one DataFrame each,
+    and nodes are hashed by 'id' to their partition and row, so that a lookup
+    costs O(1) / O(k) instead of a scan over the whole graph.
+    """
+
+    def __init__(self, node_frames, link_frames):
+        self.node_frames = node_frames
+        self.link_frames = link_frames
+        self.node_index = {}
+        for node_type, frame in node_frames.items():
+            if 'id' in frame:
+                for position, node_id in enumerate(frame['id']):
+                    self.node_index[node_id] = (node_type, position)
+        self.node_prefixes = self._prefix_index(node_frames)
+        self._frames = {}
+
+    @staticmethod
+    def _prefix_index(partitions):
+        # 'Entity.Vessel.Ferry.Cargo' is reachable from 'Entity', 'Entity.Vessel',
+        # 'Entity.Vessel.Ferry' and itself, mirroring the ENTITY_TYPES tree
+        prefixes = defaultdict(list)
+        for record_type in partitions:
+            parts = record_type.split('.')
+            for i in range(1, len(parts) + 1):
+                prefixes['.'.join(parts[:i])].append(record_type)
+        return dict(prefixes)
+
+    def add(self, nodes=(), links=()):
+        """
+        Append node and link records to their partitions.  Nodes whose id is
+        already known are skipped, the added ones are returned.
+        """
+        added = []
+        for node in nodes:
+            if node['id'] not in self.node_index:
+                # reserve the id, a repeated node within the batch is skipped too
+                self.node_index[node['id']] = None
+                added.append(node)
+        for frames, records in ((self.node_frames, added), (self.link_frames, links)):
+            by_type = defaultdict(list)
+            for record in records:
+                by_type[record['type']].append(record)
+            for record_type, group in by_type.items():
+                frame = frames.get(record_type)
+                offset = 0 if frame is None else len(frame)
+                new = pd.DataFrame.from_records(group)
+                frames[record_type] = new if frame is None else pd.concat([frame, new], ignore_index=True)
+                if frames is self.node_frames:
+                    for position, node_id in enumerate(new['id'], offset):
+                        self.node_index[node_id] = (record_type, position)
+        self.node_prefixes = self._prefix_index(self.node_frames)
+        self._frames = {}
+        return added
+
+    def node_types(self, prefix):
+        if prefix in self.node_prefixes:
+            return self.node_prefixes[prefix]
+        # prefixes that stop in the middle of a segment, e.g. 'Entity.Vessel.F'
+        return [record_type for record_type in self.node_frames if record_type.startswith(prefix)]
+
+    def get_node(self, node_id):
+        if node_id not in self.node_index:
+            return None
+        node_type, position = self.node_index[node_id]
+        row = self.node_frames[node_type].iloc[position]
+        # attributes other nodes of the partition have but this one lacks come back as NaN
+        return {key: value for key, value in row.items() if not (isinstance(value, float) and value != value)}
+
+    def nodes_frame(self, node_type):
+        return self.node_frames.get(node_type, pd.DataFrame()).copy()
+
+    def links_frame(self, link_type):
+        return self.link_frames.get(link_type, pd.DataFrame()).copy()
+
+    def nodes_frame_vague(self, prefix):
+        if ('node_prefix', prefix) not in self._frames:
+            frames = [self.node_frames[node_type] for node_type in self.node_types(prefix)]
+            self._frames[('node_prefix', prefix)] = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+        # callers are free to add columns, the cached frame stays untouched
+        return self._frames[('node_prefix', prefix)].copy()
+
+    def node_frame(self, node_id):
+        node = self.get_node(node_id)
+        return pd.DataFrame([node] if node is not None else [])
@@ -0,0 +1,157 @@
+import os
+import glob
+import json
+import time
+import fcntl
+import threading
+
+FILE_INBOX_LOCK = '.lock'
+# key of the first line of the log, naming the source version its batches were ingested on top of
+HEADER_KEY = 'source_version'
+# seconds between two looks at the inbox
+WATCH_INTERVAL = 2.0
+
+
+class IngestLog:
+    """
+    Append-only JSON lines file of the batches ingested on top of the source
+    files, shared by every process serving the data folder.  A process
+    remembers the offset it has applied up to, so checking for new batches
+    is one stat() and catching up reads only what was appended since.
+    The first line records the version of the sources the batches apply
+    to, a log written on top of other sources is set aside by discard_stale().
+    """
+
+    def __init__(self, path, version=None):
+        self.path = path
+        self.version = version
+
+    def size(self):
+        try:
+            return os.stat(self.path).st_size
+        except FileNotFoundError:
+            return 0
+
+    def append(self, batch, apply=None):
+        """
+        Append batch and return the log offset after it.  apply(offset), when
+        given, is called first with that offset while the log is locked, so
+        no other batch goes in between; if it raises, nothing is written.
+        """
+        line = json.dumps(batch, separators=(',', ':')) + '\n'
+        with open(self.path, 'a') as file:
+            # one writer at a time, a reader never sees two batches interleaved
+            fcntl.flock(file, fcntl.LOCK_EX)
+            try:
+                size = os.fstat(file.fileno()).st_size
+                if self.version is not None and size == 0:
+                    line = json.dumps({HEADER_KEY: self.version}) + '\n' + line
+                if apply is not None:
+                    apply(size + len(line.encode()))
+                file.write(line)
+                file.flush()
+                os.fsync(file.fileno())
+                return file.tell()
+            finally:
+                fcntl.flock(file, fcntl.LOCK_UN)
+
+    def quarantine(self, offset, batch, error):
+        """Write a logged batch that could not be applied next to the log, with the error, for someone to look at."""
+        print(f'could not apply the batch ending at {offset} of {self.path} because {error!r}, skipped')
+        path = f'{self.path}.{offset}.quarantined'
+        try:
+            with open(f'{path}.{os.getpid()}.tmp', 'w') as file:
+                json.dump({'offset': offset, 'error': repr(error), 'batch': batch}, file)
+            os.replace(f'{path}.{os.getpid()}.tmp', path)
+        except OSError as e:
+            print(f'could not quarantine the batch because {e}')
+
+    def read(self, offset):
+        """[(end offset, batch)] appended after offset, complete lines only."""
+        if self.size() <= offset:
+            return []
+        with open(self.path, 'rb') as file:
+            file.seek(offset)
+            data = file.read()
+        batches = []
+        for line in data.splitlines(keepends=True):
+            if not line.endswith(b'\n'):
+                # still being written
+                break
+            offset += len(line)
+            batch = json.loads(line)
+            if HEADER_KEY not in batch:
+                batches.append((offset, batch))
+        return batches
+
+    def discard_stale(self):
+        """
+        Rename the log to *.stale when it was not written on top of this
+        version of the sources, its batches would be replayed onto data they
+        were never meant for.  True when it was set aside.
+        """
+        try:
+            with open(self.path, 'rb') as file:
+                first = file.readline()
+        except FileNotFoundError:
+            return False
+        try:
+            version = json.loads(first).get(HEADER_KEY) if first.endswith(b'\n') else None
+        except (ValueError, AttributeError):
+            version = None
+        if not first or version == self.version:
+            return False
+        os.replace(self.path, f'{self.path}.stale')
+        print(f'set {self.path} aside, it was ingested on top of other sources')
+        return True
+
+
+class Inbox:
+    """
+    A folder watched for batch files ({"nodes": [...], "links": [...]}, the
+    same shape as mc2.json).  Every *.json file is checked, appended to the
+    log and removed, in name order; a file that fails the check is renamed to
+    *.rejected.  Producers should write under another name and rename the
+    finished file to *.json, so that a half-written file is never picked up.
+    """
+
+    def __init__(self, folder, log, check, interval=WATCH_INTERVAL):
+        self.folder = folder
+        self.log = log
+        self.check = check
+        self.interval = interval
+        self._thread = None
+
+    def poll(self):
+        """Move the waiting files into the log, return how many batches were appended."""
+        os.makedirs(self.folder, exist_ok=True)
+        appended = 0
+        with open(os.path.join(self.folder, FILE_INBOX_LOCK), 'w') as lock:
+            # several processes may watch the same inbox, only one moves a given file
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            for path in sorted(glob.glob(os.path.join(self.folder, '*.json'))):
+                try:
+                    with open(path, 'r') as file:
+                        batch = json.load(file)
+                    self.check(batch)
+                except (OSError, ValueError) as e:
+                    print(f'could not ingest {path} because {e}')
+                    os.replace(path, f'{path}.rejected')
+                    continue
+                self.log.append(batch)
+                os.remove(path)
+                appended += 1
+        return appended
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._watch, daemon=True)
+            self._thread.start()
+
+    def _watch(self):
+        while True:
+            try:
+                self.poll()
+            except OSError as e:
+                print(f'could not watch {self.folder} because {e}')
+            time.sleep(self.interval)
@@ -0,0 +1,53 @@
+import numpy as np
+import pandas as pd
+
+MISSING = -1
+
+
+class IdTable:
+    """
+    Every entity id the model has seen, mapped to a dense int32 code.  The
+    derived tables store these codes instead of the id strings; ids coming
+    in with a request are encoded once and codes going out are decoded once.
+    None / NaN and ids that are not in the table encode to MISSING.
+    """
+
+    def __init__(self, ids=()):
+        self.ids = []
+        self._index = None
+        self._lookup = None
+        self.add(ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, values):
+        """Codes for values, interning the ones not seen before."""
+        values = np.asarray(values, dtype=object)
+        codes = self.encode(values)
+        new = (codes == MISSING) & pd.notna(values)
+        if new.any():
+            self.ids.extend(pd.unique(values[new]).tolist())
+            self._index = None
+            self._lookup = None
+            codes = self.encode(values)
+        return codes
+
+    def encode(self, values):
+        if self._index is None:
+            self._index = pd.Index(self.ids, dtype=object)
+        return self._index.get_indexer(np.asarray(values, dtype=object)).astype(np.int32)
+
+    def decode(self, codes):
+        """Object array of the ids, None for MISSING."""
+        if self._lookup is None:
+            # the trailing None is what code -1 picks
+            self._lookup = np.array(self.ids + [None], dtype=object)
+        return self._lookup[np.asarray(codes, dtype=np.intp)]
+
+    def decode_columns(self, frame, columns):
+        """Copy of frame with the given code columns turned back into ids."""
+        frame = frame.copy()
+        for column in columns:
+            frame[column] = self.decode(frame[column].to_numpy())
+        return frame
@@ -0,0 +1,391 @@
+import os
+import glob
+import json
+import time
+import uuid
+import fcntl
+import threading
+import traceback
+import multiprocessing
+from collections import deque
+from contextlib import contextmanager
+from src import metrics
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+FINISHED = (DONE, FAILED, CANCELLED)
+
+DEFAULT_MAX_WORKERS = max(1, (os.cpu_count() or 1) // 2)
+# seconds a cancelled job gets to notice before its process is terminated
+CANCEL_GRACE = 0.5
+POLL_INTERVAL = 0.05
+MAX_FINISHED_JOBS = 256
+
+FILE_JOB = '{job_id}.json'
+FILE_RESULT = '{job_id}.result'
+FILE_INDEX = 'index.json'
+FILE_LOCK = '.lock'
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class JobStore:
+    """
+    Job records shared by every server worker and job process through one
+    folder: <job_id>.json holds the state and progress, <job_id>.result the
+    result text and index.json the latest job of every key and channel.
+    Readers take the files as they are, every change is a read-modify-write
+    under the lock file, and files are replaced whole so a reader never sees
+    half of one.
+    """
+
+    def __init__(self, folder, clear=False):
+        self.folder = folder
+        self._lock = threading.Lock()
+        os.register_at_fork(after_in_child=self._reset_lock)
+        os.makedirs(folder, exist_ok=True)
+        if clear:
+            # a new server run starts without jobs, the pids of the old ones mean nothing now
+            for path in glob.glob(os.path.join(folder, '*.json')) + glob.glob(os.path.join(folder, '*.result')):
+                os.remove(path)
+
+    def _reset_lock(self):
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def locked(self):
+        # a POSIX lock, unlike flock, is not inherited by a job forked while another thread holds it;
+        # it does not exclude the threads of one process, the thread lock does.  Not reentrant.
+        with self._lock, open(os.path.join(self.folder, FILE_LOCK), 'w') as lock:
+            fcntl.lockf(lock, fcntl.LOCK_EX)
+            yield
+
+    def _write(self, file_name, data):
+        path = os.path.join(self.folder, file_name)
+        with open(f'{path}.{os.getpid()}.tmp', 'w') as file:
+            file.write(data)
+        os.replace(f'{path}.{os.getpid()}.tmp', path)
+
+    def read(self, job_id):
+        try:
+            with open(os.path.join(self.folder, FILE_JOB.format(job_id=job_id)), 'r') as file:
+                return json.load(file)
+        except (OSError, ValueError, TypeError):
+            return None
+
+    def write(self, record):
+        self._write(FILE_JOB.format(job_id=record['job_id']), json.dumps(record))
+
+    def update(self, job_id, **changes):
+        """Change some fields of a record, hold the lock around it; the new record, None when it is gone."""
+        record = self.read(job_id)
+        if record is not None:
+            record.update(changes)
+            self.write(record)
+        return record
+
+    def read_index(self):
+        try:
+            with open(os.path.join(self.folder, FILE_INDEX), 'r') as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {'keys': {}, 'channels': {}}
+
+    def write_index(self, index):
+        self._write(FILE_INDEX, json.dumps(index))
+
+    def save_result(self, job_id, result):
+        self._write(FILE_RESULT.format(job_id=job_id), result)
+
+    def load_result(self, job_id):
+        try:
+            with open(os.path.join(self.folder, FILE_RESULT.format(job_id=job_id)), 'r') as file:
+                return file.read()
+        except OSError:
+            return None
+
+    def records(self):
+        return [record for record in map(self.read, (os.path.basename(path)[:-len('.json')] for path in
+                                                     glob.glob(os.path.join(self.folder, FILE_JOB.format(job_id='*')))
+                                                     if os.path.basename(path) != FILE_INDEX))
+                if record is not None]
+
+    def remove(self, job_id):
+        for file_name in (FILE_JOB.format(job_id=job_id), FILE_RESULT.format(job_id=job_id)):
+            try:
+                os.remove(os.path.join(self.folder, file_name))
+            except FileNotFoundError:
+                pass
+
+
+def _finish(store, job_id, state, error=None):
+    # with the store locked; a job that already finished keeps its outcome
+    record = store.read(job_id)
+    if record is None or record['state'] in FINISHED:
+        return record
+    return store.update(job_id, state=state, error=error, finished=time.time())
+
+
+class Progress:
+    """
+    Passed to the job function as progress(stage, done, total).  Every report
+    is written to the job's record, and raises JobCancelled once the job has
+    been cancelled so the computation unwinds at its next checkpoint.
+    """
+
+    def __init__(self, store, job_id):
+        self._store = store
+        self._job_id = job_id
+
+    def __call__(self, stage, done, total):
+        with self._store.locked():
+            record = self._store.read(self._job_id)
+            if record is None or record['cancel_requested']:
+                raise JobCancelled()
+            record['progress'][stage] = {'done': done, 'total': total}
+            self._store.write(record)
+
+
+def _run(store, job_id, fn, args, kwargs):
+    state, result, error = FAILED, None, None
+    try:
+        result = fn(*args, progress=Progress(store, job_id), **kwargs)
+        state = DONE
+    except JobCancelled:
+        state = CANCELLED
+    except Exception:
+        error = traceback.format_exc()
+    try:
+        # the job writes its own outcome, so it survives the server worker that started it
+        if state == DONE:
+            store.save_result(job_id, result)
+        with store.locked():
+            _finish(store, job_id, state, error)
+    finally:
+        # the process exits right after, before the periodic flush would run
+        metrics.registry.flush()
+
+
+class Job:
+    """A job as its record says, the result is only read from its file when asked for."""
+
+    def __init__(self, store, record):
+        self._store = store
+        self.id = record['job_id']
+        self.key = record['key']
+        self.channel = record['channel']
+        self.state = record['state']
+        self.progress = record['progress']
+        self.error = record['error']
+        self.submitted = record['submitted']
+        self.started = record['started']
+        self.finished = record['finished']
+
+    @property
+    def result(self):
+        return self._store.load_result(self.id) if self.state == DONE else None
+
+    def to_dict(self):
+        return {'job_id': self.id, 'state': self.state, 'progress': self.progress, 'error': self.error,
+                'submitted': self.submitted, 'started': self.started, 'finished': self.finished}
+
+
+class JobScheduler:
+    """
+    Runs long computations in forked worker processes, which inherit the
+    loaded model copy-on-write, at most max_workers at a time per server
+    process.  Job records live in a JobStore folder, so any pre-forked worker
+    answers for, cancels or supersedes a job another one started.
+
+    Jobs with the same key share one run while it is in flight, a job
+    submitted on a channel supersedes (cancels) the previous job of that
+    channel, and cancelled jobs are stopped cooperatively through Progress or
+    terminated after CANCEL_GRACE seconds by the process that started them.
+    When given a ReadWriteLock, its read side is held while forking, so that
+    a job never starts from tables half way through a change.
+    """
+
+    def __init__(self, folder, max_workers=DEFAULT_MAX_WORKERS, lock=None, clear=False):
+        self.store = JobStore(folder, clear=clear)
+        self.max_workers = max_workers
+        self.lock = lock
+        self._context = multiprocessing.get_context('fork')
+        # the jobs of this process: queued (job id, fn, args, kwargs) and running job id -> process
+        self._queue = deque()
+        self._processes = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def submit(self, fn, args=(), kwargs=None, key=None, channel=None):
+        """Queue fn(*args, progress=..., **kwargs) and return its job."""
+        with self._lock, self.store.locked():
+            self._ensure_dispatcher()
+            index = self.store.read_index()
+            record = self.store.read(index['keys'].get(key)) if key is not None else None
+            if record is None or record['state'] in FINISHED or record['cancel_requested']:
+                record = {'job_id': uuid.uuid4().hex, 'key': key, 'channel': channel, 'state': QUEUED,
+                          'progress': {}, 'error': None, 'submitted': time.time(), 'started': None,
+                          'finished': None, 'cancel_requested': None, 'owner': os.getpid(), 'pid': None}
+                self.store.write(record)
+                self._queue.append((record['job_id'], fn, args, kwargs or {}))
+                if key is not None:
+                    index['keys'][key] = record['job_id']
+            if channel is not None:
+                previous = index['channels'].get(channel)
+                if previous is not None and previous != record['job_id']:
+                    self._cancel(previous)
+                index['channels'][channel] = record['job_id']
+            self._forget(index)
+            self.store.write_index(index)
+        return Job(self.store, record)
+
+    def get(self, job_id):
+        record = self.store.read(job_id)
+        if record is not None and self._orphaned(record):
+            with self.store.locked():
+                record = self.store.read(job_id)
+                if record is not None and self._orphaned(record):
+                    record = _finish(self.store, job_id, CANCELLED if record['cancel_requested'] else FAILED,
+                                     None if record['cancel_requested'] else 'worker exited unexpectedly')
+        return Job(self.store, record) if record is not None else None
+
+    def cancel(self, job_id):
+        with self._lock, self.store.locked():
+            self._cancel(job_id)
+        return self.get(job_id)
+
+    @staticmethod
+    def _orphaned(record):
+        # a job whose process, or whose server worker while it was still queued, is gone without a word
+        if record['state'] == RUNNING:
+            return record['pid'] is not None and not _alive(record['pid'])
+        return record['state'] == QUEUED and not _alive(record['owner'])
+
+    def _cancel(self, job_id):
+        # with self._lock and the store locked, always taken in that order
+        record = self.store.read(job_id)
+        if record is None or record['state'] in FINISHED or record['cancel_requested']:
+            return
+        if record['state'] == QUEUED and record['owner'] == os.getpid():
+            for queued in self._queue:
+                if queued[0] == job_id:
+                    self._queue.remove(queued)
+                    _finish(self.store, job_id, CANCELLED)
+                    return
+        # another worker drops it from its queue, a running job notices at its next progress report
+        self.store.update(job_id, cancel_requested=time.time())
+
+    def _forget(self, index):
+        # with the store locked
+        records = self.store.records()
+        finished = sorted((record for record in records if record['state'] in FINISHED),
+                          key=lambda record: record['finished'])
+        forgotten = {record['job_id'] for record in finished[:max(len(finished) - MAX_FINISHED_JOBS, 0)]}
+        for job_id in forgotten:
+            self.store.remove(job_id)
+        kept = {record['job_id'] for record in records} - forgotten
+        for mapping in index.values():
+            for name in [name for name, job_id in mapping.items() if job_id not in kept]:
+                del mapping[name]
+
+    def _ensure_dispatcher(self):
+        # threads do not survive a fork, so a forked server worker starts its own
+        if self._thread is None or self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._queue = deque()
+            self._processes = {}
+            self._thread = threading.Thread(target=self._dispatch, daemon=True)
+            self._thread.start()
+
+    def _dispatch(self):
+        while True:
+            with self._lock:
+                for job_id, process in list(self._processes.items()):
+                    self._poll(job_id, process)
+                while self._queue and len(self._processes) < self.max_workers:
+                    # never wait for the lock here, a request may be waiting for self._lock; try again next round
+                    if self.lock is not None and not self.lock.acquire_read(blocking=False):
+                        break
+                    try:
+                        self._start(*self._queue.popleft())
+                    finally:
+                        if self.lock is not None:
+                            self.lock.release_read()
+            # reap the worker processes that have exited
+            multiprocessing.active_children()
+            time.sleep(POLL_INTERVAL)
+
+    def _start(self, job_id, fn, args, kwargs):
+        with self.store.locked():
+            record = self.store.read(job_id)
+            if record is None or record['state'] != QUEUED:
+                return
+            if record['cancel_requested']:
+                _finish(self.store, job_id, CANCELLED)
+                return
+            self.store.update(job_id, state=RUNNING, started=time.time())
+        # never fork while holding the lock file, the child would keep it locked
+        process = self._context.Process(target=_run, args=(self.store, job_id, fn, args, kwargs), daemon=True)
+        process.start()
+        self._processes[job_id] = process
+        with self.store.locked():
+            self.store.update(job_id, pid=process.pid)
+
+    def _poll(self, job_id, process):
+        if not process.is_alive():
+            process.join()
+            del self._processes[job_id]
+            with self.store.locked():
+                record = self.store.read(job_id)
+                if record is not None and record['state'] == RUNNING:
+                    _finish(self.store, job_id, CANCELLED if record['cancel_requested'] else FAILED,
+                            None if record['cancel_requested'] else 'worker exited unexpectedly')
+            return
+
+        record = self.store.read(job_id)
+        if record is not None and record['cancel_requested'] and time.time() - record['cancel_requested'] > CANCEL_GRACE:
+            # stuck inside a compiled kernel or the optimizer, stop burning CPU
+            process.terminate()
+            process.join()
+            del self._processes[job_id]
+            with self.store.locked():
+                _finish(self.store, job_id, CANCELLED)
+
+
+class LogProgress:
+    """
+    File-like object that turns the iteration lines a library prints (e.g.
+    sklearn's verbose t-SNE) into progress(stage, iteration, total) reports.
+    Use it with contextlib.redirect_stdout inside a job.
+    """
+
+    def __init__(self, progress, stage, pattern, total):
+        self.progress = progress
+        self.stage = stage
+        self.pattern = pattern
+        self.total = total
+
+    def write(self, text):
+        match = self.pattern.search(text)
+        if match:
+            self.progress(self.stage, int(match.group(1)), self.total)
+        return len(text)
+
+    def flush(self):
+        pass
@@ -0,0 +1,165 @@
+import json
+import numpy as np
+import pandas as pd
+
+DEFAULT_CHUNK_SIZE = 2 ** 20
+DEFAULT_CHUNK_ROWS = 50000
+WHITESPACE = ' \t\n\r'
+NUMBER_CHARACTERS = '0123456789.eE+-'
+
+
+class _Reader:
+    """A text file read chunk_size characters at a time, decoded value by value with raw_decode."""
+
+    def __init__(self, file, chunk_size):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        chunk = self.file.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+
+    def peek(self):
+        """Next non-whitespace character, '' at the end of the file."""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer) or self.eof:
+                return self.buffer[self.pos:self.pos + 1]
+            self._fill()
+
+    def expect(self, characters):
+        character = self.peek()
+        if not character or character not in characters:
+            raise ValueError(f'expected one of {characters!r} at offset {self.pos}, found {character!r}')
+        self.pos += 1
+        return character
+
+    def decode(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # a number cut by the end of the buffer still decodes, e.g. '2.' of '2.5e3',
+                # so only trust a value once something that cannot continue it follows
+                if self.eof or (end < len(self.buffer) and self.buffer[end] not in NUMBER_CHARACTERS):
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._fill()
+
+    def items(self):
+        """Elements of the array starting here, one at a time."""
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.decode()
+            if self.expect(',]') == ']':
+                return
+
+
+def iter_array(file, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yield the elements of a top-level JSON array without loading the whole file."""
+    yield from _Reader(file, chunk_size).items()
+
+
+def iter_object_arrays(file, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Yield (key, element) for every element of the arrays held by a top-level
+    JSON object, e.g. ('nodes', {...}) and ('links', {...}) for a networkx
+    node-link graph.  Other members are skipped.
+    """
+    reader = _Reader(file, chunk_size)
+    reader.expect('{')
+    if reader.peek() == '}':
+        return
+    while True:
+        key = reader.decode()
+        reader.expect(':')
+        if reader.peek() == '[':
+            for element in reader.items():
+                yield key, element
+        else:
+            reader.decode()
+        if reader.expect(',}') == '}':
+            return
+
+
+class ChunkedTable:
+    """
+    Records appended one at a time into column lists that are turned into a
+    DataFrame every chunk_rows rows, so no more than one chunk of Python
+    objects is alive at once, and equal strings share one object.  Keys
+    missing from a record become NaN and explicit None values stay None,
+    with the same dtypes as pd.DataFrame(records).
+    """
+
+    def __init__(self, chunk_rows=DEFAULT_CHUNK_ROWS):
+        self.chunk_rows = chunk_rows
+        self.chunks = []
+        self.keys = {}
+        self.strings = {}
+        self.columns = {}
+        self.rows = 0
+
+    def append(self, record):
+        for key in record:
+            if key not in self.columns:
+                self.columns[key] = [np.nan] * self.rows
+                self.keys.setdefault(key)
+        for key, column in self.columns.items():
+            value = record.get(key, np.nan)
+            if isinstance(value, str):
+                # ids and types repeat on every record, keep one copy of each
+                value = self.strings.setdefault(value, value)
+            column.append(value)
+        self.rows += 1
+        if self.rows >= self.chunk_rows:
+            self._flush()
+
+    def _flush(self):
+        if self.rows:
+            # only keys seen in this chunk have a column, so an explicit None keeps its column
+            self.chunks.append(pd.DataFrame(self.columns))
+        self.columns = {}
+        self.rows = 0
+
+    def __len__(self):
+        return sum(len(chunk) for chunk in self.chunks) + self.rows
+
+    def to_frame(self):
+        self._flush()
+        self.strings = {}
+        if not self.chunks:
+            return pd.DataFrame()
+        if len(self.chunks) == 1:
+            frame = self.chunks[0]
+        else:
+            frame = pd.DataFrame({key: self._concat(key) for key in self.keys})
+        self.chunks = [frame]
+        return frame
+
+    def _concat(self, key):
+        parts = [chunk[key] if key in chunk else None for chunk in self.chunks]
+        dtypes = {part.dtype for part in parts if part is not None}
+        if len(dtypes) == 1 and (all(part is not None for part in parts) or dtypes == {np.dtype(np.float64)}):
+            # the common case, one dtype throughout and NaN for the chunks without the key
+            return pd.concat([part if part is not None else pd.Series(np.nan, index=range(len(chunk)))
+                              for part, chunk in zip(parts, self.chunks)], ignore_index=True)
+        # e.g. None in one chunk and numbers or nothing in another: infer from all values at once,
+        # the way pd.DataFrame(records) does
+        values = []
+        for part, chunk in zip(parts, self.chunks):
+            values.extend(part.tolist() if part is not None else [np.nan] * len(chunk))
+        return pd.Series(values)
@@ -0,0 +1,302 @@
+import os
+import glob
+import json
+import time
+import fcntl
+import random
+import cProfile
+import threading
+from contextlib import contextmanager
+from flask import request, g
+
+# upper bounds in seconds, from a cached lookup up to a full pairwise DTW
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# seconds between the writes of a process' metrics file
+FLUSH_INTERVAL = 1.0
+# request header asking for a cProfile of that request, its value is the sampling probability (default 1)
+PROFILE_HEADER = 'X-Profile'
+PROFILE_ENV = 'ENABLE_PROFILING'
+# the summed metrics of the processes that have exited, next to the <pid>.json of the live ones
+FILE_EXITED = 'exited.json'
+FILE_LOCK = '.lock'
+
+HELP = {
+    'http_requests_total': 'Requests served, by route, method and status.',
+    'http_request_duration_seconds': 'Time from the start of a request to its response, by route and method.',
+    'model_stage_duration_seconds': 'Time spent in named stages of the model.',
+    'profiles_total': 'Requests profiled with cProfile, by route.',
+}
+
+
+class Registry:
+    """
+    Counters and histograms of this process, written to <folder>/<pid>.json
+    at most every FLUSH_INTERVAL seconds.  collect() sums the files of every
+    process that shares the folder, so the pre-forked workers and the job
+    processes are scraped together.  The file of a process that exited is
+    folded into FILE_EXITED on the next scrape and removed, which keeps the
+    totals from going backwards when workers recycle without the folder
+    growing by one file per job.
+    """
+
+    def __init__(self):
+        self.folder = None
+        self._lock = threading.Lock()
+        self._collect_lock = threading.Lock()
+        self._pid = None
+        self._thread = None
+        self._dirty = False
+        self.counters = {}
+        self.histograms = {}
+        # the lock may be held by the flush thread at the moment of a fork, the child needs its own
+        os.register_at_fork(after_in_child=self._reset_lock)
+
+    def _reset_lock(self):
+        self._lock = threading.Lock()
+        self._collect_lock = threading.Lock()
+
+    def configure(self, folder, clear=False):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+        if clear:
+            # a new server run starts from zero
+            for path in glob.glob(os.path.join(folder, '*.json')):
+                os.remove(path)
+
+    def _ensure_process(self):
+        # a forked child inherits the parent's numbers and none of its threads, it starts over
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self.counters = {}
+            self.histograms = {}
+            self._thread = None
+        if self._thread is None and self.folder is not None:
+            self._thread = threading.Thread(target=self._flush_periodically, daemon=True)
+            self._thread.start()
+
+    def inc(self, name, labels, value=1):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._ensure_process()
+            self.counters[key] = self.counters.get(key, 0) + value
+            self._dirty = True
+
+    def observe(self, name, labels, value):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._ensure_process()
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {'buckets': [0] * len(BUCKETS), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    histogram['buckets'][i] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+            self._dirty = True
+
+    def _flush_periodically(self):
+        pid = os.getpid()
+        while self._pid == pid:
+            time.sleep(FLUSH_INTERVAL)
+            self.flush()
+
+    def flush(self):
+        if self.folder is None:
+            return
+        with self._lock:
+            if not self._dirty or self._pid != os.getpid():
+                return
+            state = {'counters': [[name, labels, value] for (name, labels), value in self.counters.items()],
+                     'histograms': [[name, labels, dict(histogram, buckets=list(histogram['buckets']))]
+                                    for (name, labels), histogram in self.histograms.items()]}
+            self._dirty = False
+        path = os.path.join(self.folder, f'{os.getpid()}.json')
+        try:
+            with open(f'{path}.tmp', 'w') as file:
+                json.dump(state, file)
+            os.replace(f'{path}.tmp', path)
+        except OSError:
+            self._dirty = True
+
+    def collect(self):
+        """Prometheus text exposition of the metrics of all processes."""
+        self.flush()
+        counters = {}
+        histograms = {}
+        if self.folder is not None:
+            # one scrape at a time, so that a file being folded is never counted twice; a POSIX lock is not
+            # inherited by a job forked meanwhile, the thread lock covers the other threads of this process
+            with self._collect_lock, open(os.path.join(self.folder, FILE_LOCK), 'w') as lock:
+                fcntl.lockf(lock, fcntl.LOCK_EX)
+                self._fold_exited()
+                for path in glob.glob(os.path.join(self.folder, '*.json')):
+                    _add(counters, histograms, _read(path))
+
+        lines = []
+        for metric_type, series in (('counter', counters), ('histogram', histograms)):
+            for name in sorted({name for name, _ in series}):
+                lines.append(f'# HELP {name} {HELP.get(name, name)}')
+                lines.append(f'# TYPE {name} {metric_type}')
+                for (series_name, labels), value in sorted(series.items()):
+                    if series_name != name:
+                        continue
+                    if metric_type == 'counter':
+                        lines.append(f'{name}{_labels(labels)} {value}')
+                        continue
+                    for bound, count in zip(BUCKETS, value['buckets']):
+                        lines.append(f'{name}_bucket{_labels(labels + (("le", f"{bound:g}"),))} {count}')
+                    lines.append(f'{name}_bucket{_labels(labels + (("le", "+Inf"),))} {value["count"]}')
+                    lines.append(f'{name}_sum{_labels(labels)} {value["sum"]:.6f}')
+                    lines.append(f'{name}_count{_labels(labels)} {value["count"]}')
+        return '\n'.join(lines) + '\n'
+
+    def _fold_exited(self):
+        exited = []
+        for path in glob.glob(os.path.join(self.folder, '*.json')):
+            pid = os.path.basename(path)[:-len('.json')]
+            if pid.isdigit() and not _alive(int(pid)):
+                exited.append(path)
+        if not exited:
+            return
+        counters = {}
+        histograms = {}
+        path = os.path.join(self.folder, FILE_EXITED)
+        for state in map(_read, [path] + exited):
+            _add(counters, histograms, state)
+        state = {'counters': [[name, labels, value] for (name, labels), value in counters.items()],
+                 'histograms': [[name, labels, histogram] for (name, labels), histogram in histograms.items()]}
+        try:
+            with open(f'{path}.tmp', 'w') as file:
+                json.dump(state, file)
+            os.replace(f'{path}.tmp', path)
+            for exited_path in exited:
+                os.remove(exited_path)
+        except OSError as e:
+            print(f'could not fold the metrics of exited processes because {e}')
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # someone else's process reusing the pid
+        return True
+    return True
+
+
+def _read(path):
+    try:
+        with open(path, 'r') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def _add(counters, histograms, state):
+    """Sum the counters and histograms of a saved state into the two dicts."""
+    if state is None:
+        return
+    for name, labels, value in state['counters']:
+        key = (name, tuple(map(tuple, labels)))
+        counters[key] = counters.get(key, 0) + value
+    for name, labels, histogram in state['histograms']:
+        key = (name, tuple(map(tuple, labels)))
+        total = histograms.setdefault(key, {'buckets': [0] * len(BUCKETS), 'sum': 0.0, 'count': 0})
+        total['buckets'] = [a + b for a, b in zip(total['buckets'], histogram['buckets'])]
+        total['sum'] += histogram['sum']
+        total['count'] += histogram['count']
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + '}'
+
+
+registry = Registry()
+# stages timed during the current request, reported back in its Server-Timing header
+_request = threading.local()
+
+
+@contextmanager
+def stage(name):
+    """Time the enclosed block as model_stage_duration_seconds{stage=name}."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        registry.observe('model_stage_duration_seconds', {'stage': name}, elapsed)
+        stages = getattr(_request, 'stages', None)
+        if stages is not None:
+            stages.append((name, elapsed))
+
+
+def _profile_requested():
+    value = request.headers.get(PROFILE_HEADER)
+    if value is None or os.environ.get(PROFILE_ENV) != '1':
+        return False
+    try:
+        probability = float(value)
+    except ValueError:
+        probability = 1.0
+    return random.random() < probability
+
+
+def instrument(app, folder, clear=False):
+    """
+    Time every request of app by route, and profile the ones that ask for it
+    with the PROFILE_HEADER header while ENABLE_PROFILING=1; their pstats
+    files are written to <folder>/profiles and named in the response header.
+    """
+    registry.configure(folder, clear=clear)
+    profiles = os.path.join(folder, 'profiles')
+
+    @app.before_request
+    def start_timer():
+        g.metrics_start = time.perf_counter()
+        _request.stages = []
+        g.profiler = None
+        if _profile_requested():
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+                g.profiler = profiler
+            except ValueError:
+                # another profiler is already running in this process
+                pass
+
+    @app.after_request
+    def record(response):
+        if 'metrics_start' not in g:
+            return response
+        elapsed = time.perf_counter() - g.metrics_start
+        # the rule, not the path: /jobs/<job_id> is one series, not one per job
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        registry.observe('http_request_duration_seconds', {'route': route, 'method': request.method}, elapsed)
+        registry.inc('http_requests_total', {'route': route, 'method': request.method,
+                                             'status': str(response.status_code)})
+
+        timings = [f'{name};dur={seconds * 1000:.1f}' for name, seconds in getattr(_request, 'stages', None) or []]
+        response.headers['Server-Timing'] = ', '.join(timings + [f'total;dur={elapsed * 1000:.1f}'])
+
+        if g.profiler is not None:
+            g.profiler.disable()
+            os.makedirs(profiles, exist_ok=True)
+            name = f'{time.strftime("%Y%m%dT%H%M%S")}-{os.getpid()}-{route.strip("/").replace("/", "_") or "root"}.prof'
+            g.profiler.dump_stats(os.path.join(profiles, name))
+            g.profiler = None
+            registry.inc('profiles_total', {'route': route})
+            response.headers[PROFILE_HEADER] = name
+        return response
+
+    @app.teardown_request
+    def reset(_):
+        _request.stages = None
+        profiler = g.pop('profiler', None)
+        if profiler is not None:
+            profiler.disable()
@@ -1,15 +1,34 @@
 import os
 import json
+import hashlib
 from syslog import syslog
 import pandas as pd
 import json
-from datetime import datetime, timedelta
+from datetime import datetime
 from collections import Counter
 from collections import defaultdict
+from contextlib import redirect_stdout
+import re
 import numpy as np
 from sklearn.manifold import TSNE
-from tslearn.metrics import cdist_dtw
 from tslearn.preprocessing import TimeSeriesScalerMeanVariance
+from src.graph_store import GraphStore
+from src.movements import split_by_day, IntervalTable, END_OF_DAY
+from src.activity_cube import ActivityCube
+from src import distance
+from src.distance_cache import DistanceCache, cache_key
+from src.similarity import SimilarityIndex, SimilarityIndexStore
+from src.jobs import LogProgress
+from src.union_index import UnionIndex
+from src.rollups import Rollup
+from src.species_index import SpeciesIndex
+from src.snapshot import Snapshot
+from src.json_stream import iter_array, iter_object_arrays, ChunkedTable
+from src.interning import IdTable, MISSING
+from src.pagination import paginate
+from src.metrics import stage
+from src.ingest import IngestLog
+from src.serving import ReadWriteLock
 
 PATH_DATA_FOLDER = './data/'
 FILE_MC2_JSON = 'mc2.json'
@@ -17,6 +36,22 @@ FILE_OCEANUS_GEOGRAPHY_NODES_JSON = 'Oceanus_Geography_Nodes.json'
 FILE_OCEANUS_GEOGRAPHY_GEOJSON = 'Oceanus_Geography.geojson'
 FILE_LOCATION_COORDINATES = 'location_coordinates.json'
 FILE_TRANSPORT_MOVEMENTS = 'transportMovements.json'
+FILE_INGEST_LOG = 'ingest.jsonl'
+FOLDER_CACHE = 'cache'
+FOLDER_ACTIVITY_CUBE = 'activity_cube'
+FOLDER_DISTANCES = 'distances'
+FOLDER_SIMILARITY = 'similarity'
+FOLDER_SNAPSHOT = 'snapshot'
+FOLDER_METRICS = 'metrics'
+FOLDER_JOBS = 'jobs'
+FOLDER_INBOX = 'inbox'
+
+# sklearn's default number of t-SNE iterations and the line its verbose optimizer prints
+TSNE_MAX_ITER = 1000
+TSNE_ITERATION_LOG = re.compile(r'\[t-SNE\] Iteration (\d+):')
+# similar vessels may shift their routine by up to a week
+SIMILARITY_WINDOW = 'sakoe_chiba'
+SIMILARITY_WINDOW_SIZE = 7
 
 ENTITY_TYPES = {
     'document': {'delivery_report': 'Entity.Document.DeliveryReport'},
@@ -42,38 +77,385 @@ EVENT_TYPES = {
 }
 
 
-class Model:
-    def __init__(self):
-        self.DATA_FOLDER = PATH_DATA_FOLDER
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def parse_pings(df_transport_events):
+    """(start_time, end_time) of TransponderPing links, whose time may or may not have fractional seconds."""
+    # 尝试第一种格式解析日期时间
+    start_time = pd.to_datetime(df_transport_events['time'], errors='coerce', format="%Y-%m-%dT%H:%M:%S.%f")
+    # 对于解析失败的，使用第二种格式
+    mask = start_time.isna()
+    start_time[mask] = pd.to_datetime(df_transport_events.loc[mask, 'time'], format="%Y-%m-%dT%H:%M:%S")
+    end_time = start_time + pd.to_timedelta(df_transport_events['dwell'], unit='s')
+    return start_time, end_time
+
 
+def build_document_table(df_transaction, df_document):
+    """One row per delivery report with ids: its transactions name the commodity first and the location second."""
+    position = df_transaction.groupby('source', sort=False).cumcount()
+    first = df_transaction[position == 0].set_index('source')
+    second = df_transaction[position == 1].set_index('source')['target']
+    qty_tons = df_document.drop_duplicates('id').set_index('id')['qty_tons'] if not df_document.empty \
+        else pd.Series(dtype=float)
+
+    return pd.DataFrame({
+        'date': pd.to_datetime(first['date'], format='%Y-%m-%d').dt.strftime('%Y-%m-%d'),
+        'commodity_id': first['target'],
+        'location_id': second.reindex(first.index),
+        'qty_tons': qty_tons.reindex(first.index),
+        'document_id': first.index,
+    }).reset_index(drop=True)
+
+
+class Model:
+    def __init__(self, data_folder=PATH_DATA_FOLDER):
+        self.DATA_FOLDER = data_folder
+        # the source files identify the snapshot and the activity cube,
+        # data_version also counts the batches ingested on top of them
+        self.source_version = self.get_data_version()
+        self.data_version = self.source_version
+        self.document_table = None
+        self.harbor_table = None
+        self.union_index = None
+        self.vessel_rollup = None
+        self.commodity_rollup = None
+        self.species_index = None
+        self.commodity_fishing_locations = None
+        self.commodity_distribution_table = None
+        self.ingest_log = IngestLog(os.path.join(self.DATA_FOLDER, FILE_INGEST_LOG), self.source_version)
+        self.ingest_offset = 0
+        # catch_up changes the tables in place, requests hold the read side while they use them
+        self.lock = ReadWriteLock()
+        # day -> log offset of the last batch with pings on that day
+        self.day_versions = {}
+
+        # parsing the json sources is the slow part of startup, later runs read the snapshot instead
+        snapshot = Snapshot(os.path.join(self.DATA_FOLDER, FOLDER_CACHE, FOLDER_SNAPSHOT))
+        with stage('startup.snapshot'):
+            loaded = self.load_snapshot(snapshot)
+        if not loaded:
+            with stage('startup.sources'):
+                self.load_sources()
+            self.save_snapshot(snapshot)
+
+        with stage('startup.activity_cube'):
+            self.activity_cube = self.get_activity_cube()
+        self.distance_cache = DistanceCache(os.path.join(self.DATA_FOLDER, FOLDER_CACHE, FOLDER_DISTANCES))
+        self.similarity_indexes = SimilarityIndexStore(os.path.join(self.DATA_FOLDER, FOLDER_CACHE, FOLDER_SIMILARITY))
+        # batches ingested since the sources were written are replayed on top of them, a log of older sources is not
+        self.ingest_log.discard_stale()
+        self.catch_up()
+
+    def load_sources(self):
+        # stream the records straight into one columnar table per type, the dicts never pile up
+        node_tables = defaultdict(ChunkedTable)
+        link_tables = defaultdict(ChunkedTable)
         try:
             with open(os.path.join(self.DATA_FOLDER, FILE_MC2_JSON), 'r') as file:
-                mc2 = json.load(file)
-                self.entities = mc2['nodes']
-                self.events = mc2['links']
+                for key, record in iter_object_arrays(file):
+                    if key == 'nodes':
+                        node_tables[record['type']].append(record)
+                    elif key == 'links':
+                        link_tables[record['type']].append(record)
         except Exception as e:
             print(f'could not open: {FILE_MC2_JSON} because {e}')
-            
+            node_tables.clear()
+            link_tables.clear()
+
+        # index the graph once, every get_* lookup below goes through it
+        self.graph = GraphStore({node_type: table.to_frame() for node_type, table in node_tables.items()},
+                                {link_type: table.to_frame() for link_type, table in link_tables.items()})
+        # entity ids get their codes in graph order, the derived tables only store codes
+        self.ids = IdTable()
+        for frame in self.graph.node_frames.values():
+            if 'id' in frame:
+                self.ids.add(frame['id'])
+
+        transport_movement_start_end = ChunkedTable()
         try:
             with open(os.path.join(self.DATA_FOLDER, FILE_TRANSPORT_MOVEMENTS), 'r') as file:
-                self.transport_movement_start_end = json.load(file)
+                for record in iter_array(file):
+                    transport_movement_start_end.append(record)
         except Exception as e:
-            print(f'could not open: {FILE_MC2_JSON} because {e}')
-        
+            print(f'could not open: {FILE_TRANSPORT_MOVEMENTS} because {e}')
+            transport_movement_start_end = ChunkedTable()
+        transport_movement_start_end = transport_movement_start_end.to_frame()
+        for column in ('vessel_id', 'location_id'):
+            if column in transport_movement_start_end:
+                transport_movement_start_end[column] = self.ids.add(transport_movement_start_end[column])
+        # parsed, sorted and indexed by vessel once, instead of on every aggregation
+        self.interval_table = IntervalTable(transport_movement_start_end)
+        # the full records in the same order, row i of one is row i of the other
+        self.movement_table = transport_movement_start_end.iloc[self.interval_table.order].reset_index(drop=True)
+
         self.transport_movements = self.get_transport_movements()
+        self.get_document_table()
+
+    def load_snapshot(self, snapshot):
+        frames = snapshot.load(self.source_version)
+        if frames is None:
+            return False
+        node_frames = {name[len('nodes/'):]: frame for name, frame in frames.items() if name.startswith('nodes/')}
+        link_frames = {name[len('links/'):]: frame for name, frame in frames.items() if name.startswith('links/')}
+        self.graph = GraphStore(node_frames, link_frames)
+        self.ids = IdTable(frames['ids']['id'])
+        self.movement_table = frames['movement_table']
+        # the parsed times are stored in table order, only the strings of the records would need parsing again
+        times = frames['interval_times']
+        self.interval_table = IntervalTable(self.movement_table[['vessel_id', 'location_id']].assign(
+            start_time=times['start'].to_numpy(), end_time=times['end'].to_numpy()))
+        self.transport_movements = frames['transport_movements']
+        self.document_table = frames['document_table']
+        return True
+
+    def save_snapshot(self, snapshot):
+        frames = {f'nodes/{node_type}': frame for node_type, frame in self.graph.node_frames.items()}
+        frames.update({f'links/{link_type}': frame for link_type, frame in self.graph.link_frames.items()})
+        frames['ids'] = pd.DataFrame({'id': pd.Series(self.ids.ids, dtype=object)})
+        frames['movement_table'] = self.movement_table
+        frames['interval_times'] = pd.DataFrame({'start': self.interval_table.start, 'end': self.interval_table.end})
+        frames['transport_movements'] = self.transport_movements
+        frames['document_table'] = self.document_table
+        try:
+            snapshot.save(self.source_version, frames)
+        except OSError as e:
+            print(f'could not save the snapshot because {e}')
+
+    def get_data_version(self):
+        # size and mtime of the source files identify everything derived from them
+        stats = []
+        for file_name in (FILE_MC2_JSON, FILE_TRANSPORT_MOVEMENTS):
+            path = os.path.join(self.DATA_FOLDER, file_name)
+            if os.path.exists(path):
+                stat = os.stat(path)
+                stats.append(f'{file_name}:{stat.st_size}:{stat.st_mtime_ns}')
+        return hashlib.md5('|'.join(stats).encode()).hexdigest()
+
+    def check_batch(self, batch):
+        """Raise ValueError unless batch is {"nodes": [...], "links": [...]} with records ingest can apply."""
+        if not isinstance(batch, dict) or not set(batch) <= {'nodes', 'links'}:
+            raise ValueError('a batch is {"nodes": [...], "links": [...]}')
+        if not batch.get('nodes') and not batch.get('links'):
+            raise ValueError('the batch is empty')
+        for key, required in (('nodes', ('type', 'id')), ('links', ('type', 'source', 'target'))):
+            records = batch.get(key, [])
+            if not isinstance(records, list) or not all(isinstance(record, dict) for record in records):
+                raise ValueError(f'{key} must be a list of records')
+            for record in records:
+                shown = json.dumps(record)[:200]
+                missing = [field for field in required if record.get(field) is None]
+                if missing:
+                    raise ValueError(f'{key[:-1]} without {", ".join(missing)}: {shown}')
+                not_text = [field for field in required if not isinstance(record[field], str)]
+                if not_text:
+                    raise ValueError(f'{key[:-1]} {", ".join(not_text)} must be strings: {shown}')
+                record_type = record['type']
+                if record_type == ENTITY_TYPES['document']['delivery_report'] and key == 'nodes' \
+                        and record.get('qty_tons') is not None and not _is_number(record['qty_tons']):
+                    raise ValueError(f'qty_tons must be a number: {shown}')
+                if record_type == EVENT_TYPES['transport_event'] and key == 'links':
+                    if not _is_number(record.get('dwell')) or not record['dwell'] >= 0:
+                        raise ValueError(f'every ping needs a dwell of zero or more seconds: {shown}')
+                    if not isinstance(record.get('time'), str):
+                        raise ValueError(f'every ping needs a time: {shown}')
+                if record_type in (EVENT_TYPES['transaction'], EVENT_TYPES['harbor_report']) and key == 'links' \
+                        and not isinstance(record.get('date'), str):
+                    raise ValueError(f'every transaction and harbor report needs a date: {shown}')
+
+        links = pd.DataFrame(batch.get('links', []), columns=['type', 'time', 'dwell', 'date'])
+        pings = links[links['type'] == EVENT_TYPES['transport_event']]
+        dated = links[links['type'].isin([EVENT_TYPES['transaction'], EVENT_TYPES['harbor_report']])]
+        try:
+            if parse_pings(pings)[0].isna().any():
+                raise ValueError('every ping needs a time')
+            if pd.to_datetime(dated['date'], format='%Y-%m-%d').isna().any():
+                raise ValueError('every transaction and harbor report needs a date')
+        except (TypeError, ValueError) as e:
+            raise ValueError(f'invalid batch: {e}')
+
+    def ingest(self, batch):
+        """
+        Apply a batch of new graph records and append it to the ingest log,
+        return the new data version.  The batch is applied first, after every
+        batch logged before it and under the log's lock, so that one which
+        fails is never logged for the other processes to replay.
+        """
+        self.check_batch(batch)
+        with self.lock.writing():
+            def apply(offset):
+                self.apply_log()
+                try:
+                    self.apply_batch(batch, offset)
+                except Exception as e:
+                    raise ValueError(f'could not apply the batch: {e!r}')
+            offset = self.ingest_log.append(batch, apply)
+            self.ingest_offset = offset
+            self.data_version = hashlib.md5(f'{self.source_version}:{self.ingest_offset}'.encode()).hexdigest()
+        return {'data_version': self.data_version, 'offset': offset,
+                'nodes': len(batch.get('nodes', [])), 'links': len(batch.get('links', []))}
+
+    def catch_up(self):
+        """
+        Apply the batches appended to the ingest log since the last call, by
+        this process, another worker or the inbox watcher.  Costs one stat()
+        when there is nothing new.  Must not be called while holding the
+        read side of self.lock, it waits for the readers to finish.
+        """
+        if self.ingest_log.size() <= self.ingest_offset:
+            return False
+        with self.lock.writing():
+            return self.apply_log()
+
+    def apply_log(self):
+        """catch_up() with the write side of self.lock already held."""
+        batches = self.ingest_log.read(self.ingest_offset)
+        with stage('ingest.apply'):
+            for offset, batch in batches:
+                try:
+                    # checked again, the log may hold batches of an older server that the check would refuse now
+                    self.check_batch(batch)
+                    self.apply_batch(batch, offset)
+                except Exception as e:
+                    # set aside and skipped, rather than failing every request and every restart after it
+                    self.ingest_log.quarantine(offset, batch, e)
+                self.ingest_offset = offset
+        self.data_version = hashlib.md5(f'{self.source_version}:{self.ingest_offset}'.encode()).hexdigest()
+        return bool(batches)
+
+    def apply_batch(self, batch, sequence):
+        """
+        Fold one batch into the graph and into the derived structures it
+        touches; sequence (its log offset) marks the days it changed.
+        Everything built from data the batch does not touch stays as it is.
+        """
+        nodes = self.graph.add(batch.get('nodes', []), batch.get('links', []))
+        self.ids.add([node['id'] for node in nodes])
+        links = pd.DataFrame(batch.get('links', []), columns=['type', 'time', 'dwell', 'date', 'source', 'target'])
+
+        pings = links[links['type'] == EVENT_TYPES['transport_event']].reset_index(drop=True)
+        if len(pings):
+            self.ingest_pings(pings, sequence)
+            self.vessel_rollup = None
+
+        new_documents = [node['id'] for node in nodes if node['type'] == ENTITY_TYPES['document']['delivery_report']]
+        transactions = links[links['type'] == EVENT_TYPES['transaction']]
+        document_rows, replaced = self.ingest_documents(transactions['source'].tolist() + new_documents)
+        if len(document_rows) or replaced:
+            self.commodity_rollup = None
+            self.commodity_distribution_table = None
+        if any(node['type'] == ENTITY_TYPES['location']['region'] for node in nodes):
+            self.species_index = None
+            self.commodity_fishing_locations = None
+        elif any(node['type'] == ENTITY_TYPES['commodity']['fish'] for node in nodes):
+            self.commodity_fishing_locations = None
+
+        harbor_reports = links[links['type'] == EVENT_TYPES['harbor_report']].reset_index(drop=True)
+        harbor_rows = self.build_harbor_table(harbor_reports)
+        if any(node['type'].startswith('Entity.Vessel') for node in nodes):
+            # harbor reports may have named these vessels before, their type is only known now
+            self.harbor_table = None
+        elif self.harbor_table is not None and len(harbor_rows):
+            table = pd.concat([self.harbor_table, harbor_rows], ignore_index=True)
+            self.harbor_table = table.iloc[np.argsort(table['date'].to_numpy(), kind='stable')].reset_index(drop=True)
+
+        if self.union_index is not None:
+            if replaced:
+                # documents completed by this batch already have entries, rebuild on next use
+                self.union_index = None
+            else:
+                self.merge_union(self.get_harbor_records(harbor_rows), self.get_document_records(document_rows))
+
+    def ingest_pings(self, pings, sequence):
+        start_time, end_time = parse_pings(pings)
+        location_codes = self.ids.add(pings['source'])
+        vessel_codes = self.ids.add(pings['target'])
+
+        # day split, activity cube and per-vessel time series: only the new pings are split and added
+        split = split_by_day(start_time, end_time, location_codes, vessel_codes)
+        self.transport_movements = pd.concat([self.transport_movements, split], ignore_index=True)
+        self.activity_cube.add(split)
+
+        # a ping's movement starts at the ping and lasts its dwell, like the rows of transportMovements.json
+        movements = pd.DataFrame({
+            'start_time': start_time.dt.strftime('%Y-%m-%dT%H:%M:%S'),
+            'end_time': end_time.dt.strftime('%Y-%m-%dT%H:%M:%S'),
+            'vessel_id': vessel_codes,
+            'location_id': location_codes,
+            'dwell': pd.to_numeric(pings['dwell']).astype(np.float64),
+        })
+        if len(self.movement_table.columns):
+            movements = movements.reindex(columns=self.movement_table.columns)
+        order = self.interval_table.insert(movements)
+        self.movement_table = pd.concat([self.movement_table, movements], ignore_index=True).iloc[order] \
+            .reset_index(drop=True)
+        for day in pd.unique(split['date']):
+            self.day_versions[day] = sequence
+
+    def ingest_documents(self, document_ids):
+        """
+        Build the document table rows of the given documents from all of
+        their transactions, replace the rows they already had and append the
+        others.  Returns (positions of the appended rows, whether any row was replaced).
+        """
+        table = self.get_document_table()
+        document_ids = pd.unique(pd.Series(document_ids, dtype=object))
+        df_transaction = self.get_events(EVENT_TYPES['transaction'])
+        if not len(document_ids) or df_transaction.empty:
+            return np.array([], dtype=np.intp), False
+        df_transaction = df_transaction[df_transaction['source'].isin(document_ids)]
+        df_document = self.get_entities(ENTITY_TYPES['document']['delivery_report'])
+        if not df_document.empty:
+            df_document = df_document[df_document['id'].isin(document_ids)]
+        rows = build_document_table(df_transaction, df_document)
+        for column in ('commodity_id', 'location_id', 'document_id'):
+            rows[column] = self.ids.add(rows[column])
+        rows = rows[table.columns]
+
+        positions = pd.Index(table['document_id']).get_indexer(rows['document_id'])
+        replaced = positions >= 0
+        if replaced.any():
+            # snapshot columns are read-only memory maps
+            table = table.copy()
+            table.iloc[positions[replaced]] = rows[replaced].to_numpy()
+        self.document_table = pd.concat([table, rows[~replaced]], ignore_index=True)
+        return np.arange(len(table), len(self.document_table)), bool(replaced.any())
+
+    def get_window_version(self, start_date, end_date):
+        # results over [start_date, end_date] only change when pings land on one of its days
+        changed = [sequence for day, sequence in self.day_versions.items() if start_date <= day <= end_date]
+        return f'{self.source_version}:{max(changed)}' if changed else self.source_version
+
+    def get_activity_cube(self):
+        folder = os.path.join(self.DATA_FOLDER, FOLDER_CACHE, FOLDER_ACTIVITY_CUBE)
+        try:
+            cube = ActivityCube.load(folder, self.source_version)
+            if cube is not None:
+                return cube
+        except (OSError, ValueError, KeyError):
+            pass
 
+        cube = ActivityCube.from_movements(self.transport_movements, self.source_version)
+        try:
+            cube.save(folder)
+            # reopen memory mapped so that every worker process shares one copy
+            return ActivityCube.load(folder)
+        except OSError as e:
+            print(f'could not cache the activity cube because {e}')
+            return cube
 
     def get_events(self, event_type):
-        return pd.DataFrame([event for event in self.events if event['type'] == event_type])
+        return self.graph.links_frame(event_type)
 
     def get_entities(self, entity_type):
-        return pd.DataFrame([entity for entity in self.entities if entity['type'] == entity_type])
+        return self.graph.nodes_frame(entity_type)
 
     def get_entities_vague(self, entity_type):
-        return pd.DataFrame([entity for entity in self.entities if entity['type'].startswith(entity_type)])
+        return self.graph.nodes_frame_vague(entity_type)
 
     def get_entity(self, entity_id):
-        return pd.DataFrame([entity for entity in self.entities if entity['id'] == entity_id])
+        return self.graph.node_frame(entity_id)
 
     def get_location_coordinates(self):
         return self.location_coordinates
@@ -81,127 +463,86 @@ class Model:
     def get_geo_data(self):
         return self.oceanus_geography_geojson
 
-    def get_commodity_fishing_locations(self):
-        df_location_region = pd.DataFrame(
-            self.get_entities(ENTITY_TYPES['location']['region']))
-        df_commodities = pd.DataFrame(
-            self.get_entities(ENTITY_TYPES['commodity']['fish']))
-
-        commodity_fishing_locations = {}
-
-        for _, row in df_commodities.iterrows():
-            commodity_name = row['name']
-            commodity_id = row['id']
-            commodity_fishing_locations[commodity_id] = []
-            for _, location_row in df_location_region.iterrows():
-                fish_species_present = location_row['fish_species_present']
-                if commodity_name in fish_species_present:
-                    commodity_fishing_locations[commodity_id].append(
-                        location_row['id'])
+    def get_species_index(self):
+        if self.species_index is None:
+            df_location_region = self.get_entities(ENTITY_TYPES['location']['region'])
+            self.species_index = SpeciesIndex(df_location_region.get('id', []),
+                                              df_location_region.get('fish_species_present', []))
+        return self.species_index
 
-        return commodity_fishing_locations
+    def get_commodity_fishing_locations(self):
+        # commodity id -> the regions where its species is present
+        if self.commodity_fishing_locations is None:
+            species_index = self.get_species_index()
+            df_commodities = self.get_entities(ENTITY_TYPES['commodity']['fish'])
+            self.commodity_fishing_locations = {
+                commodity_id: species_index.lookup(commodity_name)
+                for commodity_id, commodity_name in zip(df_commodities.get('id', []), df_commodities.get('name', []))}
+        return self.commodity_fishing_locations
 
     def get_transport_movements(self):
-        self.transport_movements = []
+        self.transport_movements = pd.DataFrame(
+            columns=['date', 'location_id', 'vessel_id', 'dwell'])
         df_transport_events = pd.DataFrame(
             self.get_events(EVENT_TYPES['transport_event']))
 
         if not df_transport_events.empty:
-            # 尝试第一种格式解析日期时间
-            df_transport_events['start_time'] = pd.to_datetime(
-                df_transport_events['time'], errors='coerce', format="%Y-%m-%dT%H:%M:%S.%f")
-            # 对于解析失败的，使用第二种格式
-            mask = df_transport_events['start_time'].isna()
-            df_transport_events.loc[mask, 'start_time'] = pd.to_datetime(
-                df_transport_events.loc[mask, 'time'], format="%Y-%m-%dT%H:%M:%S")
-
-            df_transport_events['end_time'] = df_transport_events['start_time'] + \
-                pd.to_timedelta(df_transport_events['dwell'], unit='s')
+            df_transport_events['start_time'], df_transport_events['end_time'] = parse_pings(df_transport_events)
 
             # 将数据按天拆分
-            for _, row in df_transport_events.iterrows():
-                location_id = row['source']
-                vessel_id = row['target']
-                start_time = row['start_time']
-                end_time = row['end_time']
-
-                current_date = start_time
-                while current_date.date() <= end_time.date():
-                    if current_date.date() == start_time.date():
-                        if current_date.date() == end_time.date():
-                            dwell = (end_time - start_time).total_seconds()
-                        else:
-                            dwell = (datetime.combine(current_date.date(), datetime.max.time()) - start_time).total_seconds()
-                    elif current_date.date() == end_time.date():
-                        dwell = (end_time - datetime.combine(current_date.date(), datetime.min.time())).total_seconds()
-                    else:
-                        dwell = 24 * 3600  # Full day in seconds
-
-                    self.transport_movements.append({
-                        'date': current_date.strftime("%Y-%m-%d"),
-                        'location_id': location_id,
-                        'vessel_id': vessel_id,
-                        # 'vessel_type': self.get_entity(vessel_id)['type'].values[0],
-                        'type': 'transport',
-                        # 'movement_id': vessel_id + '_' + location_id + '_' + current_date.strftime("%Y-%m-%dT%H:%M:%S"),
-                        # 'key': vessel_id + '_' + location_id + '_' + current_date.strftime("%Y-%m-%dT%H:%M:%S"),
-                        'dwell': dwell
-                    })
-                    current_date += timedelta(days=1)
-        # self.transport_movements.sort(
-        #     key=lambda x: datetime.strptime(x['date'], "%Y-%m-%dT%H:%M:%S"))
+            self.transport_movements = split_by_day(
+                df_transport_events['start_time'], df_transport_events['end_time'],
+                self.ids.add(df_transport_events['source']), self.ids.add(df_transport_events['target']))
         return self.transport_movements
 
+    def get_harbor_table(self):
+        # one row per harbor report sorted by date, vessel and location as codes
+        if self.harbor_table is not None:
+            return self.harbor_table
+
+        table = self.build_harbor_table(self.get_events(EVENT_TYPES['harbor_report']))
+        self.harbor_table = table.iloc[np.argsort(table['date'].to_numpy(), kind='stable')].reset_index(drop=True)
+        return self.harbor_table
+
+    def build_harbor_table(self, df_harbor_reports):
+        columns = ['date', 'location_id', 'vessel_id', 'vessel_type']
+        if df_harbor_reports.empty:
+            return pd.DataFrame(columns=columns)
+        date = pd.to_datetime(df_harbor_reports['date'], format="%Y-%m-%d").dt.strftime("%Y-%m-%dT%H:%M:%S")
+        vessel_types = {vessel_id: (self.graph.get_node(vessel_id) or {}).get('type')
+                        for vessel_id in df_harbor_reports['source'].unique()}
+        return pd.DataFrame({
+            'date': date,
+            'location_id': self.ids.add(df_harbor_reports['target']),
+            'vessel_id': self.ids.add(df_harbor_reports['source']),
+            'vessel_type': df_harbor_reports['source'].map(vessel_types),
+        }).reset_index(drop=True)[columns]
+
+    def get_harbor_records(self, table):
+        table = self.ids.decode_columns(table, ['location_id', 'vessel_id'])
+        table['type'] = 'harbor'
+        table['movement_id'] = table['vessel_id'] + '_' + table['location_id'] + '_' + table['date']
+        table['key'] = table['movement_id']
+        return table[['date', 'location_id', 'vessel_id', 'vessel_type', 'type', 'movement_id', 'key']].to_dict('records')
+
     def get_harbor_movements(self):
-        self.harbor_movements = []
-        df_harbor_reports = pd.DataFrame(
-            self.get_events(EVENT_TYPES['harbor_report']))
-        if not df_harbor_reports.empty:
-            df_harbor_reports['date'] = pd.to_datetime(
-                df_harbor_reports['date'], format="%Y-%m-%d")
-
-            for _, row in df_harbor_reports.iterrows():
-                location_id = row['target']
-                vessel_id = row['source']
-                date = row['date']
-
-                self.harbor_movements.append({
-                    'date': date.strftime("%Y-%m-%dT%H:%M:%S"),
-                    'location_id': location_id,
-                    'vessel_id': vessel_id,
-                    'vessel_type': self.get_entity(vessel_id)['type'].values[0],
-                    'type': 'harbor',
-                    'movement_id': vessel_id + '_' + location_id + '_' + date.strftime("%Y-%m-%dT%H:%M:%S"),
-                    'key': vessel_id + '_' + location_id + '_' + date.strftime("%Y-%m-%dT%H:%M:%S"),
-                })
-        self.harbor_movements.sort(
-            key=lambda x: datetime.strptime(x['date'], "%Y-%m-%dT%H:%M:%S"))
+        self.harbor_movements = self.get_harbor_records(self.get_harbor_table())
         return self.harbor_movements
 
-    def get_commodity_distributions(self):
-        self.commodity_distributions = []
-
-        # 获取交易事件数据框
-        df_transactions = pd.DataFrame(
-            self.get_events(EVENT_TYPES['transaction']))
-
-        if not df_transactions.empty:
-            # 将日期转换为日期对象，并格式化为字符串
-            df_transactions['date'] = pd.to_datetime(
-                df_transactions['date'], format="%Y-%m-%d").dt.strftime("%Y-%m-%d")
+    def get_commodity_distribution_table(self):
+        # the document table without tonnage, ordered by document id like a groupby over the transactions
+        if self.commodity_distribution_table is None:
+            table = self.get_document_table()
+            order = np.argsort(self.ids.decode(table['document_id'].to_numpy()), kind='stable')
+            self.commodity_distribution_table = table.iloc[order][
+                ['date', 'commodity_id', 'location_id', 'document_id']].reset_index(drop=True)
+        return self.commodity_distribution_table
 
-            # 使用 groupby 和 apply 来处理每个 document_id 的数据
-            def process_group(group):
-                date = group['date'].values[0]
-                commodity_id = group['target'].values[0]
-                location_id = group['target'].values[1] if len(
-                    group) > 1 else None
-                return {'date': date, 'commodity_id': commodity_id, 'location_id': location_id, 'document_id': group['source'].values[0]}
-
-            self.commodity_distributions = df_transactions.groupby(
-                'source').apply(process_group).tolist()
-
-        print(len(self.commodity_distributions))
+    def get_commodity_distributions(self):
+        # one record per delivery report, location_id is None when its transactions name no location
+        table = self.get_commodity_distribution_table()
+        self.commodity_distributions = self.ids.decode_columns(
+            table, ['commodity_id', 'location_id', 'document_id']).to_dict('records')
         return self.commodity_distributions
 
     def get_vessel_movement_sequences(self, vessel_movements):
@@ -217,148 +558,226 @@ class Model:
             movements.sort(key=lambda x: x[0])
         return vessel_movement_sequences
 
-    def get_date_location_commodity(self):
+    def get_document_table(self):
+        # one row per delivery report: its transactions name the commodity first and the location second
+        if self.document_table is not None:
+            return self.document_table
+
         df_transaction = self.get_events(EVENT_TYPES['transaction'])
         df_document = self.get_entities(
             ENTITY_TYPES['document']['delivery_report'])
-        documents = df_transaction['source'].unique()
-        self.date_location_commodity = []
-        for document in documents:
-            pair = df_transaction[df_transaction['source'] == document]
-            date = pair['date'].values[0]
-            date = datetime.strptime(date, '%Y-%m-%d')
-            commodity = pair['target'].values[0]
-            location = pair['target'].values[1]
-            qty_tons = df_document[df_document['id']
-                                   == document]['qty_tons'].values[0]
-            self.date_location_commodity.append({'date': date.strftime(
-                "%Y-%m-%d"), 'commodity_id': commodity, 'location_id': location, 'qty_tons': qty_tons, 'document_id': document})
+        columns = ['date', 'commodity_id', 'location_id', 'qty_tons', 'document_id']
+        if df_transaction.empty:
+            self.document_table = pd.DataFrame(columns=columns)
+            return self.document_table
+
+        table = build_document_table(df_transaction, df_document)
+        for column in ('commodity_id', 'location_id', 'document_id'):
+            table[column] = self.ids.add(table[column])
+        self.document_table = table[columns]
+        return self.document_table
+
+    def get_document_rows(self, direction=None, start_date=None, end_date=None, location_ids=None,
+                          commodity_ids=None):
+        # direction: None for every document, 'import' for qty_tons > 0, 'export' for the rest
+        table = self.get_document_table()
+        mask = pd.Series(True, index=table.index)
+        if direction == 'import':
+            mask &= ~(table['qty_tons'] <= 0)
+        elif direction == 'export':
+            mask &= ~(table['qty_tons'] > 0)
+        elif direction is not None:
+            raise ValueError(f'unknown direction: {direction}')
+        if start_date is not None:
+            mask &= table['date'] >= start_date
+        if end_date is not None:
+            mask &= table['date'] <= end_date
+        if location_ids is not None:
+            mask &= table['location_id'].isin(self.get_codes(location_ids))
+        if commodity_ids is not None:
+            mask &= table['commodity_id'].isin(self.get_codes(commodity_ids))
+        return np.flatnonzero(mask.to_numpy())
+
+    def get_document_records(self, rows):
+        return self.ids.decode_columns(self.get_document_table().iloc[rows],
+                                       ['commodity_id', 'location_id', 'document_id']).to_dict('records')
+
+    def get_date_location_commodity(self, direction=None, start_date=None, end_date=None, location_ids=None):
+        with stage('documents.filter'):
+            rows = self.get_document_rows(direction, start_date, end_date, location_ids)
+        with stage('documents.records'):
+            self.date_location_commodity = self.get_document_records(rows)
         return self.date_location_commodity
 
     def get_date_location_commodity_export(self):
-        df_transaction = self.get_events(EVENT_TYPES['transaction'])
-        df_document = self.get_entities(
-            ENTITY_TYPES['document']['delivery_report'])
-        documents = df_transaction['source'].unique()
-        self.date_location_commodity = []
-        for document in documents:
-            pair = df_transaction[df_transaction['source'] == document]
-            date = pair['date'].values[0]
-            date = datetime.strptime(date, '%Y-%m-%d')
-            commodity = pair['target'].values[0]
-            location = pair['target'].values[1]
-            qty_tons = df_document[df_document['id']
-                                   == document]['qty_tons'].values[0]
-            if qty_tons > 0:
-                continue
-            self.date_location_commodity.append({'date': date.strftime(
-                "%Y-%m-%d"), 'commodity_id': commodity, 'location_id': location, 'qty_tons': qty_tons, 'document_id': document})
-        return self.date_location_commodity
+        return self.get_date_location_commodity('export')
 
     def get_date_location_commodity_import(self):
-        df_transaction = self.get_events(EVENT_TYPES['transaction'])
-        df_document = self.get_entities(
-            ENTITY_TYPES['document']['delivery_report'])
-        documents = df_transaction['source'].unique()
-        self.date_location_commodity = []
-        for document in documents:
-            pair = df_transaction[df_transaction['source'] == document]
-            date = pair['date'].values[0]
-            date = datetime.strptime(date, '%Y-%m-%d')
-            commodity = pair['target'].values[0]
-            location = pair['target'].values[1]
-            qty_tons = df_document[df_document['id']
-                                   == document]['qty_tons'].values[0]
-            if qty_tons <= 0:
-                continue
-            self.date_location_commodity.append({'date': date.strftime(
-                "%Y-%m-%d"), 'commodity_id': commodity, 'location_id': location, 'qty_tons': qty_tons, 'document_id': document})
-        return self.date_location_commodity
+        return self.get_date_location_commodity('import')
 
     def get_vessel_commodity_union(self, vessel_movements, date_location_commodity):
-        date_loc_commodity_qty = {}
-        for item in date_location_commodity:
-            # if item['location'] not in location_list:
-            #     # print(item)
-            #     continue
-            key = (datetime.strptime(
-                item['date'], '%Y-%m-%d').date(), item['location_id'])
-            if key not in date_loc_commodity_qty:
-                date_loc_commodity_qty[key] = []
-            date_loc_commodity_qty[key].append(
-                {'document_id': item['document_id'], 'commodity_id': item['commodity_id'], 'qty_tons': item['qty_tons']})
-
-        date_loc_vessel = {}
-        for item in vessel_movements:
-            key = (datetime.strptime(
-                item['date'], '%Y-%m-%dT%H:%M:%S').date(), item['location_id'])
-            if key not in date_loc_vessel:
-                date_loc_vessel[key] = []
-            date_loc_vessel[key].append(
-                {'movement_id': item['movement_id'], 'vessel_id': item['vessel_id'], 'key': item['key']})
-        date_loc_vessel_commodity = []
-        all_keys = set(set(date_loc_commodity_qty.keys()).union(
-            set(date_loc_vessel.keys())))
-
-        for key in all_keys:
-            date, location = key
-            # assert location in location_list, key
-            commoditys = date_loc_commodity_qty.get(key, [])
-            vessels = date_loc_vessel.get(key, [])
-            # if len(commoditys) == 0 or len(vessels) == 0:
-            #     continue
-            date_loc_vessel_commodity.append({'date': date.strftime(
-                '%Y-%m-%d'), 'location_id': location, 'commoditys': commoditys, 'vessels': vessels})
-        return sorted(date_loc_vessel_commodity, key=lambda x: datetime.strptime(x['date'], "%Y-%m-%d"))
+        union_index = UnionIndex()
+        union_index.add_commodities(date_location_commodity)
+        union_index.add_vessel_movements(vessel_movements)
+        return union_index.query()
 
     def refresh_unions(self, original_union, vessel_movements):
-        date_loc_vessel = {}
+        # hash the union by (date, location) once instead of scanning it for every movement key
+        union_by_key = {(item['date'], item['location_id']): item for item in original_union}
         for item in vessel_movements:
-            key = (datetime.strptime(
-                item['date'], '%Y-%m-%dT%H:%M:%S').date(), item['location_id'])
-            if key not in date_loc_vessel:
-                date_loc_vessel[key] = []
-            date_loc_vessel[key].append(
-                {'movement_id': item['movement_id'], 'vessel_id': item['vessel_id'], 'key': item['key']})
-
-        for key in date_loc_vessel.keys():
-            date, location = key
-            for item in original_union:
-                if item['date'] == date.strftime('%Y-%m-%d') and item['location_id'] == location:
-                    item['vessels'] = item['vessels'] + date_loc_vessel[key]
+            union = union_by_key.get((item['date'][:10], item['location_id']))
+            if union is not None:
+                union['vessels'] = union['vessels'] + [
+                    {'movement_id': item['movement_id'], 'vessel_id': item['vessel_id'], 'key': item['key']}]
         return original_union
-    
+
+    def get_union_index(self):
+        # harbor reports joined with delivery reports, built on first use and kept up to date by merge_union
+        if self.union_index is None:
+            # filled before it is published, a concurrent request either builds its own or sees a complete one
+            union_index = UnionIndex()
+            union_index.add_commodities(self.get_date_location_commodity())
+            union_index.add_vessel_movements(self.get_harbor_movements())
+            self.union_index = union_index
+        return self.union_index
+
+    def merge_union(self, vessel_movements=(), date_location_commodity=()):
+        union_index = self.get_union_index()
+        union_index.add_commodities(date_location_commodity)
+        union_index.add_vessel_movements(vessel_movements)
+        return union_index
+
+    def query_vessel_commodity_union(self, start_date=None, end_date=None, location_ids=None, vessel_ids=None):
+        with stage('union.index'):
+            union_index = self.get_union_index()
+        with stage('union.query'):
+            return union_index.query(start_date, end_date, location_ids, vessel_ids)
+
+    def get_codes(self, ids):
+        # codes of the known ids, unknown ones cannot match anything
+        codes = self.ids.encode(ids)
+        return codes[codes != MISSING]
+
+    def query_transport_movements(self, start_date=None, end_date=None, vessel_ids=None, location_ids=None,
+                                  cursor=None, limit=None):
+        # movements overlapping [start_date, end_date] in start order, one page at a time
+        start = None if start_date is None else np.datetime64(start_date, 'D').astype('datetime64[ns]')
+        end = None if end_date is None else np.datetime64(end_date, 'D').astype('datetime64[ns]') + END_OF_DAY
+        with stage('movements.filter'):
+            rows = self.interval_table.select(start, end,
+                                              None if vessel_ids is None else self.get_codes(vessel_ids),
+                                              None if location_ids is None else self.get_codes(location_ids))
+            page, next_cursor = paginate(rows, cursor, limit, self.data_version)
+        with stage('movements.records'):
+            items = self.ids.decode_columns(self.movement_table.iloc[page], ['vessel_id', 'location_id'])
+            items = items.astype(object).where(items.notna(), None).to_dict('records')
+        return {'items': items, 'next_cursor': next_cursor, 'total': len(rows)}
+
+    def query_harbor_movements(self, start_date=None, end_date=None, vessel_ids=None, location_ids=None,
+                               vessel_types=None, cursor=None, limit=None):
+        table = self.get_harbor_table()
+        with stage('harbor.filter'):
+            # sorted by date, so the date range is a slice
+            lo = 0 if start_date is None else table['date'].searchsorted(start_date)
+            hi = len(table) if end_date is None else table['date'].searchsorted(f'{end_date}T23:59:59',
+                                                                               side='right')
+            selected = table.iloc[lo:hi]
+            mask = np.ones(len(selected), dtype=bool)
+            if vessel_ids is not None:
+                mask &= selected['vessel_id'].isin(self.get_codes(vessel_ids)).to_numpy()
+            if location_ids is not None:
+                mask &= selected['location_id'].isin(self.get_codes(location_ids)).to_numpy()
+            if vessel_types is not None:
+                mask &= selected['vessel_type'].isin(vessel_types).to_numpy()
+            rows = lo + np.flatnonzero(mask)
+            page, next_cursor = paginate(rows, cursor, limit, self.data_version)
+        with stage('harbor.records'):
+            items = self.get_harbor_records(table.iloc[page])
+        return {'items': items, 'next_cursor': next_cursor, 'total': len(rows)}
+
+    def query_commodity_distributions(self, direction=None, start_date=None, end_date=None, location_ids=None,
+                                      commodity_ids=None, cursor=None, limit=None):
+        with stage('documents.filter'):
+            rows = self.get_document_rows(direction, start_date, end_date, location_ids, commodity_ids)
+            page, next_cursor = paginate(rows, cursor, limit, self.data_version)
+        with stage('documents.records'):
+            items = self.get_document_records(page)
+        return {'items': items, 'next_cursor': next_cursor, 'total': len(rows)}
+
+    def get_vessel_rollup(self):
+        # dwell is the time spent on each day, a visit counts on the day its movement starts
+        if self.vessel_rollup is None:
+            with stage('rollup.build'):
+                split, movements = self.transport_movements, self.movement_table
+                start_days = pd.to_datetime(movements['start_time']).to_numpy().astype('datetime64[D]')
+                self.vessel_rollup = Rollup.from_records(
+                    np.concatenate([split['date'].to_numpy(dtype='datetime64[D]'), start_days]),
+                    np.concatenate([split['vessel_id'].to_numpy(), movements['vessel_id'].to_numpy()]),
+                    np.concatenate([split['location_id'].to_numpy(), movements['location_id'].to_numpy()]),
+                    visits=np.concatenate([np.zeros(len(split), dtype=np.int64),
+                                           np.ones(len(movements), dtype=np.int64)]),
+                    dwell=np.concatenate([split['dwell'].to_numpy(dtype=np.float64), np.zeros(len(movements))]))
+        return self.vessel_rollup
+
+    def get_commodity_rollup(self):
+        # tons are signed like qty_tons: imports are positive, exports the rest
+        if self.commodity_rollup is None:
+            with stage('rollup.build'):
+                table = self.get_document_table()
+                qty_tons = table['qty_tons'].to_numpy(dtype=np.float64)
+                self.commodity_rollup = Rollup.from_records(
+                    table['date'].to_numpy(dtype='datetime64[D]'), table['commodity_id'].to_numpy(),
+                    table['location_id'].to_numpy(),
+                    reports=np.ones(len(table), dtype=np.int64),
+                    import_tons=np.where(qty_tons > 0, qty_tons, 0.),
+                    export_tons=np.where(qty_tons <= 0, qty_tons, 0.))
+        return self.commodity_rollup
+
+    def get_rollup(self, kind, start_date, end_date, bins=None, resolution=None, ids=None, location_ids=None):
+        """
+        Visits and dwell per (vessel, location, bin) for kind 'vessel', report
+        count and tonnage per (commodity, location, bin) for kind 'commodity',
+        over [start_date, end_date] at day / week / month resolution.  Without
+        a resolution, the finest one giving at most bins bins is used.
+        """
+        if kind == 'vessel':
+            rollup, id_column = self.get_vessel_rollup(), 'vessel_id'
+        elif kind == 'commodity':
+            rollup, id_column = self.get_commodity_rollup(), 'commodity_id'
+        else:
+            raise ValueError(f'unknown kind: {kind}')
+        if bins is not None and int(bins) < 1:
+            raise ValueError('bins must be a positive integer')
+        with stage('rollup.query'):
+            resolution, edges, frame = rollup.query(
+                start_date, end_date, None if bins is None else int(bins), resolution,
+                None if ids is None else self.get_codes(ids),
+                None if location_ids is None else self.get_codes(location_ids))
+            frame = frame.rename(columns={'entity': id_column, 'location': 'location_id'})
+            frame = self.ids.decode_columns(frame, [id_column, 'location_id'])
+            # zipping plain lists is several times faster than to_dict for the many small rows of a heatmap
+            columns = {column: values.tolist() for column, values in frame.items()}
+            items = [dict(zip(columns, row)) for row in zip(*columns.values())]
+        return {'resolution': resolution, 'bins': edges, 'items': items}
+
+    def get_vessel_activity(self, start_date, end_date, vessel_ids, location_ids):
+        # (vessels, dates, array of shape vessels x days x locations x {count, dwell})
+        with stage('time_series.slice'):
+            vessels, dates, activity = self.activity_cube.slice(start_date, end_date, self.ids.encode(vessel_ids),
+                                                                self.ids.encode(location_ids))
+        return self.ids.decode(vessels).tolist(), dates, activity
+
     def get_vessel_time_series(self, start_date, end_date, vessel_ids, location_ids):
-        location_indices = {location: index for index, location in enumerate(location_ids)}
-        # 生成日期列表
-        start = datetime.strptime(start_date, "%Y-%m-%d")
-        end = datetime.strptime(end_date, "%Y-%m-%d")
-        date_list = [(start + timedelta(days=x)).strftime("%Y-%m-%d") for x in range((end - start).days + 1)]
-        filtered_movements = [record for record in self.transport_movements if record['vessel_id'] in vessel_ids and record['date'] in date_list and record['location_id'] in location_ids and datetime.strptime(record['date'], "%Y-%m-%d") >= start and datetime.strptime(record['date'], "%Y-%m-%d") <= end]
-        result_count = defaultdict(lambda: defaultdict(lambda: [0] * len(location_ids)))
-        result_dwell = defaultdict(lambda: defaultdict(lambda: [0] * len(location_ids)))
-        
-        for record in filtered_movements:
-            vessel_id = record['vessel_id']
-            date = record['date']
-            location_id = record['location_id']
-            dwell = record['dwell']
-            
-            # 增加对应位置的停留时间
-            result_dwell[vessel_id][date][location_indices[location_id]] += dwell
-            
-            # 增加对应位置的计数
-            result_count[vessel_id][date][location_indices[location_id]] += 1
+        vessels, date_list, activity = self.get_vessel_activity(start_date, end_date, vessel_ids, location_ids)
 
         final_result = {}
-        for vessel in result_count.keys():
-            final_result[vessel] = []
-            for date in date_list:
-                counts = result_count[vessel][date]
-                dwells = result_dwell[vessel][date]
-                combined = [(count, dwell) for count, dwell in zip(counts, dwells)]
-                final_result[vessel].append([date, combined])
-            
+        with stage('time_series.build'):
+            for vessel, series in zip(vessels, activity):
+                final_result[vessel] = []
+                for date, day in zip(date_list, series.tolist()):
+                    combined = [(int(count), dwell) for count, dwell in day]
+                    final_result[vessel].append([date, combined])
+
         return final_result
 
     def get_vessel_tsne(self, final_result):
@@ -371,81 +790,161 @@ class Model:
             time_series_data.append(time_series)
             vessels.append(vessel)
         # 转换为 numpy 数组并标准化
-        time_series_data = np.array(time_series_data)
+        return self.embed_vessel_time_series(vessels, np.array(time_series_data))
+
+    def get_vessel_embedding(self, start_date, end_date, vessel_ids, location_ids, metric='dtw', window=None,
+                             window_size=None, max_distance=None, n_jobs=None, progress=None):
+        vessels, _, time_series_data = self.get_vessel_activity(start_date, end_date, vessel_ids, location_ids)
+        # pair distances only depend on the two series, which are normalized on their own,
+        # so they can be reused by any request over the same days and location set
+        key = cache_key(self.get_window_version(start_date, end_date), start_date, end_date,
+                        sorted(set(location_ids)), 'mean_variance', metric, window, window_size, max_distance)
+        return self.embed_vessel_time_series(vessels, time_series_data, metric=metric, window=window,
+                                             window_size=window_size, max_distance=max_distance, n_jobs=n_jobs,
+                                             distance_key=key, progress=progress)
+
+    def embed_vessel_time_series(self, vessels, time_series_data, metric='dtw', window=None, window_size=None,
+                                 max_distance=None, n_jobs=None, distance_key=None, progress=None):
         # 展开二维数据并进行标准化
         n_samples, n_timesteps, n_locations, n_features = time_series_data.shape
         time_series_data = time_series_data.reshape(n_samples, n_timesteps, n_locations * n_features)
-        time_series_data = TimeSeriesScalerMeanVariance().fit_transform(time_series_data)
+        with stage('embedding.normalize'):
+            time_series_data = TimeSeriesScalerMeanVariance().fit_transform(time_series_data)
 
         # 计算时间序列之间的 TW 距离矩阵
-        dtw_distances = cdist_dtw(time_series_data)
-        tsne = TSNE(n_components=2, perplexity=50, random_state=0)
-        transformed_data = tsne.fit_transform(dtw_distances)
-        transformed_data = transformed_data.astype(float).tolist()
-        return json.dumps([[vessel, coord] for vessel, coord in zip(vessels, transformed_data)])
-    
+        engine = dict(metric=metric, window=window, window_size=window_size, max_distance=max_distance, n_jobs=n_jobs)
+        if progress is not None:
+            engine['progress'] = lambda done, total: progress('distances', done, total)
+        with stage('embedding.distances'):
+            if distance_key is None:
+                dtw_distances = distance.cdist(time_series_data, **engine)
+            else:
+                dtw_distances = self.get_vessel_distances(vessels, time_series_data, distance_key, **engine)
+
+        with stage('embedding.tsne'):
+            if progress is None:
+                tsne = TSNE(n_components=2, perplexity=50, random_state=0)
+                transformed_data = tsne.fit_transform(dtw_distances)
+            else:
+                # the verbose optimizer prints every 50 iterations, which doubles as a cancellation checkpoint
+                tsne = TSNE(n_components=2, perplexity=50, random_state=0, verbose=2)
+                progress('embedding', 0, TSNE_MAX_ITER)
+                with redirect_stdout(LogProgress(progress, 'embedding', TSNE_ITERATION_LOG, TSNE_MAX_ITER)):
+                    transformed_data = tsne.fit_transform(dtw_distances)
+                progress('embedding', TSNE_MAX_ITER, TSNE_MAX_ITER)
+        with stage('embedding.serialize'):
+            transformed_data = transformed_data.astype(float).tolist()
+            return json.dumps([[vessel, coord] for vessel, coord in zip(vessels, transformed_data)])
+
+    def get_vessel_distances(self, vessels, time_series_data, distance_key, **engine):
+        distances = self.distance_cache.get(distance_key, vessels).astype(np.float64)
+        missing = np.isnan(distances)
+        if not missing.any():
+            return distances
+
+        if missing.sum() == len(vessels) * (len(vessels) - 1):
+            # nothing cached yet, only the upper triangle needs computing
+            distances = distance.cdist(time_series_data, **engine)
+        else:
+            # cover the missing pairs with as few rows as possible (greedy vertex cover),
+            # so a selection that adds k vessels costs k rows instead of the full matrix
+            remaining = missing.copy()
+            counts = remaining.sum(axis=1)
+            rows = []
+            while counts.max() > 0:
+                row = int(counts.argmax())
+                rows.append(row)
+                counts -= remaining[:, row]
+                counts[row] = 0
+                remaining[:, row] = False
+                remaining[row, :] = False
+            rows = np.array(sorted(rows), dtype=np.intp)
+            columns = np.flatnonzero(missing[rows].any(axis=0))
+            block = distance.cdist(time_series_data[rows], time_series_data[columns], **engine)
+            distances[np.ix_(rows, columns)] = block
+            distances[np.ix_(columns, rows)] = block.T
+
+        self.distance_cache.put(distance_key, vessels, distances)
+        return self.distance_cache.get(distance_key, vessels).astype(np.float64)
+
+    def get_similarity_index(self, start_date, end_date, location_ids, window=SIMILARITY_WINDOW,
+                             window_size=SIMILARITY_WINDOW_SIZE, progress=None):
+        # one index per window holds every vessel active in it, whichever vessel is asked about
+        location_ids = sorted(set(location_ids))
+        key = cache_key(self.get_window_version(start_date, end_date), start_date, end_date, location_ids,
+                        'mean_variance', window, window_size)
+
+        def build():
+            if progress is not None:
+                progress('series', 0, 1)
+            vessels, _, activity = self.get_vessel_activity(
+                start_date, end_date, self.ids.decode(self.activity_cube.vessel_ids).tolist(), location_ids)
+            if progress is not None:
+                progress('series', 1, 1)
+            # envelope blocks double as cancellation checkpoints
+            return SimilarityIndex.from_activity(
+                vessels, activity, window, window_size,
+                progress=None if progress is None else lambda done, total: progress('envelopes', done, total))
+
+        with stage('similarity.index'):
+            return self.similarity_indexes.get(key, build)
+
+    def build_similarity_index(self, start_date, end_date, location_ids, window=SIMILARITY_WINDOW,
+                               window_size=SIMILARITY_WINDOW_SIZE, progress=None):
+        index = self.get_similarity_index(start_date, end_date, location_ids, window, window_size, progress)
+        return json.dumps({'vessels': len(index)})
+
+    def get_similar_vessels(self, vessel_id, start_date, end_date, location_ids, k=10, metric='dtw',
+                            window=SIMILARITY_WINDOW, window_size=SIMILARITY_WINDOW_SIZE):
+        """
+        The k vessels whose activity over the window is nearest to vessel_id's,
+        by the same normalized series and distance as the embedding.  Raises
+        KeyError when vessel_id has no movement in the window.
+        """
+        k = int(k)
+        if k < 1:
+            raise ValueError('k must be a positive integer')
+        index = self.get_similarity_index(start_date, end_date, location_ids, window, window_size)
+        with stage('similarity.query'):
+            neighbors, computed = index.query(vessel_id, k, metric)
+        return {'vessel_id': vessel_id,
+                'neighbors': [{'vessel_id': vessel, 'distance': d} for vessel, d in neighbors],
+                'candidates': max(len(index) - 1, 0),
+                'computed': computed}
+
     def get_aggregate_vessel_movements(self, start_date, end_date, vessel_ids, location_ids):
         # 将start_date和end_date转换为datetime对象
         start = datetime.strptime(start_date, "%Y-%m-%d")
         end = datetime.strptime(end_date, "%Y-%m-%d")
-        
-        # 创建DataFrame
-        df = pd.DataFrame(self.transport_movement_start_end)
-        
-        # 转换时间列为datetime格式
-        df['start_time'] = pd.to_datetime(df['start_time'])
-        df['end_time'] = pd.to_datetime(df['end_time'])
-        
-        # 筛选符合时间范围、船只ID和位置ID的数据
-        filtered_df = df[
-            (df['start_time'] <= end) & 
-            (df['end_time'] >= start) & 
-            (df['vessel_id'].isin(vessel_ids)) & 
-            (df['location_id'].isin(location_ids))
-        ]
-        
-        # 获取所有时间点
-        time_points = pd.concat([filtered_df['start_time'], filtered_df['end_time']]).drop_duplicates().sort_values().reset_index(drop=True)
-        time_points = time_points[time_points <= end]
-        if time_points.iloc[-1] != end:
-            time_points = pd.concat([time_points, pd.Series([end])]).drop_duplicates().sort_values().reset_index(drop=True)
-            
-        time_points = time_points[time_points >= start]
-        if time_points.iloc[0] != start:
-            time_points = pd.concat([pd.Series([start]), time_points]).drop_duplicates().sort_values().reset_index(drop=True)
-
-        
-        
+
+        # 扫描线：每个时间区间内停留船只最多的位置
+        with stage('aggregate.sweep'):
+            # ties go to the smallest location id, the same however the table was built
+            location_names = self.ids.decode(self.interval_table.locations)
+            time_points, busiest = self.interval_table.busiest_locations(start, end, self.ids.encode(vessel_ids),
+                                                                         self.ids.encode(location_ids),
+                                                                         location_names)
+        # -1 (nothing open) picks the trailing None
+        busiest = np.append(location_names, None)[busiest]
+
         aggregated_results = []
-        
-        for i in range(len(time_points) - 1):
-            start_interval = time_points[i]
-            end_interval = time_points[i + 1]
-            
-            # 过滤在当前时间区间内的记录
-            mask = (filtered_df['start_time'] < end_interval) & (filtered_df['end_time'] > start_interval)
-            current_interval = filtered_df[mask]
-            
-            # 计算位置出现次数
-            location_count = current_interval['location_id'].value_counts()
-            
-            if not location_count.empty:
-                max_location = location_count.idxmax()
-            else:
-                max_location = None
-            
+        for i, max_location in enumerate(busiest):
             # 合并连续相同的location_id
             if aggregated_results and aggregated_results[-1]['location_id'] == max_location:
-                aggregated_results[-1]['end_time'] = end_interval.isoformat()
+                aggregated_results[-1]['end_time'] = time_points[i + 1]
             else:
                 aggregated_results.append({
-                    'start_time': start_interval.isoformat(),
-                    'end_time': end_interval.isoformat(),
+                    'start_time': time_points[i],
+                    'end_time': time_points[i + 1],
                     'location_id': max_location,
                     'vessel_id': 'aggregation'
                 })
-        
-        return json.dumps(aggregated_results)
+
+        with stage('aggregate.serialize'):
+            for result in aggregated_results:
+                result['start_time'] = pd.Timestamp(result['start_time']).isoformat()
+                result['end_time'] = pd.Timestamp(result['end_time']).isoformat()
+            return json.dumps(aggregated_results)
     
     """
     to_json is frequently used in outputing pandas DataFrame
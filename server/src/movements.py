@@ -0,0 +1,193 @@
+import heapq
+from collections import defaultdict
+import numpy as np
+import pandas as pd
+
+DAY = np.timedelta64(1, 'D')
+# datetime.max.time() - datetime.min.time(), i.e. 23:59:59.999999
+END_OF_DAY = DAY - np.timedelta64(1, 'us')
+
+
+def split_by_day(start_time, end_time, location_ids, vessel_ids):
+    """
+    Split every [start_time, end_time] stay at midnight in one pass.
+
+    One output row is produced for each calendar day an interval touches, with
+    the seconds spent at the location on that day: the first day runs until
+    23:59:59.999999, full days in between count 86400 and the last day starts
+    at midnight.  Returns a columnar table (date, location_id, vessel_id, dwell).
+    """
+    start = np.asarray(start_time, dtype='datetime64[ns]')
+    end = np.asarray(end_time, dtype='datetime64[ns]')
+    start_day = start.astype('datetime64[D]')
+    end_day = end.astype('datetime64[D]')
+    n_days = np.maximum((end_day - start_day).astype(np.int64) + 1, 0)
+
+    # repeat each interval once per day it covers, then number the copies
+    rows = np.repeat(np.arange(len(start)), n_days)
+    first = np.cumsum(n_days) - n_days
+    offset = np.arange(len(rows)) - np.repeat(first, n_days)
+    is_first = offset == 0
+    is_last = offset == n_days[rows] - 1
+
+    day = (start_day[rows] + offset.astype('timedelta64[D]')).astype('datetime64[ns]')
+    row_start = start[rows]
+    row_end = end[rows]
+
+    dwell = np.full(len(rows), 24 * 3600, dtype=np.float64)
+    dwell = np.where(is_last, _seconds(row_end - day), dwell)
+    dwell = np.where(is_first, _seconds(day + END_OF_DAY - row_start), dwell)
+    dwell = np.where(is_first & is_last, _seconds(row_end - row_start), dwell)
+
+    return pd.DataFrame({
+        'date': np.datetime_as_string(day, unit='D'),
+        # ids keep their dtype, interned codes stay integers
+        'location_id': pd.Series(location_ids).to_numpy()[rows],
+        'vessel_id': pd.Series(vessel_ids).to_numpy()[rows],
+        'dwell': dwell,
+    })
+
+
+def _seconds(delta):
+    # same as Timedelta.total_seconds(): truncate to microseconds, then scale
+    microseconds = delta.astype('timedelta64[ns]').astype(np.int64) // 1000
+    return microseconds / 1e6
+
+
+
+class IntervalTable:
+    """
+    The transport movements as parsed (start, end, vessel, location) arrays,
+    built once: rows are sorted by start time and indexed by vessel, so a
+    selection only touches the intervals of the requested vessels.  Vessels
+    and locations are whatever keys the caller uses, the model passes codes
+    from its IdTable.
+    """
+
+    def __init__(self, movements):
+        df = pd.DataFrame(movements, columns=['start_time', 'end_time', 'vessel_id', 'location_id'])
+        start = pd.to_datetime(df['start_time']).to_numpy(dtype='datetime64[ns]')
+        order = np.argsort(start, kind='stable')
+        # row i of the table is row order[i] of movements
+        self.order = order
+        self.start = start[order]
+        self.end = pd.to_datetime(df['end_time']).to_numpy(dtype='datetime64[ns]')[order]
+        self.vessel_ids = df['vessel_id'].to_numpy()[order]
+        location_codes, self.locations = pd.factorize(df['location_id'].to_numpy()[order])
+        self.location_codes = location_codes.astype(np.int64)
+        self.location_index = {location: code for code, location in enumerate(self.locations)}
+        self.vessel_rows = pd.Series(np.arange(len(order))).groupby(self.vessel_ids).indices
+
+    def __len__(self):
+        return len(self.start)
+
+    def insert(self, movements):
+        """
+        Merge more movements into the table and return the order of the
+        merge: row i of the table is now row order[i] of the old table
+        followed by movements.  Only the new rows are parsed and sorted, the
+        old ones keep their relative order and go before new ones starting
+        at the same time, exactly as if the table was built from both.
+        """
+        df = pd.DataFrame(movements, columns=['start_time', 'end_time', 'vessel_id', 'location_id'])
+        start = pd.to_datetime(df['start_time']).to_numpy(dtype='datetime64[ns]')
+        end = pd.to_datetime(df['end_time']).to_numpy(dtype='datetime64[ns]')
+        new_order = np.argsort(start, kind='stable')
+        n_old, n_new = len(self), len(df)
+        positions = np.searchsorted(self.start, start[new_order], side='right') + np.arange(n_new)
+        is_new = np.zeros(n_old + n_new, dtype=bool)
+        is_new[positions] = True
+        order = np.empty(n_old + n_new, dtype=np.intp)
+        order[positions] = n_old + new_order
+        order[~is_new] = np.arange(n_old)
+
+        locations = df['location_id'].to_numpy()
+        # locations seen for the first time get the next codes, the known ones keep theirs
+        unseen = [location for location in pd.unique(locations) if location not in self.location_index]
+        for location in unseen:
+            self.location_index[location] = len(self.location_index)
+        self.locations = np.concatenate([self.locations, np.array(unseen, dtype=self.locations.dtype)])
+        location_codes = np.array([self.location_index[location] for location in locations], dtype=np.int64)
+
+        self.start = np.concatenate([self.start, start])[order]
+        self.end = np.concatenate([self.end, end])[order]
+        self.vessel_ids = np.concatenate([self.vessel_ids, df['vessel_id'].to_numpy()])[order]
+        self.location_codes = np.concatenate([self.location_codes, location_codes])[order]
+        self.vessel_rows = pd.Series(np.arange(len(order))).groupby(self.vessel_ids).indices
+        return order
+
+    def select(self, start, end, vessel_ids, location_ids):
+        """
+        Rows overlapping [start, end] for the given vessels and locations, in
+        start order.  None for any of them leaves that side unrestricted.
+        """
+        if vessel_ids is None:
+            rows = np.arange(len(self), dtype=np.intp)
+        else:
+            rows = [self.vessel_rows[vessel] for vessel in set(vessel_ids) if vessel in self.vessel_rows]
+            if not rows:
+                return np.array([], dtype=np.intp)
+            rows = np.sort(np.concatenate(rows))
+        mask = np.ones(len(rows), dtype=bool)
+        if start is not None:
+            mask &= self.end[rows] >= start
+        if end is not None:
+            mask &= self.start[rows] <= end
+        if location_ids is not None:
+            locations = [self.location_index[location] for location in set(location_ids)
+                         if location in self.location_index]
+            mask &= np.isin(self.location_codes[rows], locations)
+        return rows[mask]
+
+    def busiest_locations(self, start, end, vessel_ids, location_ids, keys=None):
+        """
+        Sweep [start, end] and return (time_points, location codes): between
+        time_points[i] and time_points[i + 1] the location with most open
+        intervals is codes[i], -1 when none is open.  Equally busy locations
+        go to the smallest of keys[code] (the locations themselves by
+        default), codes depend on the order rows were added in.  Intervals
+        open and close as events on a running count, the current maximum
+        comes from a lazy heap, so the sweep is O((N + T) log N).
+        """
+        keys = self.locations if keys is None else np.asarray(keys)
+        rank = np.empty(len(keys), dtype=np.int64)
+        rank[np.argsort(keys, kind='stable')] = np.arange(len(keys))
+        start = np.datetime64(start, 'ns')
+        end = np.datetime64(end, 'ns')
+        rows = self.select(start, end, vessel_ids, location_ids)
+        starts, ends, locations = self.start[rows], self.end[rows], self.location_codes[rows]
+
+        # every start / end inside the window is a time point, plus the window itself
+        time_points = np.unique(np.concatenate([starts, ends]))
+        time_points = time_points[(time_points > start) & (time_points < end)]
+        time_points = np.concatenate([[start], time_points, [end]]) if end > start else np.array([start])
+
+        # an interval is open from the time point at its (clipped) start up to the one at its end
+        opens = np.searchsorted(time_points, np.maximum(starts, start))
+        closes = np.searchsorted(time_points, np.minimum(ends, end))
+        active = opens < closes
+        opens, closes, locations = opens[active], closes[active], locations[active]
+        open_order = np.argsort(opens, kind='stable')
+        close_order = np.argsort(closes, kind='stable')
+
+        counts = defaultdict(int)
+        heap = []
+        busiest = np.full(max(len(time_points) - 1, 0), -1, dtype=np.int64)
+        next_open = next_close = 0
+        for i in range(len(busiest)):
+            while next_close < len(close_order) and closes[close_order[next_close]] == i:
+                location = locations[close_order[next_close]]
+                counts[location] -= 1
+                heapq.heappush(heap, (-counts[location], rank[location], location))
+                next_close += 1
+            while next_open < len(open_order) and opens[open_order[next_open]] == i:
+                location = locations[open_order[next_open]]
+                counts[location] += 1
+                heapq.heappush(heap, (-counts[location], rank[location], location))
+                next_open += 1
+            # drop entries pushed before the count of their location changed
+            while heap and (heap[0][0] != -counts[heap[0][2]] or counts[heap[0][2]] == 0):
+                heapq.heappop(heap)
+            if heap:
+                busiest[i] = heap[0][2]
+        return time_points, busiest
@@ -0,0 +1,50 @@
+import json
+import base64
+import numpy as np
+
+DEFAULT_PAGE_SIZE = 1000
+MAX_PAGE_SIZE = 10000
+
+
+class PaginationError(ValueError):
+    pass
+
+
+def encode_cursor(version, position):
+    payload = json.dumps({'v': version, 'after': int(position)}).encode()
+    return base64.urlsafe_b64encode(payload).decode()
+
+
+def decode_cursor(cursor, version):
+    """Row position the cursor points after, -1 for the first page."""
+    if cursor is None:
+        return -1
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        position = int(payload['after'])
+    except (ValueError, TypeError, KeyError, AttributeError):
+        raise PaginationError('malformed cursor')
+    if payload.get('v') != version:
+        # the rows were rebuilt since, positions no longer mean the same thing
+        raise PaginationError('cursor expired, the data changed since the first page')
+    return position
+
+
+def paginate(rows, cursor, limit, version):
+    """
+    Keyset pagination over rows, the sorted positions of the matching rows
+    in a table.  Returns (page rows, next cursor or None); the cursor holds
+    the last position returned, so a page costs a binary search.
+    """
+    try:
+        limit = DEFAULT_PAGE_SIZE if limit is None else int(limit)
+    except (ValueError, TypeError):
+        raise PaginationError('limit must be an integer')
+    if limit <= 0:
+        raise PaginationError('limit must be positive')
+    limit = min(limit, MAX_PAGE_SIZE)
+    rows = np.asarray(rows)
+    start = np.searchsorted(rows, decode_cursor(cursor, version), side='right')
+    page = rows[start:start + limit]
+    next_cursor = encode_cursor(version, page[-1]) if start + limit < len(rows) else None
+    return page, next_cursor
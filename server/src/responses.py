@@ -0,0 +1,122 @@
+import gzip
+import json
+import functools
+from flask import request, Response
+from src.distance_cache import cache_key
+from src.metrics import stage
+
+# optional encoders, each one is only offered when its package is installed
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MIMETYPE_JSON = 'application/json'
+MIMETYPE_MSGPACK = 'application/x-msgpack'
+MIMETYPE_ARROW = 'application/vnd.apache.arrow.stream'
+# smaller bodies are not worth the compression overhead
+MIN_COMPRESSED_SIZE = 1024
+
+
+def available_mimetypes():
+    # json first, so that */* keeps getting json
+    return [MIMETYPE_JSON] + ([MIMETYPE_MSGPACK] if msgpack else []) + ([MIMETYPE_ARROW] if pyarrow else [])
+
+
+def available_encodings():
+    return (['br'] if brotli else []) + ['gzip']
+
+
+def request_params():
+    """The request as the view sees it: path, query string and (parsed) body."""
+    body = request.get_data(as_text=True)
+    try:
+        body = json.loads(body) if body else None
+    except ValueError:
+        pass
+    return [request.path, request.args.to_dict(flat=False), body]
+
+
+def _arrow_table(data):
+    # records become the rows, the other members of a paginated result go to the schema metadata
+    metadata = None
+    if isinstance(data, dict) and isinstance(data.get('items'), list):
+        metadata = {key: json.dumps(value) for key, value in data.items() if key != 'items'}
+        data = data['items']
+    if not isinstance(data, list) or not all(isinstance(item, dict) for item in data):
+        return None
+    return pyarrow.Table.from_pylist(data, metadata=metadata)
+
+
+def encode(result, mimetype):
+    """(body bytes, mimetype) for a view result, either JSON text or JSON-able data."""
+    if mimetype == MIMETYPE_JSON:
+        return (result if isinstance(result, str) else json.dumps(result)).encode(), MIMETYPE_JSON
+    data = json.loads(result) if isinstance(result, str) else result
+    if mimetype == MIMETYPE_MSGPACK:
+        return msgpack.packb(data), MIMETYPE_MSGPACK
+    table = _arrow_table(data)
+    if table is None:
+        # not tabular, e.g. t-SNE [vessel, [x, y]] pairs
+        return encode(result, MIMETYPE_JSON)
+    sink = pyarrow.BufferOutputStream()
+    with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes(), MIMETYPE_ARROW
+
+
+def compress(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body, quality=5)
+    return gzip.compress(body, compresslevel=6)
+
+
+def negotiated(version):
+    """
+    Decorator for views that return JSON text or JSON-able data.
+
+    The body is encoded as JSON, MessagePack or an Arrow IPC stream, whichever
+    Accept prefers, and compressed with brotli or gzip as Accept-Encoding
+    allows.  The ETag hashes the request parameters, version() and the chosen
+    representation, so it is known before the view runs: a request whose
+    If-None-Match still matches gets a 304 without computing anything.
+    (body, status) results other than 200 are passed through as they are.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            mimetype = request.accept_mimetypes.best_match(available_mimetypes(), default=MIMETYPE_JSON)
+            encoding = request.accept_encodings.best_match(available_encodings())
+            etag = cache_key(request_params(), version(), mimetype, encoding)
+            headers = {'Vary': 'Accept, Accept-Encoding', 'Cache-Control': 'no-cache'}
+
+            if request.if_none_match.contains_weak(etag):
+                response = Response(status=304, headers=headers)
+                response.set_etag(etag)
+                return response
+
+            result = view(*args, **kwargs)
+            if isinstance(result, tuple):
+                result, status = result
+                if status != 200:
+                    return result, status
+
+            with stage('response.encode'):
+                body, mimetype = encode(result, mimetype)
+            if encoding is not None and len(body) >= MIN_COMPRESSED_SIZE:
+                with stage('response.compress'):
+                    body = compress(body, encoding)
+                headers['Content-Encoding'] = encoding
+            response = Response(body, mimetype=mimetype, headers=headers)
+            response.set_etag(etag)
+            return response
+        return wrapper
+    return decorator
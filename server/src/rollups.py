@@ -0,0 +1,117 @@
+import numpy as np
+import pandas as pd
+
+RESOLUTIONS = ('day', 'week', 'month')
+KEYS = ['bin', 'entity', 'location']
+EPOCH = np.datetime64('1970-01-01', 'D')
+
+
+def bin_start(days, resolution):
+    """First day of the day / week (Monday) / month bin of every datetime64[D] day."""
+    days = np.asarray(days, dtype='datetime64[D]')
+    if resolution == 'day':
+        return days
+    if resolution == 'week':
+        # 1970-01-01 was a Thursday, three days after a Monday
+        return days - ((days.astype(np.int64) + 3) % 7).astype('timedelta64[D]')
+    if resolution == 'month':
+        return days.astype('datetime64[M]').astype('datetime64[D]')
+    raise ValueError(f'unknown resolution: {resolution}, expected one of {RESOLUTIONS}')
+
+
+def bin_starts(start, end, resolution):
+    """Starts of the bins touching [start, end], plus the start of the bin after the last."""
+    first, last = bin_start([start, end], resolution)
+    if resolution == 'month':
+        months = np.arange(first.astype('datetime64[M]'), last.astype('datetime64[M]') + 2)
+        return months.astype('datetime64[D]')
+    step = 7 if resolution == 'week' else 1
+    return np.arange(first, last + step + 1, step)
+
+
+class Rollup:
+    """
+    Sums of some measures per (entity, location, bin) at day, week and month
+    resolution, built once from day-level records.  Each level is a sparse
+    table sorted by bin, so a range query reads the whole bins inside the
+    range from its own level and only the partial bins at either end from
+    the day level.  Entities and locations are whatever keys the caller
+    uses, the model passes codes from its IdTable.
+    """
+
+    def __init__(self, measures, levels):
+        self.measures = list(measures)
+        self.levels = levels
+
+    @staticmethod
+    def _floor(bins, resolution):
+        # bins are stored as days since the epoch
+        return (bin_start(EPOCH + bins.astype('timedelta64[D]'), resolution) - EPOCH).astype(np.int64)
+
+    @classmethod
+    def from_records(cls, days, entities, locations, **measures):
+        days = (np.asarray(days, dtype='datetime64[D]') - EPOCH).astype(np.int64)
+        frame = pd.DataFrame({'bin': days, 'entity': entities, 'location': locations, **measures})
+        # e.g. the zero seconds of a stay ending at midnight, not worth a row
+        frame = frame[(frame[list(measures)] != 0).any(axis=1)]
+        days = frame.groupby(KEYS, sort=True, as_index=False).sum()
+        # weeks straddle months, so both coarser levels sum the days, already much fewer rows than the records
+        levels = {resolution: days.assign(bin=cls._floor(days['bin'].to_numpy(), resolution))
+                  .groupby(KEYS, sort=True, as_index=False).sum() for resolution in RESOLUTIONS[1:]}
+        levels[RESOLUTIONS[0]] = days
+        return cls(measures, levels)
+
+    def pick(self, start, end, bins=None):
+        """The finest resolution with at most bins bins over [start, end], month when none fits."""
+        if bins is None:
+            return RESOLUTIONS[0]
+        for resolution in RESOLUTIONS:
+            if len(bin_starts(start, end, resolution)) - 1 <= bins:
+                return resolution
+        return RESOLUTIONS[-1]
+
+    def _rows(self, resolution, first, last):
+        # rows of a level whose bin starts within [first, last]
+        level = self.levels[resolution]
+        bins = level['bin'].to_numpy()
+        first, last = (np.array([first, last], dtype='datetime64[D]') - EPOCH).astype(np.int64)
+        return level.iloc[np.searchsorted(bins, first, side='left'):np.searchsorted(bins, last, side='right')]
+
+    def query(self, start_date, end_date, bins=None, resolution=None, entities=None, locations=None):
+        """
+        Return (resolution, bin edges, frame) for [start_date, end_date]:
+        edges holds the (first, last) day of every bin clipped to the range,
+        and the frame one row per non-empty (bin index, entity, location)
+        with the summed measures.  None for entities or locations leaves
+        that side unrestricted.
+        """
+        start = np.datetime64(start_date, 'D')
+        end = np.datetime64(end_date, 'D')
+        resolution = resolution or self.pick(start, end, bins)
+        if resolution not in RESOLUTIONS:
+            raise ValueError(f'unknown resolution: {resolution}, expected one of {RESOLUTIONS}')
+        if end < start:
+            return resolution, [], self.levels['day'].iloc[:0].reset_index(drop=True)
+        starts = bin_starts(start, end, resolution)
+        edges = [(max(first, start), min(following - 1, end)) for first, following in zip(starts[:-1], starts[1:])]
+        # whole bins come from the level itself, the clipped ones at either end from the days
+        whole = [i for i, (first, following) in enumerate(zip(starts[:-1], starts[1:]))
+                 if first >= start and following - 1 <= end]
+        if whole:
+            parts = [self._rows('day', start, starts[whole[0]] - 1),
+                     self._rows(resolution, starts[whole[0]], starts[whole[-1]]),
+                     self._rows('day', starts[whole[-1] + 1], end)]
+        else:
+            parts = [self._rows('day', start, end)]
+        frame = pd.concat(parts, ignore_index=True)
+        if entities is not None:
+            frame = frame[frame['entity'].isin(entities)]
+        if locations is not None:
+            frame = frame[frame['location'].isin(locations)]
+        frame = frame.assign(bin=np.searchsorted((starts - EPOCH).astype(np.int64),
+                                                 self._floor(frame['bin'].to_numpy(), resolution)))
+        if resolution != 'day':
+            # the clipped bins are still one row per day
+            frame = frame.groupby(KEYS, sort=True, as_index=False).sum()
+        edges = [(str(first), str(last)) for first, last in edges]
+        return resolution, edges, frame.reset_index(drop=True)
@@ -0,0 +1,126 @@
+import os
+import threading
+from contextlib import contextmanager
+
+
+class WorkerState:
+    """
+    Requests in flight and served by this process, and whether it is
+    draining: a draining worker has stopped accepting connections and only
+    finishes what it has, so it reports itself as not ready.
+    """
+
+    def __init__(self):
+        self.draining = False
+        self.served = 0
+        self.in_flight = 0
+        self._idle = threading.Condition()
+
+    @property
+    def ready(self):
+        return not self.draining
+
+    def start_request(self):
+        with self._idle:
+            self.in_flight += 1
+            self.served += 1
+            return self.served
+
+    def end_request(self):
+        with self._idle:
+            self.in_flight -= 1
+            if self.in_flight == 0:
+                self._idle.notify_all()
+
+    def wait_idle(self, timeout):
+        """True once nothing is in flight, False if timeout seconds pass first."""
+        with self._idle:
+            return self._idle.wait_for(lambda: self.in_flight == 0, timeout)
+
+
+worker_state = WorkerState()
+
+
+class ReadWriteLock:
+    """
+    Shared by the requests reading the model, exclusive for the ingestion
+    changing it.  A waiting writer goes before new readers, so a steady
+    stream of requests cannot hold ingestion off.  Not reentrant: a thread
+    holding the read side must not ask for the write side.
+    """
+
+    def __init__(self):
+        self._reset()
+        # a fork may happen while request threads hold the read side, the child starts unlocked
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._condition = threading.Condition()
+        self._readers = 0
+        self._writing = False
+        self._writers_waiting = 0
+
+    def _readable(self):
+        return not self._writing and not self._writers_waiting
+
+    def acquire_read(self, blocking=True):
+        """Take the read side, or only when it is free right now with blocking=False; True when taken."""
+        with self._condition:
+            if blocking:
+                self._condition.wait_for(self._readable)
+            elif not self._readable():
+                return False
+            self._readers += 1
+            return True
+
+    def release_read(self):
+        with self._condition:
+            self._readers -= 1
+            if self._readers == 0:
+                self._condition.notify_all()
+
+    def acquire_write(self):
+        with self._condition:
+            self._writers_waiting += 1
+            try:
+                self._condition.wait_for(lambda: not self._writing and self._readers == 0)
+            finally:
+                self._writers_waiting -= 1
+            self._writing = True
+
+    def release_write(self):
+        with self._condition:
+            self._writing = False
+            self._condition.notify_all()
+
+    @contextmanager
+    def writing(self):
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
+
+
+class CountingMiddleware:
+    """WSGI middleware keeping worker_state up to date, on_request(served) is called as each request starts."""
+
+    def __init__(self, app, state=worker_state, on_request=None):
+        self.app = app
+        self.state = state
+        self.on_request = on_request
+
+    def __call__(self, environ, start_response):
+        served = self.state.start_request()
+        if self.on_request is not None:
+            self.on_request(served)
+        iterable = None
+        try:
+            # iterated here, so a streamed body still counts as in flight until it is sent
+            iterable = self.app(environ, start_response)
+            yield from iterable
+        finally:
+            # Flask tears the request down in close()
+            if hasattr(iterable, 'close'):
+                iterable.close()
+            self.state.end_request()
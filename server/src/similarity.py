@@ -0,0 +1,161 @@
+import os
+import json
+import threading
+from collections import OrderedDict
+import numpy as np
+from tslearn.preprocessing import TimeSeriesScalerMeanVariance
+from src import distance
+
+FILE_INDEX_META = '{key}.json'
+FILE_INDEX_ARRAY = '{key}.{name}.npy'
+INDEX_ARRAYS = ('series', 'upper', 'lower')
+# bump whenever the saved layout changes, older indexes are rebuilt
+INDEX_FORMAT = 1
+DEFAULT_MAX_LOADED = 4
+DEFAULT_MAX_SAVED = 32
+
+
+class SimilarityIndex:
+    """
+    The normalized activity series of every vessel active in one window,
+    with their LB_Keogh envelopes for the DTW band, built in one linear pass.
+    A query only bounds the other vessels against the query vessel and runs
+    exact DTW on the few whose bound can still beat the k-th best, instead
+    of the full pairwise matrix an embedding needs.
+    """
+
+    def __init__(self, vessels, series, upper, lower, window=None, window_size=None):
+        self.vessels = list(vessels)
+        self.vessel_index = {vessel: i for i, vessel in enumerate(self.vessels)}
+        self.series = series
+        self.upper = upper
+        self.lower = lower
+        self.window = window
+        self.window_size = window_size
+        self.lo, self.hi = distance.band(series.shape[1], window, window_size)
+
+    def __len__(self):
+        return len(self.vessels)
+
+    @classmethod
+    def from_activity(cls, vessels, activity, window=None, window_size=None, progress=None):
+        # (vessels, days, locations, 2) -> (vessels, days, features), normalized per vessel as for the embedding
+        n_samples, n_timesteps, n_locations, n_features = activity.shape
+        series = activity.reshape(n_samples, n_timesteps, n_locations * n_features)
+        if n_samples:
+            series = TimeSeriesScalerMeanVariance().fit_transform(series)
+        series = np.ascontiguousarray(series, dtype=np.float64)
+        lo, hi = distance.band(n_timesteps, window, window_size)
+        upper, lower = distance.envelopes(series, lo, hi, progress=progress)
+        return cls(vessels, series, upper, lower, window, window_size)
+
+    def query(self, vessel, k, metric='dtw'):
+        """
+        The k vessels nearest to vessel, as ([(vessel, distance)], number of
+        exact distances computed).  Raises KeyError for a vessel that is not
+        active in the window.
+        """
+        row = self.vessel_index[vessel]
+        k = min(k, len(self) - 1)
+        if k <= 0:
+            return [], 0
+        if metric == 'euclidean':
+            flat = self.series.reshape(len(self), -1)
+            distances = np.sqrt(((flat - flat[row]) ** 2).sum(axis=1))
+            distances[row] = np.inf
+            rows = np.argsort(distances, kind='stable')[:k]
+            distances, computed = distances[rows], len(self) - 1
+        elif metric == 'dtw':
+            rows, distances, computed = distance.nearest(self.series[row], self.series, k, self.lo, self.hi,
+                                                         self.upper, self.lower, exclude=row)
+        else:
+            raise ValueError(f'unknown metric: {metric}, expected one of {distance.METRICS}')
+        return [(self.vessels[i], float(d)) for i, d in zip(rows.tolist(), distances.tolist())], computed
+
+    def save(self, folder, key):
+        os.makedirs(folder, exist_ok=True)
+        for name in INDEX_ARRAYS:
+            path = os.path.join(folder, FILE_INDEX_ARRAY.format(key=key, name=name))
+            # write aside and rename, readers in other processes never see half a file
+            np.save(path + '.tmp.npy', getattr(self, name))
+            os.replace(path + '.tmp.npy', path)
+        # the meta file goes last and marks the index complete
+        path = os.path.join(folder, FILE_INDEX_META.format(key=key))
+        with open(path + '.tmp', 'w') as file:
+            json.dump({'format': INDEX_FORMAT, 'vessels': self.vessels, 'window': self.window,
+                       'window_size': self.window_size}, file)
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, folder, key, mmap_mode='r'):
+        """Open a saved index memory mapped, so that every worker shares the same pages; None when missing."""
+        try:
+            with open(os.path.join(folder, FILE_INDEX_META.format(key=key)), 'r') as file:
+                meta = json.load(file)
+            if meta.get('format') != INDEX_FORMAT:
+                return None
+            arrays = [np.load(os.path.join(folder, FILE_INDEX_ARRAY.format(key=key, name=name)), mmap_mode=mmap_mode)
+                      for name in INDEX_ARRAYS]
+        except (OSError, ValueError, KeyError):
+            return None
+        if any(array.shape[0] != len(meta['vessels']) for array in arrays):
+            # caught between the renames of a concurrent writer
+            return None
+        return cls(meta['vessels'], *arrays, meta['window'], meta['window_size'])
+
+
+class SimilarityIndexStore:
+    """
+    Similarity indexes per window key, the most recent max_loaded kept open
+    and every built one saved to folder, where other workers, jobs and later
+    runs pick it up; only the max_saved most recently used are kept on disk.
+    """
+
+    def __init__(self, folder, max_loaded=DEFAULT_MAX_LOADED, max_saved=DEFAULT_MAX_SAVED):
+        self.folder = folder
+        self.max_loaded = max_loaded
+        self.max_saved = max_saved
+        self._indexes = OrderedDict()
+        self._lock = threading.Lock()
+        os.register_at_fork(after_in_child=self._reset_lock)
+
+    def _reset_lock(self):
+        self._lock = threading.Lock()
+
+    def get(self, key, build):
+        """The index saved under key, calling build() and saving its result when there is none."""
+        with self._lock:
+            index = self._indexes.get(key)
+            if index is not None:
+                self._indexes.move_to_end(key)
+                return index
+        index = SimilarityIndex.load(self.folder, key)
+        if index is None:
+            index = build()
+            try:
+                index.save(self.folder, key)
+                self._prune()
+                # reopen memory mapped so that every worker process shares one copy
+                index = SimilarityIndex.load(self.folder, key) or index
+            except OSError as e:
+                print(f'could not cache the similarity index because {e}')
+        else:
+            # touch the meta file so that pruning sees it as recently used
+            os.utime(os.path.join(self.folder, FILE_INDEX_META.format(key=key)))
+        with self._lock:
+            self._indexes[key] = index
+            self._indexes.move_to_end(key)
+            while len(self._indexes) > self.max_loaded:
+                self._indexes.popitem(last=False)
+        return index
+
+    def _prune(self):
+        suffix = FILE_INDEX_META.format(key='')
+        entries = sorted((os.stat(os.path.join(self.folder, file_name)).st_mtime, file_name[:-len(suffix)])
+                         for file_name in os.listdir(self.folder) if file_name.endswith(suffix))
+        for _, key in entries[:-self.max_saved]:
+            for path in [FILE_INDEX_META.format(key=key)] + [FILE_INDEX_ARRAY.format(key=key, name=name)
+                                                           for name in INDEX_ARRAYS]:
+                path = os.path.join(self.folder, path)
+                if os.path.exists(path):
+                    os.remove(path)
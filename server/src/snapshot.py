@@ -0,0 +1,138 @@
+import os
+import json
+import shutil
+import numpy as np
+import pandas as pd
+
+# bump whenever the layout below or the tables stored in it change shape
+SNAPSHOT_FORMAT = 4
+FILE_META = 'meta.json'
+
+# how a missing value was spelled in an object column
+PRESENT, NONE, NAN = 0, 1, 2
+
+
+def _missing(value):
+    if value is None:
+        return NONE
+    if isinstance(value, float) and value != value:
+        return NAN
+    return PRESENT
+
+
+def _json_default(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def _encode(series):
+    """(codec, {suffix: array}) for one column."""
+    values = series.to_numpy()
+    if values.dtype.kind in 'biufcmM':
+        return 'array', {'values': values}
+
+    nulls = np.fromiter((_missing(value) for value in values), dtype=np.int8, count=len(values))
+    if all(isinstance(value, str) for value, null in zip(values, nulls) if null == PRESENT):
+        # dictionary encoded: each distinct string once, plus an int32 code per row
+        codes, uniques = pd.factorize(values)
+        return 'str', dict(_pack([value.encode() for value in uniques]), codes=codes.astype(np.int32), nulls=nulls)
+    # anything else as JSON text, one entry per row
+    chunks = [json.dumps(value, default=_json_default).encode() if null == PRESENT else b''
+              for value, null in zip(values, nulls)]
+    return 'json', dict(_pack(chunks), nulls=nulls)
+
+
+def _pack(chunks):
+    """Byte strings as one UTF-8 buffer plus offsets."""
+    offsets = np.zeros(len(chunks) + 1, dtype=np.int64)
+    np.cumsum([len(chunk) for chunk in chunks], out=offsets[1:])
+    return {'data': np.frombuffer(b''.join(chunks), dtype=np.uint8), 'offsets': offsets}
+
+
+def _unpack(arrays):
+    data = arrays['data'].tobytes()
+    offsets = arrays['offsets'].tolist()
+    return [data[offsets[i]:offsets[i + 1]].decode() for i in range(len(offsets) - 1)]
+
+
+def _decode(codec, arrays):
+    if codec == 'array':
+        return arrays['values']
+    nulls = np.asarray(arrays['nulls'])
+    if codec == 'str':
+        # code -1 (a missing value) picks the trailing None
+        values = np.array(_unpack(arrays) + [None], dtype=object)[np.asarray(arrays['codes'], dtype=np.intp)]
+    else:
+        texts = _unpack(arrays)
+        values = np.empty(len(texts), dtype=object)
+        # filled one by one, lists of equal length would otherwise become a 2d array
+        for i, text in enumerate(texts):
+            values[i] = json.loads(text) if text else None
+    values[nulls == NONE] = None
+    values[nulls == NAN] = np.nan
+    return values
+
+
+class Snapshot:
+    """
+    Named DataFrames saved column by column as .npy files under one folder,
+    together with the version of the sources they were derived from.
+    Numeric and datetime columns are memory mapped on load, string columns
+    are dictionary encoded and other object columns are stored as JSON text.
+    The index is not kept, frames come back with a RangeIndex.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+
+    def load(self, version, mmap_mode='r'):
+        """{name: DataFrame}, or None when there is no snapshot of this version."""
+        try:
+            with open(os.path.join(self.folder, FILE_META), 'r') as file:
+                meta = json.load(file)
+            if meta['format'] != SNAPSHOT_FORMAT or meta['version'] != version:
+                return None
+            frames = {}
+            for name, frame in meta['frames'].items():
+                folder = os.path.join(self.folder, frame['folder'])
+                columns = {}
+                for i, column in enumerate(frame['columns']):
+                    arrays = {suffix: np.load(os.path.join(folder, f'c{i}.{suffix}.npy'), mmap_mode=mmap_mode)
+                              for suffix in column['arrays']}
+                    columns[column['name']] = _decode(column['codec'], arrays)
+                frames[name] = pd.DataFrame(columns, index=pd.RangeIndex(frame['length']), copy=False)
+            return frames
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def save(self, version, frames):
+        # write next to the snapshot and swap it in, so a reader never sees half of one
+        staging = f'{self.folder}.{os.getpid()}.tmp'
+        shutil.rmtree(staging, ignore_errors=True)
+        os.makedirs(staging)
+        meta = {'format': SNAPSHOT_FORMAT, 'version': version, 'frames': {}}
+        for n, (name, frame) in enumerate(frames.items()):
+            folder = f'f{n}'
+            os.makedirs(os.path.join(staging, folder))
+            columns = []
+            for i, column in enumerate(frame.columns):
+                codec, arrays = _encode(frame[column])
+                for suffix, array in arrays.items():
+                    np.save(os.path.join(staging, folder, f'c{i}.{suffix}.npy'), array, allow_pickle=False)
+                columns.append({'name': column, 'codec': codec, 'arrays': list(arrays)})
+            meta['frames'][name] = {'folder': folder, 'length': len(frame), 'columns': columns}
+        with open(os.path.join(staging, FILE_META), 'w') as file:
+            json.dump(meta, file)
+
+        retired = f'{self.folder}.{os.getpid()}.old'
+        if os.path.exists(self.folder):
+            os.rename(self.folder, retired)
+        try:
+            os.rename(staging, self.folder)
+        except OSError:
+            # another process swapped its own snapshot in first
+            shutil.rmtree(staging, ignore_errors=True)
+        shutil.rmtree(retired, ignore_errors=True)
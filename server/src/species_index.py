@@ -0,0 +1,29 @@
+from collections import defaultdict
+import numpy as np
+
+
+class SpeciesIndex:
+    """
+    Inverted index of the regions' fish_species_present: species name ->
+    the regions where it is present, in region order, built in one pass so
+    that matching a commodity to its fishing regions is a dict lookup.  A
+    region listing its species as one string is matched by substring, as
+    the original per-commodity scan did.
+    """
+
+    def __init__(self, region_ids, species_present):
+        self.regions = defaultdict(list)
+        self.texts = []
+        for position, (region, present) in enumerate(zip(region_ids, species_present)):
+            if isinstance(present, str):
+                self.texts.append((position, region, present))
+            elif isinstance(present, (list, tuple, np.ndarray)):
+                for species in dict.fromkeys(present):
+                    self.regions[species].append((position, region))
+
+    def lookup(self, species):
+        matches = self.regions.get(species, [])
+        if self.texts:
+            # rare, keep the region order across both kinds
+            matches = sorted(matches + [(position, region) for position, region, text in self.texts if species in text])
+        return [region for _, region in matches]
@@ -0,0 +1,142 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+
+# counts at scale 1, roughly the shape of the VAST 2024 MC2 graph
+BASE_COUNTS = {
+    'vessels': 100,
+    'cities': 6,
+    'points': 18,
+    'regions': 6,
+    'commodities': 20,
+    'pings': 25000,
+    'documents': 2500,
+    'harbor_reports': 2500,
+}
+# the geography and the catalogue of species do not grow with the traffic
+FIXED_COUNTS = ('cities', 'points', 'regions', 'commodities')
+START_DATE = '2035-02-01'
+DAYS = 180
+
+VESSEL_TYPES = ['Entity.Vessel.FishingVessel', 'Entity.Vessel.CargoVessel', 'Entity.Vessel.Tour',
+                'Entity.Vessel.Other', 'Entity.Vessel.Research', 'Entity.Vessel.Ferry.Passenger',
+                'Entity.Vessel.Ferry.Cargo']
+# most of the fleet fishes, like in the real data
+VESSEL_TYPE_WEIGHTS = [0.7, 0.1, 0.05, 0.05, 0.03, 0.04, 0.03]
+
+
+def scaled_counts(scale=1, **counts):
+    """BASE_COUNTS with the traffic multiplied by scale, explicit counts win."""
+    result = {key: value if key in FIXED_COUNTS else max(int(round(value * scale)), 1)
+              for key, value in BASE_COUNTS.items()}
+    result.update({key: value for key, value in counts.items() if value is not None})
+    return result
+
+
+def _times(rng, n, start, days):
+    seconds = rng.integers(0, days * 86400, n)
+    micro = np.where(rng.random(n) < 0.1, rng.integers(1, 1000000, n), 0)
+    times = np.datetime64(start, 'us') + seconds.astype('timedelta64[s]') + micro.astype('timedelta64[us]')
+    # pings come both with and without fractional seconds, as in mc2.json
+    return pd.DatetimeIndex(times), micro > 0
+
+
+def _write_array(file, records):
+    file.write('[')
+    for i, record in enumerate(records):
+        if i:
+            file.write(',\n')
+        file.write(json.dumps(record))
+    file.write(']')
+
+
+def generate(folder, scale=1, seed=0, start_date=START_DATE, days=DAYS, **counts):
+    """
+    Write an MC2-shaped mc2.json and the matching transportMovements.json
+    into folder and return the counts used.  The same arguments always give
+    the same files.  Records are written one at a time, so large scales do
+    not need the whole graph in memory as dicts.
+    """
+    counts = scaled_counts(scale, **counts)
+    rng = np.random.default_rng(seed)
+    os.makedirs(folder, exist_ok=True)
+
+    species = [f'Species {i}' for i in range(counts['commodities'])]
+    commodities = [f'gadusnspecies{i}' for i in range(counts['commodities'])]
+    vessels = [f'vessel{i}' for i in range(counts['vessels'])]
+    cities = [f'City of Port {i}' for i in range(counts['cities'])]
+    points = [f'Nav {i}' for i in range(counts['points'])]
+    regions = [f'Region {i}' for i in range(counts['regions'])]
+    locations = np.array(cities + points + regions, dtype=object)
+    documents = [f'cargo_{i}' for i in range(counts['documents'])]
+    vessel_types = rng.choice(VESSEL_TYPES, counts['vessels'], p=VESSEL_TYPE_WEIGHTS)
+
+    def nodes():
+        for commodity, name in zip(commodities, species):
+            yield {'type': 'Entity.Commodity.Fish', 'name': name, 'id': commodity}
+        for vessel, vessel_type in zip(vessels, vessel_types):
+            yield {'type': str(vessel_type), 'Name': vessel.title(), 'tonnage': int(rng.integers(100, 20000)),
+                   'flag_country': 'Oceanus', 'company': None, 'length_overall': int(rng.integers(10, 200)),
+                   'id': vessel}
+        for city in cities:
+            yield {'type': 'Entity.Location.City', 'Name': city, 'Activities': ['Commercial fishing'], 'id': city}
+        for point in points:
+            yield {'type': 'Entity.Location.Point', 'Name': point, 'Activities': [], 'id': point}
+        for region in regions:
+            present = rng.choice(species, min(3, len(species)), replace=False).tolist()
+            yield {'type': 'Entity.Location.Region', 'Name': region, 'Activities': ['Fishing ground'],
+                   'fish_species_present': present, 'id': region}
+        for document, date, qty_tons in zip(documents, document_dates.strftime('%Y-%m-%d'), qty):
+            yield {'type': 'Entity.Document.DeliveryReport', 'date': date, 'qty_tons': float(qty_tons), 'id': document}
+
+    # pings: a vessel dwells at a location, most stays are short, a few last days
+    ping_times, fractional = _times(rng, counts['pings'], start_date, days)
+    ping_vessels = rng.integers(0, counts['vessels'], counts['pings'])
+    ping_locations = rng.integers(0, len(locations), counts['pings'])
+    dwell = np.minimum(rng.exponential(6 * 3600, counts['pings']), 5 * 86400).round(6)
+    ping_strings = np.where(fractional, ping_times.strftime('%Y-%m-%dT%H:%M:%S.%f'),
+                            ping_times.strftime('%Y-%m-%dT%H:%M:%S'))
+
+    document_dates, _ = _times(rng, counts['documents'], start_date, days)
+    document_commodities = rng.integers(0, counts['commodities'], counts['documents'])
+    document_cities = rng.integers(0, counts['cities'], counts['documents'])
+    # positive deliveries come in, negative ones go out
+    qty = rng.normal(10, 15, counts['documents']).round(3)
+
+    harbor_dates, _ = _times(rng, counts['harbor_reports'], start_date, days)
+    harbor_vessels = rng.integers(0, counts['vessels'], counts['harbor_reports'])
+    harbor_locations = rng.integers(0, counts['cities'] + counts['points'], counts['harbor_reports'])
+
+    def links():
+        for time, dwell_seconds, location, vessel in zip(ping_strings, dwell, ping_locations, ping_vessels):
+            yield {'type': 'Event.TransportEvent.TransponderPing', 'time': str(time), 'dwell': float(dwell_seconds),
+                   'source': locations[location], 'target': vessels[vessel], 'key': 0}
+        for document, date, commodity, city in zip(documents, document_dates.strftime('%Y-%m-%d'),
+                                                   document_commodities, document_cities):
+            yield {'type': 'Event.Transaction', 'date': date, 'source': document,
+                   'target': commodities[commodity], 'key': 0}
+            yield {'type': 'Event.Transaction', 'date': date, 'source': document, 'target': cities[city], 'key': 1}
+        for date, vessel, location in zip(harbor_dates.strftime('%Y-%m-%d'), harbor_vessels, harbor_locations):
+            yield {'type': 'Event.HarborReport', 'date': date, 'source': vessels[vessel],
+                   'target': locations[location], 'key': 0}
+
+    with open(os.path.join(folder, 'mc2.json'), 'w') as file:
+        file.write('{"directed": true, "multigraph": true, "graph": {}, "nodes": ')
+        _write_array(file, nodes())
+        file.write(', "links": ')
+        _write_array(file, links())
+        file.write('}')
+
+    end_times = ping_times + pd.to_timedelta(dwell, unit='s')
+
+    def movements():
+        for start, end, vessel, location, dwell_seconds in zip(ping_times.strftime('%Y-%m-%dT%H:%M:%S'),
+                                                               end_times.strftime('%Y-%m-%dT%H:%M:%S'),
+                                                               ping_vessels, ping_locations, dwell):
+            yield {'start_time': start, 'end_time': end, 'vessel_id': vessels[vessel],
+                   'location_id': locations[location], 'dwell': float(dwell_seconds)}
+
+    with open(os.path.join(folder, 'transportMovements.json'), 'w') as file:
+        _write_array(file, movements())
+    return counts
@@ -0,0 +1,74 @@
+from bisect import bisect_left, bisect_right, insort
+from collections import defaultdict
+
+
+class UnionIndex:
+    """
+    The vessel-commodity union keyed by (date, location_id), each entry holding
+    the delivery reports ('commoditys') and the vessel movements ('vessels') of
+    that day and place.  Dates are kept sorted and vessels map back to their
+    keys, so new records merge in O(new items) and filtered reads only visit
+    the matching entries.
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self.dates = []
+        self.date_keys = defaultdict(list)
+        self.vessel_keys = defaultdict(set)
+
+    @staticmethod
+    def _date(value):
+        # '%Y-%m-%d' and '%Y-%m-%dT%H:%M:%S' both start with the day
+        return value[:10]
+
+    def _entry(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            date, location = key
+            entry = self.entries[key] = {'date': date, 'location_id': location, 'commoditys': [], 'vessels': []}
+            if date not in self.date_keys:
+                insort(self.dates, date)
+            self.date_keys[date].append(key)
+        return entry
+
+    def add_commodities(self, date_location_commodity):
+        for item in date_location_commodity:
+            key = (self._date(item['date']), item['location_id'])
+            self._entry(key)['commoditys'].append(
+                {'document_id': item['document_id'], 'commodity_id': item['commodity_id'], 'qty_tons': item['qty_tons']})
+
+    def add_vessel_movements(self, vessel_movements):
+        for item in vessel_movements:
+            key = (self._date(item['date']), item['location_id'])
+            self._entry(key)['vessels'].append(
+                {'movement_id': item['movement_id'], 'vessel_id': item['vessel_id'], 'key': item['key']})
+            self.vessel_keys[item['vessel_id']].add(key)
+
+    def query(self, start_date=None, end_date=None, location_ids=None, vessel_ids=None):
+        """
+        Entries within [start_date, end_date] at location_ids, sorted by date.
+        With vessel_ids, only entries visited by one of those vessels are kept
+        and their 'vessels' are narrowed down to them.
+        """
+        lo = 0 if start_date is None else bisect_left(self.dates, start_date)
+        hi = len(self.dates) if end_date is None else bisect_right(self.dates, end_date)
+        if vessel_ids is None:
+            keys = [key for date in self.dates[lo:hi] for key in self.date_keys[date]]
+        else:
+            vessel_ids = set(vessel_ids)
+            keys = {key for vessel in vessel_ids for key in self.vessel_keys.get(vessel, ())}
+            keys = [key for key in keys if (start_date is None or key[0] >= start_date)
+                    and (end_date is None or key[0] <= end_date)]
+        if location_ids is not None:
+            location_ids = set(location_ids)
+            keys = [key for key in keys if key[1] in location_ids]
+
+        result = []
+        for key in sorted(keys, key=lambda key: (key[0], key[1] or '')):
+            entry = self.entries[key]
+            vessels = entry['vessels'] if vessel_ids is None else \
+                [vessel for vessel in entry['vessels'] if vessel['vessel_id'] in vessel_ids]
+            result.append({'date': entry['date'], 'location_id': entry['location_id'],
+                           'commoditys': list(entry['commoditys']), 'vessels': list(vessels)})
+        return result
@@ -1,18 +1,93 @@
 from src import app
-from src.models import Model
-from flask import request
+from src.models import Model, FOLDER_CACHE, FOLDER_METRICS, FOLDER_INBOX, FOLDER_JOBS, SIMILARITY_WINDOW, \
+    SIMILARITY_WINDOW_SIZE
+from src.jobs import JobScheduler, DONE, FAILED, CANCELLED
+from src.distance import check_engine
+from src.distance_cache import cache_key
+from src.pagination import PaginationError
+from src.responses import negotiated
+from src.metrics import instrument, registry
+from src.serving import worker_state
+from src.ingest import Inbox
+from flask import request, Response, g
+from datetime import datetime
+import os
 import json
 
 # initialize the model
 model = Model()
+# job records are shared through the cache folder, any worker answers for a job another one started
+scheduler = JobScheduler(os.path.join(model.DATA_FOLDER, FOLDER_CACHE, FOLDER_JOBS), lock=model.lock, clear=True)
+# per-route and per-stage timings, summed over every process serving this data folder
+instrument(app, os.path.join(model.DATA_FOLDER, FOLDER_CACHE, FOLDER_METRICS), clear=True)
+# responses of the data views depend on the request and the loaded data only
+versioned = negotiated(lambda: model.data_version)
+# batch files dropped into data/inbox are ingested when INGEST_WATCH=1 (serve.py --watch in production)
+inbox = Inbox(os.path.join(model.DATA_FOLDER, FOLDER_INBOX), model.ingest_log, model.check_batch)
+if os.environ.get('INGEST_WATCH') == '1':
+    inbox.start()
 print("================================================================")
 
 
+def _invalid_dates(*dates):
+    # the error message for the first given date that is not YYYY-MM-DD, None when they are all fine
+    for date in dates:
+        if date is not None:
+            try:
+                datetime.strptime(date, '%Y-%m-%d')
+            except (TypeError, ValueError):
+                return f'invalid date: {date!r}, expected YYYY-MM-DD'
+    return None
+
+
 @app.route('/get')
 def _get():
     return "Get"
 
 
+@app.route('/metrics')
+def metrics():
+    return Response(registry.collect(), mimetype='text/plain; version=0.0.4')
+
+
+@app.before_request
+def catch_up():
+    # batches ingested through another worker or the inbox are applied before the request reads the model
+    model.catch_up()
+    # /ingest applies its batch under the write side itself
+    if request.endpoint != 'ingest':
+        model.lock.acquire_read()
+        g.model_read = True
+
+
+@app.teardown_request
+def release_model(_):
+    if g.pop('model_read', False):
+        model.lock.release_read()
+
+
+@app.route('/ingest', methods=['POST'])
+def ingest():
+    """
+    Append new graph records, {"nodes": [...], "links": [...]} as in mc2.json,
+    e.g. a day of TransponderPing and Transaction links with their
+    DeliveryReport nodes.  Only the derived structures they touch are updated.
+    """
+    try:
+        # the raw body, also when a client labels it as form data
+        post_data = json.loads(request.get_data(as_text=True) or '{}')
+        return json.dumps(model.ingest(post_data))
+    except ValueError as e:
+        return json.dumps({"error": str(e)}), 400
+
+
+@app.route('/ready')
+def ready():
+    # the model is loaded before any route answers, so only a draining worker is not ready
+    return json.dumps({"ready": worker_state.ready, "pid": os.getpid(), "data_version": model.data_version,
+                       "served": worker_state.served}), 200 if worker_state.ready else 503
+
+
 @app.route('/get_example_data')
 def _get_example_data():
     return model.get_example_data()
@@ -30,22 +105,81 @@ def _modify_example_data():
 
 
 @app.route('/get_vessel_movements')
+@versioned
 def get_vessel_movements():
-    return model.get_vessel_movements()
+    # query string: start_date, end_date, vessel_id and location_id (repeatable), cursor, limit
+    error = _invalid_dates(request.args.get("start_date"), request.args.get("end_date"))
+    if error:
+        return json.dumps({"error": error}), 400
+    try:
+        return json.dumps(model.query_transport_movements(
+            request.args.get("start_date"), request.args.get("end_date"),
+            request.args.getlist("vessel_id") or None, request.args.getlist("location_id") or None,
+            request.args.get("cursor"), request.args.get("limit")))
+    except PaginationError as e:
+        return json.dumps({"error": str(e)}), 400
+
+
+def _vessel_tsne_params(post_data):
+    args = (post_data["start_date"], post_data["end_date"], post_data["vessel_ids"], post_data["location_ids"])
+    # distance engine: metric 'dtw' | 'euclidean', window None | 'sakoe_chiba' | 'itakura',
+    # window_size is the band radius / maximum slope, max_distance bounds the pairs worth refining
+    kwargs = {"metric": post_data.get("metric", "dtw"),
+              "window": post_data.get("window"),
+              "window_size": post_data.get("window_size"),
+              "max_distance": post_data.get("max_distance"),
+              "n_jobs": post_data.get("n_jobs")}
+    check_engine(**kwargs)
+    error = _invalid_dates(args[0], args[1])
+    if error:
+        raise ValueError(error)
+    return args, kwargs
 
 
 @app.route('/get_vessel_tsne', methods=['POST'])
+@versioned
 def get_vessel_tsne():
     post_data = request.data.decode()
     post_data = json.loads(post_data)
-    start_date = post_data["start_date"]
-    end_date = post_data["end_date"]
-    vessel_ids = post_data["vessel_ids"]
-    location_ids = post_data["location_ids"]
-    time_series = model.get_vessel_time_series(start_date, end_date, vessel_ids, location_ids)
-    return model.get_vessel_tsne(time_series)
+    try:
+        args, kwargs = _vessel_tsne_params(post_data)
+        return model.get_vessel_embedding(*args, **kwargs)
+    except (TypeError, ValueError) as e:
+        return json.dumps({"error": str(e)}), 400
+
+
+def _similarity_index_params(post_data):
+    args = (post_data["start_date"], post_data["end_date"], post_data["location_ids"])
+    # DTW band of the index, a week wide Sakoe-Chiba band unless given
+    kwargs = {"window": post_data.get("window", SIMILARITY_WINDOW),
+              "window_size": post_data.get("window_size", SIMILARITY_WINDOW_SIZE)}
+    return args, kwargs
+
+
+@app.route('/get_similar_vessels', methods=['POST'])
+@versioned
+def get_similar_vessels():
+    """
+    The k (default 10) vessels behaving most like "vessel_id" over start_date,
+    end_date and location_ids, nearest first, with metric 'dtw' | 'euclidean'
+    as for /get_vessel_tsne.  Every vessel active in the window is a candidate.
+    """
+    post_data = request.data.decode()
+    post_data = json.loads(post_data)
+    (start_date, end_date, location_ids), kwargs = _similarity_index_params(post_data)
+    vessel_id = post_data["vessel_id"]
+    try:
+        return json.dumps(model.get_similar_vessels(vessel_id, start_date, end_date, location_ids,
+                                                    post_data.get("k", 10), post_data.get("metric", "dtw"),
+                                                    **kwargs))
+    except KeyError:
+        return json.dumps({"error": "vessel has no movement in the window"}), 404
+    except (TypeError, ValueError) as e:
+        return json.dumps({"error": str(e)}), 400
+
 
 @app.route('/get_aggregate_vessel_movements', methods=['POST'])
+@versioned
 def get_aggregate_vessel_movements():
     post_data = request.data.decode()
     post_data = json.loads(post_data)
@@ -54,4 +188,186 @@ def get_aggregate_vessel_movements():
     vessel_ids = post_data["vessel_ids"]
     location_ids = post_data["location_ids"]
     
-    return model.get_aggregate_vessel_movements(start_date, end_date, vessel_ids, location_ids)
\ No newline at end of file
+    return model.get_aggregate_vessel_movements(start_date, end_date, vessel_ids, location_ids)
+
+
+@app.route('/jobs/vessel_tsne', methods=['POST'])
+def submit_vessel_tsne():
+    """
+    Same body as /get_vessel_tsne, computed in the background. Identical
+    requests in flight share one job, and a job submitted with the same
+    "channel" as a previous one (e.g. one per client view) cancels it.
+    """
+    post_data = request.data.decode()
+    post_data = json.loads(post_data)
+    try:
+        (start_date, end_date, vessel_ids, location_ids), kwargs = _vessel_tsne_params(post_data)
+        args = (start_date, end_date, sorted(set(vessel_ids)), sorted(set(location_ids)))
+    except (TypeError, ValueError) as e:
+        return json.dumps({"error": str(e)}), 400
+    key = cache_key('vessel_tsne', model.data_version, args, kwargs)
+    job = scheduler.submit(model.get_vessel_embedding, args, kwargs, key=key, channel=post_data.get("channel"))
+    return json.dumps(job.to_dict()), 202
+
+
+@app.route('/jobs/similarity_index', methods=['POST'])
+def submit_similarity_index():
+    """
+    Build the index /get_similar_vessels uses for a window ahead of time,
+    same body without vessel_id, k and metric.  The index is saved to the
+    cache folder, where every worker picks it up.
+    """
+    post_data = request.data.decode()
+    post_data = json.loads(post_data)
+    (start_date, end_date, location_ids), kwargs = _similarity_index_params(post_data)
+    args = (start_date, end_date, sorted(set(location_ids)))
+    key = cache_key('similarity_index', model.data_version, args, kwargs)
+    job = scheduler.submit(model.build_similarity_index, args, kwargs, key=key, channel=post_data.get("channel"))
+    return json.dumps(job.to_dict()), 202
+
+
+@app.route('/jobs/<job_id>')
+def get_job(job_id):
+    job = scheduler.get(job_id)
+    if job is None:
+        return json.dumps({"error": "unknown job"}), 404
+    return json.dumps(job.to_dict())
+
+
+@app.route('/jobs/<job_id>/result')
+def get_job_result(job_id):
+    job = scheduler.get(job_id)
+    if job is None:
+        return json.dumps({"error": "unknown job"}), 404
+    if job.state == DONE:
+        return job.result
+    if job.state in (FAILED, CANCELLED):
+        return json.dumps(job.to_dict()), 410
+    return json.dumps(job.to_dict()), 202
+
+
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    job = scheduler.cancel(job_id)
+    if job is None:
+        return json.dumps({"error": "unknown job"}), 404
+    return json.dumps(job.to_dict())
+
+
+@app.route('/get_date_location_commodity', methods=['POST'])
+@versioned
+def get_date_location_commodity():
+    # every field is optional: direction 'import' | 'export', start_date, end_date, location_ids
+    post_data = request.data.decode() or '{}'
+    post_data = json.loads(post_data)
+    error = _invalid_dates(post_data.get("start_date"), post_data.get("end_date"))
+    if error:
+        return json.dumps({"error": error}), 400
+    try:
+        return json.dumps(model.get_date_location_commodity(post_data.get("direction"), post_data.get("start_date"),
+                                                            post_data.get("end_date"), post_data.get("location_ids")))
+    except ValueError as e:
+        return json.dumps({"error": str(e)}), 400
+
+
+@app.route('/get_vessel_commodity_union', methods=['POST'])
+@versioned
+def get_vessel_commodity_union():
+    # every field is optional: start_date, end_date, location_ids, vessel_ids
+    post_data = request.data.decode() or '{}'
+    post_data = json.loads(post_data)
+    return json.dumps(model.query_vessel_commodity_union(post_data.get("start_date"), post_data.get("end_date"),
+                                                         post_data.get("location_ids"), post_data.get("vessel_ids")))
+
+
+@app.route('/query_transport_movements', methods=['POST'])
+@versioned
+def query_transport_movements():
+    # every field is optional: start_date, end_date, vessel_ids, location_ids, cursor, limit
+    post_data = request.data.decode() or '{}'
+    post_data = json.loads(post_data)
+    error = _invalid_dates(post_data.get("start_date"), post_data.get("end_date"))
+    if error:
+        return json.dumps({"error": error}), 400
+    try:
+        return json.dumps(model.query_transport_movements(
+            post_data.get("start_date"), post_data.get("end_date"), post_data.get("vessel_ids"),
+            post_data.get("location_ids"), post_data.get("cursor"), post_data.get("limit")))
+    except PaginationError as e:
+        return json.dumps({"error": str(e)}), 400
+
+
+@app.route('/query_harbor_movements', methods=['POST'])
+@versioned
+def query_harbor_movements():
+    # every field is optional: start_date, end_date, vessel_ids, location_ids, vessel_types, cursor, limit
+    post_data = request.data.decode() or '{}'
+    post_data = json.loads(post_data)
+    error = _invalid_dates(post_data.get("start_date"), post_data.get("end_date"))
+    if error:
+        return json.dumps({"error": error}), 400
+    try:
+        return json.dumps(model.query_harbor_movements(
+            post_data.get("start_date"), post_data.get("end_date"), post_data.get("vessel_ids"),
+            post_data.get("location_ids"), post_data.get("vessel_types"), post_data.get("cursor"),
+            post_data.get("limit")))
+    except PaginationError as e:
+        return json.dumps({"error": str(e)}), 400
+
+
+@app.route('/get_commodity_fishing_locations')
+@versioned
+def get_commodity_fishing_locations():
+    # commodity id -> region ids where its species is present; commodity_id (repeatable) narrows it down
+    commodity_fishing_locations = model.get_commodity_fishing_locations()
+    commodity_ids = request.args.getlist("commodity_id")
+    if commodity_ids:
+        commodity_fishing_locations = {commodity_id: commodity_fishing_locations.get(commodity_id, [])
+                                       for commodity_id in commodity_ids}
+    return json.dumps(commodity_fishing_locations)
+
+
+@app.route('/get_commodity_distributions')
+@versioned
+def get_commodity_distributions():
+    # every delivery report as {date, commodity_id, location_id, document_id}, by document id
+    return json.dumps(model.get_commodity_distributions())
+
+
+@app.route('/get_rollup', methods=['POST'])
+@versioned
+def get_rollup():
+    """
+    Pre-aggregated heatmap data: "kind" 'vessel' (visits, dwell) or
+    'commodity' (reports, import_tons, export_tons) per location and bin over
+    start_date, end_date.  Optional: bins (the most the view can show, the
+    finest of day / week / month that fits is used), resolution to force one,
+    ids (vessel or commodity ids) and location_ids.
+    """
+    post_data = request.data.decode()
+    post_data = json.loads(post_data)
+    try:
+        return json.dumps(model.get_rollup(
+            post_data["kind"], post_data["start_date"], post_data["end_date"], post_data.get("bins"),
+            post_data.get("resolution"), post_data.get("ids"), post_data.get("location_ids")))
+    except (TypeError, ValueError) as e:
+        return json.dumps({"error": str(e)}), 400
+
+
+@app.route('/query_commodity_distributions', methods=['POST'])
+@versioned
+def query_commodity_distributions():
+    # every field is optional: direction 'import' | 'export', start_date, end_date, location_ids,
+    # commodity_ids, cursor, limit
+    post_data = request.data.decode() or '{}'
+    post_data = json.loads(post_data)
+    error = _invalid_dates(post_data.get("start_date"), post_data.get("end_date"))
+    if error:
+        return json.dumps({"error": error}), 400
+    try:
+        return json.dumps(model.query_commodity_distributions(
+            post_data.get("direction"), post_data.get("start_date"), post_data.get("end_date"),
+            post_data.get("location_ids"), post_data.get("commodity_ids"), post_data.get("cursor"),
+            post_data.get("limit")))
+    except ValueError as e:
+        return json.dumps({"error": str(e)}), 400